@@ -0,0 +1,53 @@
+import argparse
+import importlib
+import os
+import sys
+
+from utils import compare_kernels, trace_diff, write_trace_diff
+from metal_daemon import with_kernel_source
+from metal_puzzles import problems
+
+
+def load_kernel(problem, spec):
+    """Kernel factory for `spec`: a `module:function`, or a file with the kernel source."""
+    if os.path.exists(spec):
+        with open(spec) as f:
+            return with_kernel_source(problem, f.read()).fn
+    module, _, name = spec.partition(":")
+    if not name:
+        raise ValueError(f"{spec!r} is neither a file nor a module:function")
+    return getattr(importlib.import_module(module), name)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare kernel implementations of a problem")
+    parser.add_argument("problem", help="problem name, e.g. 'Matmul (Full)'")
+    parser.add_argument("kernels", nargs="+", help="kernel source files or module:function factories")
+    parser.add_argument("--names", nargs="+", help="names for the kernels, by default their files or functions")
+    parser.add_argument("--repeat", type=int, default=10, help="runs to time each kernel over")
+    parser.add_argument("--svg", help="where to draw the trace diff of the last kernel against the first")
+    args = parser.parse_args(argv)
+
+    if args.problem not in problems:
+        raise KeyError(f"Unknown problem {args.problem!r}")
+    if len(args.kernels) < 2:
+        parser.error("need at least two kernels to compare")
+    names = args.names or [os.path.basename(k).rpartition(":")[2] for k in args.kernels]
+    if len(names) != len(args.kernels):
+        parser.error("give one name per kernel")
+
+    problem = problems[args.problem]
+    kernels = {name: load_kernel(problem, spec) for name, spec in zip(names, args.kernels)}
+    variants = compare_kernels(problem, kernels, args.repeat)
+
+    if args.svg:
+        first, last = variants[0], variants[-1]
+        write_trace_diff(
+            last.results, trace_diff(first.cells, last.cells), f"{problem.name}: {first.name} -> {last.name}", args.svg
+        )
+        print(f"Wrote {args.svg}")
+    return 0 if all(v.passed is not False for v in variants) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
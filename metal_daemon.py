@@ -0,0 +1,203 @@
+import argparse
+import dataclasses
+import io
+import json
+import os
+import socket
+import socketserver
+import stat
+import sys
+import traceback
+
+from concurrent.futures import ThreadPoolExecutor
+
+# Importing these once is the whole point of the daemon: MLX, chalk, colour
+# and the Metal logo stay loaded, and the kernel/simulator caches in `utils`
+# stay warm across requests.
+from utils import write_results
+from metal_puzzles import problems
+
+DEFAULT_SOCKET = os.getenv("METAL_PUZZLES_SOCKET", "/tmp/metal_puzzles.sock")
+COMMANDS = ["run", "check", "score", "show"]
+
+
+def with_kernel_source(problem, source=None, header=None):
+    """Copy `problem`, replacing its kernel's source and/or header.
+
+    The copy is made even when there is nothing to replace: requests run
+    concurrently, and running a problem sets its `metalKernel` and launch.
+    """
+    if source is None and header is None:
+        return dataclasses.replace(problem)
+
+    fn = problem.fn
+
+    def kernel_fn(*inputs):
+        kernel = fn(*inputs)
+        return dataclasses.replace(
+            kernel,
+            source=kernel.source if source is None else source,
+            header=kernel.header if header is None else header,
+        )
+
+    return dataclasses.replace(problem, fn=kernel_fn)
+
+
+def handle(request):
+    command = request.get("command")
+    if command == "list":
+        return list(problems)
+    if command not in COMMANDS:
+        raise ValueError(f"Unknown command {command!r}, expected one of {COMMANDS + ['list']}")
+    if request.get("problem") not in problems:
+        raise KeyError(f"Unknown problem {request.get('problem')!r}")
+
+    # Never touch the shared problem itself; see `with_kernel_source`.
+    problem = with_kernel_source(
+        problems[request["problem"]], request.get("source"), request.get("header")
+    )
+
+    if command == "run":
+        problem.metalKernel = problem.fn(*problem.inputs)
+        outputs = problem.run_metal()
+        if isinstance(outputs, tuple):
+            return [x.tolist() for x in outputs]
+        return outputs.tolist()
+    if command == "check":
+        # Report why a check failed to the client, not the daemon's stdout.
+        problem.metalKernel = problem.fn(*problem.inputs)
+        try:
+            failed = problem.compare(problem.run_metal())
+        except AssertionError as e:
+            return {"passed": False, "error": str(e)}
+        return {"passed": not failed, "mismatches": [str(m) for m in failed]}
+
+    if command == "score":
+        # Static analysis where possible; no need to run every thread.
+        return {"score": problem.score().to_dict()}
+
+    results = problem.run_python()
+    score = problem.score(results).to_dict()
+
+    svg = io.StringIO()
+    write_results(
+        results, problem.name, problem.threadsperblock.x, problem.threadsperblock.y, svg
+    )
+    return {"score": score, "svg": svg.getvalue()}
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        line = self.rfile.readline()
+        if not line.strip():
+            # A bare connection, like the liveness probe of another daemon.
+            return
+        try:
+            response = {"ok": True, "result": handle(json.loads(line))}
+        except Exception as e:
+            traceback.print_exc()
+            response = {"ok": False, "error": f"{type(e).__name__}: {e}"}
+        self.wfile.write(json.dumps(response).encode() + b"\n")
+
+
+class DaemonServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Unix socket server that hands each connection to a fixed worker pool."""
+
+    def __init__(self, path, workers):
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        super().__init__(path, RequestHandler)
+
+    def process_request(self, request, client_address):
+        self.pool.submit(self.process_request_thread, request, client_address)
+
+    def server_close(self):
+        super().server_close()
+        self.pool.shutdown(wait=True)
+
+
+def remove_stale_socket(path):
+    """Remove the socket at `path` left behind by a daemon that is gone.
+
+    Raises if another daemon is still listening there, or if `path` is not
+    a socket at all.
+    """
+    if not os.path.exists(path):
+        return
+    if not stat.S_ISSOCK(os.stat(path).st_mode):
+        raise FileExistsError(f"{path} exists and is not a socket")
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(path)
+        except (ConnectionRefusedError, FileNotFoundError):
+            pass
+        else:
+            raise RuntimeError(f"A daemon is already listening on {path}")
+    os.unlink(path)
+
+
+def serve(path=DEFAULT_SOCKET, workers=4):
+    remove_stale_socket(path)
+    with DaemonServer(path, workers) as server:
+        print(f"Serving {len(problems)} problems on {path} with {workers} workers")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.unlink(path)
+
+
+def send(request, path=DEFAULT_SOCKET):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(path)
+        sock.sendall(json.dumps(request).encode() + b"\n")
+        data = b""
+        while chunk := sock.recv(65536):
+            data += chunk
+    response = json.loads(data)
+    if not response["ok"]:
+        raise RuntimeError(response["error"])
+    return response["result"]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Metal Puzzles daemon")
+    parser.add_argument("--socket", default=DEFAULT_SOCKET)
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    serve_parser = sub.add_parser("serve", help="start the daemon")
+    serve_parser.add_argument("--workers", type=int, default=4)
+
+    sub.add_parser("list", help="list problem names")
+
+    for command in COMMANDS:
+        p = sub.add_parser(command, help=f"{command} a problem on the daemon")
+        p.add_argument("problem", help="problem name, e.g. 'Map' or 'Matmul (Full)'")
+        p.add_argument("--source", help="file with the kernel source to use")
+        p.add_argument("--header", help="file with the kernel header to use")
+        if command == "show":
+            p.add_argument("--out", default="out.svg", help="where to write the SVG")
+
+    args = parser.parse_args(argv)
+
+    if args.command == "serve":
+        return serve(args.socket, args.workers)
+
+    request = {"command": args.command}
+    if args.command != "list":
+        request["problem"] = args.problem
+        for key in ["source", "header"]:
+            if getattr(args, key):
+                with open(getattr(args, key)) as f:
+                    request[key] = f.read()
+
+    result = send(request, args.socket)
+    if args.command == "show":
+        with open(args.out, "w") as f:
+            f.write(result.pop("svg"))
+        print(f"Wrote {args.out}")
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,240 @@
+import argparse
+import dataclasses
+import json
+import multiprocessing
+import os
+import random
+import sys
+
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import mlx.core as mx
+    xp = mx
+except ImportError:
+    # Without MLX only the bounds are checked, on NumPy inputs.
+    mx = None
+    import numpy as xp
+
+from metal_puzzles import problems
+
+DEFAULT_CORPUS = os.getenv("METAL_PUZZLES_CORPUS", "fuzz_corpus.json")
+MAX_SHRINK_STEPS = 200
+
+
+def dtype_name(dtype):
+    return str(dtype).split(".")[-1]
+
+
+def generate(problem, rng):
+    """Draw a random case inside `problem.constraints`."""
+    c = problem.constraints
+    return {
+        "problem": problem.name,
+        "sizes": {name: rng.randint(lo, hi) for name, (lo, hi) in c.sizes.items()},
+        "dtype": dtype_name(rng.choice(c.dtypes)),
+        "seed": rng.randrange(2**32),
+    }
+
+
+def instantiate(problem, case):
+    """Copy `problem` with the inputs and launch of `case`.
+
+    Inputs are drawn from the case's `seed`, unless the case lists them
+    explicitly, as shrunk cases do.
+    """
+    c = problem.constraints
+    launch = c.launch(**case["sizes"])
+    dtype, inputs = (mlx_inputs if mx is not None else numpy_inputs)(case, launch["inputs"], c.values)
+    changes = {k: launch[k] for k in ["output_shapes", "grid", "threadgroup"] if k in launch}
+    problem = dataclasses.replace(problem, inputs=inputs, input_dtypes=None, **changes)
+    if xp.issubdtype(dtype, xp.floating):
+        # Half precision kernels write half precision outputs, which are
+        # then compared with that dtype's tolerance.
+        problem.output_dtypes = [dtype] * len(problem.output_shapes)
+    return problem
+
+
+def mlx_inputs(case, shapes, values):
+    """`(dtype, inputs)` of `case`: listed explicitly, or drawn from its `seed`."""
+    dtype = getattr(mx, case["dtype"])
+    if "inputs" in case:
+        return dtype, [mx.array(x, dtype=dtype) for x in case["inputs"]]
+    keys = mx.random.split(mx.random.key(case["seed"]), len(shapes))
+    lo, hi = values
+    if mx.issubdtype(dtype, mx.floating):
+        return dtype, [mx.random.uniform(lo, hi, shape, dtype, key=k) for shape, k in zip(shapes, keys)]
+    return dtype, [mx.random.randint(lo, hi + 1, shape, dtype, key=k) for shape, k in zip(shapes, keys)]
+
+
+def numpy_inputs(case, shapes, values):
+    """`(dtype, inputs)` of `case` as NumPy arrays, for running without MLX."""
+    # NumPy has no bfloat16; float16 is the same size, which is all the
+    # bounds check needs.
+    dtype = xp.dtype("float16" if case["dtype"] == "bfloat16" else case["dtype"])
+    if "inputs" in case:
+        return dtype, [xp.array(x, dtype=dtype) for x in case["inputs"]]
+    rng = xp.random.default_rng(case["seed"])
+    lo, hi = values
+    if xp.issubdtype(dtype, xp.floating):
+        return dtype, [rng.uniform(lo, hi, shape).astype(dtype) for shape in shapes]
+    return dtype, [rng.integers(lo, hi + 1, shape, dtype=dtype) for shape in shapes]
+
+
+def run_case(case):
+    """Run one case, returning why it failed or None if it passed.
+
+    The static analysis checks every access is in bounds. Where Metal is
+    available, the kernel's outputs are also compared against the spec.
+    """
+    try:
+        problem = instantiate(problems[case["problem"]], case)
+        for message in problem.analyze().out_of_bounds:
+            return message
+        if mx is None or not mx.metal.is_available():
+            return None
+
+        problem.metalKernel = problem.fn(*problem.inputs)
+        failed = problem.compare(problem.run_metal(), limit=1)
+        if failed:
+            return str(failed[0])
+    except Exception as e:
+        return f"{type(e).__name__}: {e}"
+    return None
+
+
+def complexity(v):
+    """Rank a value: 0, then 1, then other integers, then the rest."""
+    return 0 if v == 0 else 1 if v == 1 else 2 if v == round(v) else 3
+
+
+def candidates(case):
+    """Simpler variants of `case`, smallest sizes first, then simpler values."""
+    c = problems[case["problem"]].constraints
+    for name, (lo, _) in c.sizes.items():
+        v = case["sizes"][name]
+        for smaller in sorted({lo, (lo + v) // 2, v - 1}):
+            if lo <= smaller < v:
+                yield {**case, "sizes": {**case["sizes"], name: smaller}, "inputs": None}
+
+    inputs = case["inputs"]
+    flat = [xp.array(x).reshape(-1).tolist() for x in inputs]
+    for i, x in enumerate(inputs):
+        for fill in [0, 1]:
+            if any(v != fill for v in flat[i]) and all(complexity(v) >= complexity(fill) for v in flat[i]):
+                yield {**case, "inputs": inputs[:i] + [xp.full(xp.array(x).shape, fill).tolist()] + inputs[i + 1 :]}
+    for i, values in enumerate(flat):
+        shape = xp.array(inputs[i]).shape
+        for j, v in enumerate(values):
+            for simpler in [0, 1, round(v)]:
+                if complexity(simpler) < complexity(v):
+                    new = values[:j] + [simpler] + values[j + 1 :]
+                    yield {**case, "inputs": inputs[:i] + [xp.array(new).reshape(shape).tolist()] + inputs[i + 1 :]}
+
+
+def materialize(case):
+    """Give `case` explicit inputs, so they can be shrunk and saved."""
+    if case.get("inputs") is not None:
+        return case
+    case = {k: v for k, v in case.items() if k != "inputs"}
+    problem = instantiate(problems[case["problem"]], case)
+    return {**case, "inputs": [x.tolist() for x in problem.inputs]}
+
+
+def shrink(case, message):
+    """Greedily simplify a failing case for as long as it keeps failing."""
+    case = materialize(case)
+    steps = 0
+    progress = True
+    while progress and steps < MAX_SHRINK_STEPS:
+        progress = False
+        for candidate in candidates(case):
+            steps += 1
+            candidate = materialize(candidate)
+            result = run_case(candidate)
+            if result is not None:
+                case, message, progress = candidate, result, True
+                break
+            if steps >= MAX_SHRINK_STEPS:
+                break
+    return {**case, "message": message}
+
+
+def load_corpus(path):
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_corpus(path, corpus):
+    with open(path, "w") as f:
+        json.dump(corpus, f, indent=1)
+
+
+def fuzz(names, cases=100, workers=None, seed=0, corpus_path=DEFAULT_CORPUS):
+    """Replay the corpus, then fuzz `names` with `cases` random cases each.
+
+    New failures are shrunk, one per problem, and added to the corpus.
+    Returns the number of failing cases.
+    """
+    corpus = load_corpus(corpus_path)
+    replay = [case for case in corpus if case["problem"] in names]
+    rng = random.Random(seed)
+    fresh = [generate(problems[name], rng) for name in names for _ in range(cases)]
+
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(workers, mp_context=context) as pool:
+        replayed = list(pool.map(run_case, replay))
+        results = list(pool.map(run_case, fresh, chunksize=8))
+
+    failures = 0
+    for case, message in zip(replay, replayed):
+        if message is not None:
+            failures += 1
+            print(f"{case['problem']}: corpus case {case['sizes']} still fails: {message}")
+
+    first = {}
+    for case, message in zip(fresh, results):
+        if message is not None:
+            failures += 1
+            first.setdefault(case["problem"], (case, message))
+    for name in names:
+        failed = sum(1 for case, m in zip(fresh, results) if case["problem"] == name and m is not None)
+        print(f"{name}: {failed} of {cases} cases failed")
+
+    known = [{k: v for k, v in case.items() if k != "message"} for case in corpus]
+    for name, (case, message) in first.items():
+        small = shrink(case, message)
+        print(f"{name}: shrunk to {small['sizes']} {small['dtype']}: {small['message']}")
+        if {k: v for k, v in small.items() if k != "message"} not in known:
+            corpus.append(small)
+    if first:
+        save_corpus(corpus_path, corpus)
+        print(f"Saved {len(corpus)} cases to {corpus_path}")
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Fuzz the puzzle kernels against their specs")
+    parser.add_argument("problems", nargs="*", help="problem names, by default every problem with constraints")
+    parser.add_argument("--cases", type=int, default=100, help="random cases per problem")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--corpus", default=DEFAULT_CORPUS, help="JSON file of failing cases, replayed first")
+    args = parser.parse_args(argv)
+
+    names = args.problems or [name for name, p in problems.items() if p.constraints is not None]
+    for name in names:
+        if name not in problems:
+            raise KeyError(f"Unknown problem {name!r}")
+        if problems[name].constraints is None:
+            raise ValueError(f"Problem {name!r} declares no constraints to fuzz")
+    if mx is None or not mx.metal.is_available():
+        print("Metal is not available: only checking that accesses stay in bounds.")
+
+    return 1 if fuzz(names, args.cases, args.workers, args.seed, args.corpus) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
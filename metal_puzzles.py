@@ -1,12 +1,42 @@
-import mlx.core as mx
-from utils import MetalProblem, MetalKernel
+from utils import MetalProblem, MetalKernel, Constraints
 import sys
 
-if len(sys.argv) != 2:
-    print("Usage: python3 metal_puzzles.py {PUZZLE_NUMBER}")
-    sys.exit(1)
+try:
+    import mlx.core as mx
+except ImportError:
+    # Simulating and scoring only need the shapes and dtypes of the
+    # inputs, so without MLX the problems get NumPy inputs with MLX's
+    # default dtypes.
+    from types import SimpleNamespace
+    import numpy as np
+
+    mx = SimpleNamespace(
+        array=np.ndarray,
+        float32=np.float32,
+        arange=lambda *args, dtype=np.int32: np.arange(*args, dtype=dtype),
+        ones=lambda shape, dtype=np.float32: np.ones(shape, dtype),
+        zeros=lambda shape, dtype=np.float32: np.zeros(shape, dtype),
+    )
+
+# Every problem below is registered by name, so tools such as
+# `metal_daemon.py` can import this file without running the puzzles.
+problems = {}
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print("Usage: python3 metal_puzzles.py {PUZZLE_NUMBER}")
+        sys.exit(1)
+
+    puzzle_number = int(sys.argv[1])
+else:
+    puzzle_number = 0
+
+def run(problem):
+    problems[problem.name] = problem
+    if __name__ == "__main__":
+        problem.show()
 
-puzzle_number = int(sys.argv[1])
+        problem.check()
 
 ############################################################
 ### Puzzle 1: Map
@@ -53,12 +83,16 @@ if puzzle_number == 0 or puzzle_number == 1:
         [a], 
         output_shape,
         grid=(SIZE,1,1), 
-        spec=map_spec
+        spec=map_spec,
+        chunk_axes=(0,),
+        constraints=Constraints(
+            sizes={"n": (1, 64)},
+            launch=lambda n: dict(inputs=[(n,)], output_shapes=(n,), grid=(n, 1, 1)),
+            dtypes=("float32", "float16", "bfloat16", "int32"),
+        ),
     )
 
-    problem.show()
-
-    problem.check()
+    run(problem)
 
 ############################################################
 ### Puzzle 2: Zip
@@ -97,12 +131,16 @@ if puzzle_number == 0 or puzzle_number == 2:
         [a, b],
         output_shapes,
         grid=(SIZE,1,1),
-        spec=zip_spec
+        spec=zip_spec,
+        chunk_axes=(0, 0),
+        constraints=Constraints(
+            sizes={"n": (1, 64)},
+            launch=lambda n: dict(inputs=[(n,), (n,)], output_shapes=(n,), grid=(n, 1, 1)),
+            dtypes=("float32", "float16", "bfloat16", "int32"),
+        ),
     )
 
-    problem.show()
-
-    problem.check()
+    run(problem)
 
 ############################################################
 ### Puzzle 3: Guard
@@ -145,12 +183,16 @@ if puzzle_number == 0 or puzzle_number == 3:
         [a], 
         output_shape,
         grid=(8,1,1), 
-        spec=map_spec
+        spec=map_spec,
+        chunk_axes=(0,),
+        constraints=Constraints(
+            sizes={"n": (1, 32), "extra": (0, 8)},
+            launch=lambda n, extra: dict(inputs=[(n,)], output_shapes=(n,), grid=(n + extra, 1, 1)),
+            dtypes=("float32", "float16", "bfloat16", "int32"),
+        ),
     )
 
-    problem.show()
-
-    problem.check()
+    run(problem)
 
 ############################################################
 ### Puzzle 4: Map 2D
@@ -190,12 +232,18 @@ if puzzle_number == 0 or puzzle_number == 4:
         [a], 
         output_shape,
         grid=(3,3,1), 
-        spec=map_spec
+        spec=map_spec,
+        chunk_axes=(0,),
+        constraints=Constraints(
+            sizes={"rows": (1, 8), "cols": (1, 8), "extra": (0, 3)},
+            launch=lambda rows, cols, extra: dict(
+                inputs=[(rows, cols)], output_shapes=(rows, cols), grid=(cols + extra, rows + extra, 1)
+            ),
+            dtypes=("float32", "float16", "bfloat16", "int32"),
+        ),
     )
 
-    problem.show()
-
-    problem.check()
+    run(problem)
 
 ############################################################
 ### Puzzle 5: Broadcast
@@ -233,12 +281,18 @@ if puzzle_number == 0 or puzzle_number == 5:
         [a, b], 
         output_shape,
         grid=(3,3,1), 
-        spec=zip_spec
+        spec=zip_spec,
+        chunk_axes=(0, None),
+        constraints=Constraints(
+            sizes={"rows": (1, 8), "cols": (1, 8), "extra": (0, 3)},
+            launch=lambda rows, cols, extra: dict(
+                inputs=[(rows, 1), (1, cols)], output_shapes=(rows, cols), grid=(cols + extra, rows + extra, 1)
+            ),
+            dtypes=("float32", "float16", "bfloat16", "int32"),
+        ),
     )
 
-    problem.show()
-
-    problem.check()
+    run(problem)
 
 ############################################################
 ### Puzzle 6: Threadgroups
@@ -281,12 +335,18 @@ if puzzle_number == 0 or puzzle_number == 6:
         output_shape,
         grid=(12,1,1), 
         threadgroup=(4,1,1),
-        spec=map_spec
+        spec=map_spec,
+        chunk_axes=(0,),
+        constraints=Constraints(
+            sizes={"n": (1, 64), "threads": (1, 8)},
+            launch=lambda n, threads: dict(
+                inputs=[(n,)], output_shapes=(n,), grid=(-(-n // threads) * threads, 1, 1), threadgroup=(threads, 1, 1)
+            ),
+            dtypes=("float32", "float16", "bfloat16", "int32"),
+        ),
     )
 
-    problem.show()
-
-    problem.check()
+    run(problem)
 
 ############################################################
 ### Puzzle 7: Threadgroups 2D
@@ -324,12 +384,21 @@ if puzzle_number == 0 or puzzle_number == 7:
         output_shape,
         grid=(6,6,1), 
         threadgroup=(3,3,1),
-        spec=map_spec
+        spec=map_spec,
+        chunk_axes=(0,),
+        constraints=Constraints(
+            sizes={"rows": (1, 16), "cols": (1, 16), "threads": (1, 4)},
+            launch=lambda rows, cols, threads: dict(
+                inputs=[(rows, cols)],
+                output_shapes=(rows, cols),
+                grid=(-(-cols // threads) * threads, -(-rows // threads) * threads, 1),
+                threadgroup=(threads, threads, 1),
+            ),
+            dtypes=("float32", "float16", "bfloat16", "int32"),
+        ),
     )
 
-    problem.show()
-
-    problem.check()
+    run(problem)
 
 ############################################################
 ### Puzzle 8: Threadgroup Memory
@@ -392,12 +461,16 @@ if puzzle_number == 0 or puzzle_number == 8:
         output_shape,
         grid=(SIZE,1,1), 
         threadgroup=(4,1,1),
-        spec=map_spec
+        spec=map_spec,
+        chunk_axes=(0,),
+        constraints=Constraints(
+            sizes={"n": (1, 32)},
+            launch=lambda n: dict(inputs=[(n,)], output_shapes=(n,), grid=(-(-n // 4) * 4, 1, 1)),
+            dtypes=("float32", "float16", "bfloat16", "int32"),
+        ),
     )
 
-    problem.show()
-
-    problem.check()
+    run(problem)
 
 ############################################################
 ### Puzzle 9: Pooling
@@ -464,12 +537,15 @@ if puzzle_number == 0 or puzzle_number == 9:
         output_shape,
         grid=(SIZE,1,1), 
         threadgroup=(SIZE,1,1),
-        spec=pooling_spec
+        spec=pooling_spec,
+        constraints=Constraints(
+            sizes={"n": (1, 8)},
+            launch=lambda n: dict(inputs=[(n,)], output_shapes=(n,), grid=(n, 1, 1), threadgroup=(n, 1, 1)),
+            dtypes=("float32", "float16", "int32"),
+        ),
     )
 
-    problem.show()
-
-    problem.check()
+    run(problem)
 
 ############################################################
 ### Puzzle 10: Dot Product
@@ -485,6 +561,11 @@ if puzzle_number == 0 or puzzle_number == 9:
 def dot_spec(a: mx.array, b: mx.array):
     return a @ b
 
+def dot_launch(n, extra):
+    # One threadgroup of a power of two threads, at least `n` of them.
+    threads = min(8, 1 << ((n - 1).bit_length() + extra))
+    return dict(inputs=[(n,), (n,)], grid=(threads, 1, 1), threadgroup=(threads, 1, 1))
+
 def dot_test(a: mx.array, b: mx.array):
     header = """
         constant uint THREADGROUP_MEM_SIZE = 8;
@@ -516,6 +597,7 @@ def dot_test(a: mx.array, b: mx.array):
         output_names=["out"],
         header=header,
         source=source,
+        params=["THREADGROUP_MEM_SIZE"],
     )
 
     return kernel
@@ -532,12 +614,15 @@ if puzzle_number == 0 or puzzle_number == 10:
         output_shape,
         grid=(SIZE,1,1), 
         threadgroup=(SIZE,1,1),
-        spec=dot_spec
+        spec=dot_spec,
+        constraints=Constraints(
+            sizes={"n": (1, 8), "extra": (0, 3)},
+            launch=dot_launch,
+            dtypes=("float32", "float16"),
+        ),
     )
 
-    problem.show()
-
-    problem.check()
+    run(problem)
 
 ############################################################
 ### Puzzle 11: 1D Convolution
@@ -613,12 +698,15 @@ if puzzle_number == 0 or puzzle_number == 11:
         output_shape,
         grid=(8,1,1), 
         threadgroup=(8,1,1),
-        spec=conv_spec
+        spec=conv_spec,
+        constraints=Constraints(
+            sizes={"n": (1, 8), "k": (1, 4), "blocks": (1, 2)},
+            launch=lambda n, k, blocks: dict(inputs=[(n,), (k,)], output_shapes=(n,), grid=(8 * blocks, 1, 1)),
+            dtypes=("float32", "float16", "int32"),
+        ),
     )
 
-    problem.show()
-
-    problem.check()
+    run(problem)
 
     # Test 2
     a = mx.arange(15, dtype=mx.float32)
@@ -632,12 +720,15 @@ if puzzle_number == 0 or puzzle_number == 11:
         output_shape,
         grid=(16,1,1), 
         threadgroup=(8,1,1),
-        spec=conv_spec
+        spec=conv_spec,
+        constraints=Constraints(
+            sizes={"n": (1, 32), "k": (1, 4)},
+            launch=lambda n, k: dict(inputs=[(n,), (k,)], output_shapes=(n,), grid=(-(-n // 8) * 8, 1, 1)),
+            dtypes=("float32", "float16", "int32"),
+        ),
     )
 
-    problem.show()
-
-    problem.check()
+    run(problem)
 
 ############################################################
 ### Puzzle 12: Prefix Sum
@@ -672,17 +763,15 @@ def prefix_sum_test(a: mx.array):
             cache[local_i] = 0;
         }
         threadgroup_barrier(mem_flags::mem_threadgroup);
-        if (i < a_shape[0]){
-            for (int k = 0; k < 3; k++) {
-                int p = 1 << k;
-                if (local_i % (p * 2) == 0 && local_i + p < a_shape[0]) {
-                    cache[local_i] += cache[local_i + p];
-                }
-                threadgroup_barrier(mem_flags::mem_threadgroup);
+        for (int k = 0; k < 3; k++) {
+            int p = 1 << k;
+            if (i < a_shape[0] && local_i % (p * 2) == 0 && local_i + p < a_shape[0]) {
+                cache[local_i] += cache[local_i + p];
             }
-            if (local_i == 0){
-                out[threadgroup_position_in_grid.x] = cache[local_i];
-            } 
+            threadgroup_barrier(mem_flags::mem_threadgroup);
+        }
+        if (i < a_shape[0] && local_i == 0){
+            out[threadgroup_position_in_grid.x] = cache[local_i];
         }
     """
 
@@ -708,12 +797,15 @@ if puzzle_number == 0 or puzzle_number == 12:
         output_shape,
         grid=(8,1,1), 
         threadgroup=(8,1,1),
-        spec=prefix_sum_spec
+        spec=prefix_sum_spec,
+        constraints=Constraints(
+            sizes={"n": (1, 8), "blocks": (1, 2)},
+            launch=lambda n, blocks: dict(inputs=[(n,)], grid=(8 * blocks, 1, 1)),
+            dtypes=("float32", "float16", "int32"),
+        ),
     )
 
-    problem.show()
-
-    problem.check()
+    run(problem)
 
     # Test 2
     SIZE = 15
@@ -727,12 +819,15 @@ if puzzle_number == 0 or puzzle_number == 12:
         output_shape,
         grid=(16,1,1), 
         threadgroup=(8,1,1),
-        spec=prefix_sum_spec
+        spec=prefix_sum_spec,
+        constraints=Constraints(
+            sizes={"n": (1, 64)},
+            launch=lambda n: dict(inputs=[(n,)], output_shapes=(-(-n // 8),), grid=(-(-n // 8) * 8, 1, 1)),
+            dtypes=("float32", "float16", "int32"),
+        ),
     )
 
-    problem.show()
-
-    problem.check()
+    run(problem)
 
 ############################################################
 ### Puzzle 13: Axis Sum
@@ -763,18 +858,16 @@ def axis_sum_test(a: mx.array):
         } else {
             cache[local_i] = 0;
         }
-        if (i < a_shape[1]){
-            threadgroup_barrier(mem_flags::mem_threadgroup);
-            for (int k = 0; k < 3; k++) {
-                int p = 1 << k;
-                if (local_i % (p * 2) == 0 && local_i + p < a_shape[1]){
-                    cache[local_i] += cache[local_i + p];
-                }
-                threadgroup_barrier(mem_flags::mem_threadgroup);
+        threadgroup_barrier(mem_flags::mem_threadgroup);
+        for (int k = 0; k < 3; k++) {
+            int p = 1 << k;
+            if (i < a_shape[1] && local_i % (p * 2) == 0 && local_i + p < a_shape[1]){
+                cache[local_i] += cache[local_i + p];
             }
-            if (local_i == 0){
-                out[batch] = cache[local_i];
-            } 
+            threadgroup_barrier(mem_flags::mem_threadgroup);
+        }
+        if (i < a_shape[1] && local_i == 0){
+            out[batch] = cache[local_i];
         }
     """
 
@@ -800,12 +893,16 @@ if puzzle_number == 0 or puzzle_number == 13:
         output_shape,
         grid=(8,BATCH,1), 
         threadgroup=(8,1,1),
-        spec=axis_sum_spec
+        spec=axis_sum_spec,
+        chunk_axes=(0,),
+        constraints=Constraints(
+            sizes={"batch": (1, 8), "n": (1, 8)},
+            launch=lambda batch, n: dict(inputs=[(batch, n)], output_shapes=(batch, 1), grid=(8, batch, 1)),
+            dtypes=("float32", "float16", "int32"),
+        ),
     )
 
-    problem.show()
-
-    problem.check()
+    run(problem)
 
 ############################################################
 ### Puzzle 14: Matrix Multiply!
@@ -854,6 +951,7 @@ def matmul_test(a: mx.array, b: mx.array):
                     acc += a_shared[local_i][local_k] * b_shared[local_k][local_j];
                 }
             }
+            threadgroup_barrier(mem_flags::mem_threadgroup);
         }
         if (i < a_shape[0] && j < b_shape[1]) {
             out[i * b_shape[1] + j] = acc;   
@@ -866,6 +964,7 @@ def matmul_test(a: mx.array, b: mx.array):
         output_names=["out"],
         header=header,
         source=source,
+        params=["THREADGROUP_MEM_SIZE"],
     )
 
     return kernel
@@ -884,12 +983,16 @@ if puzzle_number == 0 or puzzle_number == 14:
         output_shape,
         grid=(3,3,1), 
         threadgroup=(3,3,1),
-        spec=matmul_spec
+        spec=matmul_spec,
+        chunk_axes=(0, None),
+        constraints=Constraints(
+            sizes={"n": (1, 3)},
+            launch=lambda n: dict(inputs=[(n, n), (n, n)], output_shapes=(n, n)),
+            dtypes=("float32", "float16"),
+        ),
     )
 
-    problem.show()
-
-    problem.check()
+    run(problem)
 
     # Test 2
     SIZE = 8
@@ -904,9 +1007,15 @@ if puzzle_number == 0 or puzzle_number == 14:
         output_shape,
         grid=(9,9,1), 
         threadgroup=(3,3,1),
-        spec=matmul_spec
+        spec=matmul_spec,
+        chunk_axes=(0, None),
+        constraints=Constraints(
+            sizes={"n": (1, 16)},
+            launch=lambda n: dict(
+                inputs=[(n, n), (n, n)], output_shapes=(n, n), grid=(-(-n // 3) * 3, -(-n // 3) * 3, 1)
+            ),
+            dtypes=("float32", "float16"),
+        ),
     )
 
-    problem.show()
-
-    problem.check()
+    run(problem)
@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+
+import utils
+from metal_puzzles import problems
+from utils import MetalKernel, MetalProblem, Undecidable
+
+
+@pytest.mark.parametrize("name", list(problems))
+def test_static_score_matches_simulation(name):
+    problem = problems[name]
+    analysis = problem.analyze(fallback=False)
+    simulated = problem.measure(problem.run_python())
+    # Lane usage comes from branches actually taken; only the simulator has it.
+    simulated.lanes = None
+    assert analysis.score.to_dict() == simulated.to_dict()
+    assert analysis.out_of_bounds == []
+
+
+def problem(source, size=8, grid=8, threadgroup=8):
+    kernel = MetalKernel(name="k", input_names=["a"], output_names=["out"], source=source)
+    return MetalProblem(
+        "K", lambda a: kernel, [np.zeros(size, np.float32)], (size,),
+        grid=(grid, 1, 1), threadgroup=(threadgroup, 1, 1),
+    )
+
+
+def test_undecidable_kernels_fall_back_to_simulation():
+    p = problem("""
+        uint i = thread_position_in_grid.x;
+        out[i] = simd_sum(a[i]);
+    """)
+    with pytest.raises(Undecidable):
+        p.analyze(fallback=False)
+    analysis = p.analyze()
+    assert analysis.simulated and "SIMD" in analysis.reason
+    assert analysis.score.to_dict() == p.measure(p.run_python()).to_dict()
+
+
+def test_fallback_samples_large_grids(monkeypatch):
+    monkeypatch.setattr(utils, "MAX_STEPS", 1)
+    p = problem("""
+        uint i = thread_position_in_grid.x;
+        out[i] = a[i];
+    """, size=4096, grid=4096, threadgroup=8)
+    analysis = p.analyze()
+    assert analysis.simulated and analysis.reason == "too many steps"
+    assert analysis.score.sample["simulated"] < analysis.score.sample["threadgroups"] == 512
+    assert analysis.score.total["in_reads"] == 4096
+
+
+def test_out_of_bounds_accesses_are_reported():
+    # No guard: the last threads read and write past the end of both buffers.
+    p = problem("""
+        uint i = thread_position_in_grid.x;
+        out[i] = a[i + 2];
+    """, size=6, grid=8, threadgroup=4)
+    messages = p.analyze(fallback=False).out_of_bounds
+    assert len(messages) == 2
+    assert any(m.startswith("a[") and "2..9" in m for m in messages)
+    assert any(m.startswith("out[") and "0..7" in m for m in messages)
@@ -0,0 +1,27 @@
+import dataclasses
+
+import mlx.core as mx
+import pytest
+
+from metal_puzzles import problems
+from utils import check_async
+
+
+def broken_spec(a):
+    raise ValueError("no spec")
+
+
+@pytest.mark.skipif(mx.metal.is_available(), reason="Checks the path without Metal")
+def test_specs_run_on_cpu_streams_without_metal():
+    good = list(problems.values())
+    bad_spec = dataclasses.replace(problems["Map"], name="Broken", spec=broken_spec)
+    bad_shape = dataclasses.replace(problems["Map"], name="Reshaped", output_shapes=(5,))
+    streams = [mx.new_stream(mx.cpu) for _ in range(2)]
+
+    checked = check_async(good + [bad_spec, bad_shape], streams)
+    results = {problem.name: (passed, failed) for problem, passed, failed in checked}
+    assert len(results) == len(good) + 2
+    for problem in good:
+        assert results[problem.name] == (None, "Metal is not available")
+    assert results["Broken"] == (False, "ValueError: no spec")
+    assert results["Reshaped"][0] is False
@@ -0,0 +1,61 @@
+import dataclasses
+
+import numpy as np
+import pytest
+
+from metal_puzzles import problems
+from utils import CacheConfig, MetalKernel, MetalProblem, global_requests, model_cache
+
+NAIVE = """
+    uint i = thread_position_in_grid.x;
+    uint j = thread_position_in_grid.y;
+    if (i < a_shape[0] && j < b_shape[1]) {
+        float acc = 0;
+        for (uint k = 0; k < a_shape[1]; k++) {
+            acc += a[i * a_shape[1] + k] * b[k * b_shape[1] + j];
+        }
+        out[i * b_shape[1] + j] = acc;
+    }
+"""
+
+
+def naive_test(a, b):
+    return MetalKernel(name="naive", input_names=["a", "b"], output_names=["out"], source=NAIVE)
+
+
+def test_tiling_moves_reuse_out_of_the_cache():
+    n = 16
+    tiled = dataclasses.replace(
+        problems["Matmul (Full)"], inputs=[np.zeros((n, n), np.float32)] * 2, output_shapes=(n, n), grid=(18, 18, 1)
+    )
+    naive = dataclasses.replace(tiled, fn=naive_test)
+    config = CacheConfig(capacity=16 * 1024)
+    reports = [model_cache(p.run_python(), config) for p in [naive, tiled]]
+
+    for report in reports:
+        # Both kernels fit in the cache, so only the first touch of each
+        # line misses.
+        requests = sum(c["requests"] for c in report.tables.values())
+        assert report.footprint_bytes == 3 * n * n * 4
+        assert report.hit_rate == pytest.approx(1 - report.footprint_bytes // config.line / requests)
+    naive_report, tiled_report = reports
+    # Threadgroup memory serves the reuse that naive leaves to the cache.
+    assert tiled_report.tables["a"]["requests"] < naive_report.tables["a"]["requests"]
+    assert tiled_report.hit_rate < naive_report.hit_rate
+
+
+def test_requests_follow_program_order():
+    source = """
+        uint i = thread_position_in_grid.x;
+        out[i] = b[i] + a[i];
+    """
+    kernel = MetalKernel(name="k", input_names=["a", "b"], output_names=["out"], source=source)
+    problem = MetalProblem(
+        "K", lambda a, b: kernel, [np.zeros(64, np.float32)] * 2, (64,), grid=(64, 1, 1), threadgroup=(64, 1, 1)
+    )
+    requests, _ = global_requests(problem.run_python(), 128)
+    (block,) = requests.values()
+    # Round, SIMD group, then each lane's first, second and third access.
+    assert [(key[:3], name) for key, name, _ in block] == [
+        ((0, g, k), name) for g in range(2) for k, name in enumerate(["b", "a", "out"])
+    ]
@@ -0,0 +1,26 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from metal_daemon import handle, with_kernel_source
+from metal_puzzles import problems
+
+
+def test_requests_work_on_copies():
+    problem = problems["Map"]
+    before = vars(problem).get("metalKernel")
+    copy = with_kernel_source(problem)
+    copy.metalKernel = copy.fn(*copy.inputs)
+    assert copy is not problem
+    assert vars(problem).get("metalKernel") is before
+
+
+def test_concurrent_requests_keep_their_kernels():
+    # Two sources for the same problem, scored at once: each request must
+    # see its own kernel.
+    plain = "uint i = thread_position_in_grid.x;\nout[i] = a[i] + 10;"
+    twice = "uint i = thread_position_in_grid.x;\nout[i] = a[i] + a[i];"
+    requests = [{"command": "score", "problem": "Map", "source": s} for s in [plain, twice] * 8]
+    with ThreadPoolExecutor(8) as pool:
+        scores = list(pool.map(handle, requests))
+    for request, result in zip(requests, scores):
+        reads = 1 if request["source"] == plain else 2
+        assert result["score"]["max"]["in_reads"] == reads
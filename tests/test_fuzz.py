@@ -0,0 +1,61 @@
+import random
+
+import pytest
+
+import metal_fuzz
+from metal_fuzz import candidates, generate, instantiate, load_corpus, materialize, run_case, save_corpus, shrink
+from metal_puzzles import problems
+
+
+def fails_when_long_and_nonzero(case):
+    # A stand-in for a kernel bug: any input of three or more elements
+    # with a non-zero value fails.
+    x = case["inputs"][0] if case.get("inputs") is not None else [1]
+    if case["sizes"]["n"] >= 3 and any(v != 0 for v in x):
+        return "synthetic failure"
+    return None
+
+
+def test_shrink_finds_a_minimal_case(monkeypatch):
+    monkeypatch.setattr(metal_fuzz, "run_case", fails_when_long_and_nonzero)
+    case = {"problem": "Map", "sizes": {"n": 40}, "dtype": "float32", "seed": 7}
+    small = shrink(case, "synthetic failure")
+
+    assert small["message"] == "synthetic failure"
+    assert fails_when_long_and_nonzero(small) is not None
+    assert small["sizes"] == {"n": 3}
+    assert sorted(small["inputs"][0]) == [0, 0, 1]
+    # No simpler variant still fails.
+    assert all(fails_when_long_and_nonzero(materialize(c)) is None for c in candidates(small))
+
+
+def test_corpus_round_trip(monkeypatch, tmp_path):
+    monkeypatch.setattr(metal_fuzz, "run_case", fails_when_long_and_nonzero)
+    small = shrink({"problem": "Zip", "sizes": {"n": 9}, "dtype": "float16", "seed": 1}, "synthetic failure")
+    path = str(tmp_path / "corpus.json")
+    save_corpus(path, [small])
+
+    (loaded,) = load_corpus(path)
+    assert loaded == small
+    problem = problems["Zip"]
+    for x, y in zip(instantiate(problem, loaded).inputs, instantiate(problem, small).inputs):
+        assert x.dtype == y.dtype and x.tolist() == y.tolist()
+    assert load_corpus(str(tmp_path / "missing.json")) == []
+
+
+def test_constraints_cover_dtypes_and_launches():
+    rng = random.Random(0)
+    for name in ["Map", "Dot Product", "1D Conv (Simple)", "Prefix Sum (Simple)"]:
+        problem = problems[name]
+        cases = [generate(problem, rng) for _ in range(50)]
+        assert len({case["dtype"] for case in cases}) > 1
+        launches = {(p.grid, p.threadgroup) for p in (instantiate(problem, case) for case in cases)}
+        assert len(launches) > 1
+
+
+@pytest.mark.parametrize("name", [name for name, p in problems.items() if p.constraints is not None])
+def test_generated_cases_stay_in_bounds(name):
+    rng = random.Random(1)
+    for _ in range(5):
+        case = generate(problems[name], rng)
+        assert run_case(case) is None, case
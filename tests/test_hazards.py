@@ -0,0 +1,57 @@
+import numpy as np
+
+from utils import MetalKernel, MetalProblem, find_hazards
+
+
+def hazards(source, atomic_outputs=False):
+    kernel = MetalKernel(
+        name="hazard", input_names=["a"], output_names=["out"], source=source, atomic_outputs=atomic_outputs
+    )
+    problem = MetalProblem(
+        "Hazard", lambda a: kernel, [np.zeros(8, np.float32)], (8,), grid=(8, 1, 1), threadgroup=(8, 1, 1)
+    )
+    return [h.kind for h in find_hazards(problem.run_python())]
+
+
+SUM = """
+    uint i = thread_position_in_grid.x;
+    threadgroup atomic_float total[1];
+    if (i == 0) {
+        atomic_store_explicit(&total[0], 0.0f, memory_order_relaxed);
+    }
+    threadgroup_barrier(mem_flags::mem_threadgroup);
+    atomic_fetch_add_explicit(&total[0], a[i], memory_order_relaxed);
+"""
+
+
+def test_atomics_do_not_race_with_each_other():
+    assert hazards(SUM) == []
+
+
+def test_plain_access_races_with_atomics():
+    assert hazards(SUM + "out[i] = total[0];") == ["atomic-plain"]
+    assert hazards(SUM + """
+        if (i == 3) {
+            total[0] = a[i];
+        }
+    """) == ["atomic-plain"]
+
+
+def test_plain_device_write_races_with_atomics():
+    source = """
+        uint i = thread_position_in_grid.x;
+        if (i == 0) {
+            out[0] = a[i];
+        }
+        atomic_fetch_add_explicit(&out[0], a[i], memory_order_relaxed);
+    """
+    assert hazards(source, atomic_outputs=True) == ["atomic-plain"]
+
+
+def test_plain_races_still_reported():
+    source = """
+        uint i = thread_position_in_grid.x;
+        threadgroup float cache[1];
+        cache[0] = a[i];
+    """
+    assert hazards(source) == ["write-write"]
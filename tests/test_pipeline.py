@@ -0,0 +1,36 @@
+import mlx.core as mx
+import numpy as np
+
+from utils import MetalKernel, MetalPipeline, MetalStage, compare_outputs
+
+
+def add_test(name, src, dst):
+    source = f"""
+        uint i = thread_position_in_grid.x;
+        {dst}[i] = {src}[i] + {src}[i];
+    """
+    return lambda x: MetalKernel(name=name, input_names=[src], output_names=[dst], source=source)
+
+
+def test_total_row_sums_every_thread():
+    pipeline = MetalPipeline(
+        "Twice",
+        [
+            MetalStage("First", add_test("first", "a", "b"), ["a"], (8,), grid=(8, 1, 1)),
+            MetalStage("Second", add_test("second", "b", "c"), ["b"], (8,), grid=(8, 1, 1)),
+        ],
+        inputs={"a": np.zeros(8, np.float32)},
+        outputs=["c"],
+    )
+    rows = dict(pipeline.score(pipeline.run_python()))
+    assert rows["First"]["in_reads"] == 2
+    assert rows["Grid Total"]["in_reads"] == 2 * 8 * 2
+    assert rows["Grid Total"]["out_writes"] == 2 * 8
+
+
+def test_compare_outputs_reports_each_differing_output():
+    x = mx.arange(6, dtype=mx.float32).reshape(2, 3)
+    y = mx.array([0, 1, 2, 3, 5, 5], dtype=mx.float32)
+    failed = compare_outputs(["same", "differs"], (x, x), [(0, [x.reshape(-1), y])])
+    assert [m.name for m in failed] == ["differs"]
+    assert failed[0].count == 1 and failed[0].first[0][0] == (1, 1)
@@ -0,0 +1,64 @@
+import numpy as np
+
+from utils import MetalKernel, MetalProblem, find_hazards
+
+
+def simulate(source, threads=32):
+    kernel = MetalKernel(name="simd", input_names=["a"], output_names=["out"], source=source)
+    problem = MetalProblem(
+        "SIMD", lambda a: kernel, [np.zeros(threads, np.float32)], (threads,),
+        grid=(threads, 1, 1), threadgroup=(threads, 1, 1),
+    )
+    return problem, problem.run_python()
+
+
+def registers(results):
+    _, _, metal, _ = next(iter(next(iter(results.values())).values()))
+    return metal.threadgroupMemory.registers
+
+
+def test_divergent_exchanges_use_their_own_registers():
+    # Only half the lanes shuffle inside the branch; the shuffle after it
+    # is one exchange for all lanes all the same.
+    _, results = simulate("""
+        uint i = thread_position_in_grid.x;
+        float v = a[i];
+        if (i < 16) {
+            v = simd_shuffle_xor(v, 1);
+        }
+        out[i] = simd_shuffle_down(v, 1);
+    """)
+    regs = registers(results)
+    assert sorted(len(r.incoming) for r in regs) == [16, 32]
+    for reg in regs:
+        written = {index for index, _, _, _ in reg.incoming}
+        assert {index for index, _, _ in reg.reads} <= written
+
+
+def test_exchanges_in_a_loop_are_one_per_iteration():
+    _, results = simulate("""
+        uint i = thread_position_in_grid.x;
+        float v = a[i];
+        for (uint offset = 16; offset > 0; offset /= 2) {
+            v += simd_shuffle_down(v, offset);
+        }
+        out[i] = v;
+    """)
+    assert [len(r.incoming) for r in registers(results)] == [32] * 5
+
+
+def test_out_of_range_lanes():
+    # Shifting past the end of the group keeps the lane's own value, as
+    # Metal specifies; shuffling from a lane that doesn't exist does not.
+    _, results = simulate("""
+        uint i = thread_position_in_grid.x;
+        out[i] = simd_shuffle_down(a[i], 4);
+    """)
+    assert find_hazards(results) == []
+
+    _, results = simulate("""
+        uint i = thread_position_in_grid.x;
+        out[i] = simd_shuffle(a[i], i + 8);
+    """, threads=16)
+    hazards = find_hazards(results)
+    assert [h.kind for h in hazards] == ["simd-lane"] * 8
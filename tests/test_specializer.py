@@ -0,0 +1,74 @@
+import ast
+
+import numpy as np
+import pytest
+
+import utils
+from metal_puzzles import problems
+from utils import (
+    MAX_UNROLL, BranchMarker, Coord, MetalKernel, MetalProblem, Specializer, convert_source_to_py, kernel_function,
+)
+
+
+def unspecialized(header, source, names, threadsperblock, params):
+    """`compile_specialized` without the `Specializer` pass."""
+    line_map = []
+    tree = ast.parse(convert_source_to_py(header + source, line_map), "<metal>")
+    tree = BranchMarker(header, source, line_map).visit(tree)
+    return kernel_function(tree.body, dict(names), params)
+
+
+def scores(problem, monkeypatch):
+    specialized = problem.measure(problem.run_python()).to_dict()
+    with monkeypatch.context() as m:
+        m.setattr(utils, "compile_specialized", unspecialized)
+        plain = problem.measure(problem.run_python()).to_dict()
+    return specialized, plain
+
+
+@pytest.mark.parametrize("name", list(problems))
+def test_specialization_keeps_the_score(name, monkeypatch):
+    specialized, plain = scores(problems[name], monkeypatch)
+    lanes, plain_lanes = specialized.pop("lanes"), plain.pop("lanes")
+    assert specialized == plain
+    # Folding only removes branches every lane takes the same way.
+    branches = lanes["branches"] if lanes else []
+    for branch in plain_lanes["branches"] if plain_lanes else []:
+        if branch not in branches:
+            assert branch["active"] in (0, branch["launched"])
+    assert all(branch in plain_lanes["branches"] for branch in branches)
+
+
+def loops(source, env=None):
+    tree = ast.parse(convert_source_to_py(source))
+    body = Specializer(dict(env or {}), Coord(8, 1)).block(tree.body)
+    return sum(isinstance(node, ast.While) for stmt in body for node in ast.walk(stmt))
+
+
+def test_unroll_limit():
+    loop = """
+        for (uint k = 0; k < N; k++) {
+            out[k] = a[k];
+        }
+    """
+    assert loops(loop, {"N": MAX_UNROLL}) == 0
+    assert loops(loop, {"N": MAX_UNROLL + 1}) == 1
+
+
+def test_loop_carried_bound():
+    # The bound grows inside the loop, so it can't be unrolled, and the
+    # loop still runs 6 times: the bound moves from 3 up to 6.
+    source = """
+        uint i = thread_position_in_grid.x;
+        uint n = 3;
+        for (uint k = 0; k < n; k++) {
+            if (n < 6) {
+                n += 1;
+            }
+            out[i] = a[k];
+        }
+    """
+    assert loops(source) == 1
+    kernel = MetalKernel(name="grow", input_names=["a"], output_names=["out"], source=source)
+    problem = MetalProblem("Grow", lambda a: kernel, [np.zeros(8, np.float32)], (8,), grid=(8, 1, 1))
+    assert problem.measure(problem.run_python()).max["in_reads"] == 6
@@ -0,0 +1,41 @@
+import numpy as np
+
+from utils import MetalKernel, MetalProblem, convert_source_to_py
+
+
+def run(source):
+    scope = {}
+    exec(convert_source_to_py(source), scope)
+    return scope
+
+
+def test_type_names_stripped_only_from_declarations():
+    scope = run("""
+        const uint n = 8;
+        uint half = n / 2;
+        int long = half + 1;
+        float x = float(long) + (float)half + (long);
+    """)
+    assert (scope["half"], scope["long"], scope["x"]) == (4, 5, 14)
+
+
+def test_float_literal_suffixes():
+    scope = run("float x = 0.5f + .25h + 1e-3f + 2.E+2F;")
+    assert scope["x"] == 0.5 + 0.25 + 1e-3 + 200.0
+
+
+def test_kernel_with_type_named_variable():
+    source = """
+        uint half = a_shape[0] >> 1;
+        uint i = thread_position_in_grid.x;
+        if (i < half) {
+            out[i] = a[i] + a[i + half];
+        }
+    """
+    kernel = MetalKernel(name="fold", input_names=["a"], output_names=["out"], source=source)
+    problem = MetalProblem(
+        "Fold", lambda a: kernel, [np.zeros(8, np.float32)], (4,), grid=(8, 1, 1), spec=lambda a: a[:4] + a[4:]
+    )
+    score = problem.measure(problem.run_python())
+    assert score.total["in_reads"] == 8
+    assert score.total["out_writes"] == 4
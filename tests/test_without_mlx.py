@@ -0,0 +1,43 @@
+import random
+import sys
+
+import numpy as np
+import pytest
+
+import metal_puzzles as with_mlx
+
+
+@pytest.fixture
+def without_mlx(monkeypatch):
+    # Import the modules afresh with MLX missing; the originals are put
+    # back afterwards.
+    monkeypatch.setitem(sys.modules, "mlx", None)
+    monkeypatch.setitem(sys.modules, "mlx.core", None)
+    for name in ["utils", "metal_puzzles", "metal_fuzz", "metal_daemon"]:
+        monkeypatch.delitem(sys.modules, name, raising=False)
+
+
+def test_puzzles_score_the_same_with_numpy_inputs(without_mlx):
+    import metal_puzzles
+    import utils
+
+    assert utils.mx is None
+    assert metal_puzzles.problems.keys() == with_mlx.problems.keys()
+    for name, problem in metal_puzzles.problems.items():
+        assert all(isinstance(x, np.ndarray) for x in problem.inputs)
+        assert problem.score().to_dict() == with_mlx.problems[name].score().to_dict()
+
+
+def test_tools_run_without_mlx(without_mlx):
+    import metal_daemon
+    import metal_fuzz
+    import utils
+
+    assert metal_daemon.handle({"command": "score", "problem": "Map"})["score"]["max"]["in_reads"] == 1
+    rng = random.Random(0)
+    for name in ["Map", "Dot Product", "Matmul (Full)"]:
+        for _ in range(5):
+            assert metal_fuzz.run_case(metal_fuzz.generate(metal_fuzz.problems[name], rng)) is None
+    (result,) = utils.check_async([metal_fuzz.problems["Map"]])
+    assert result[1:] == (None, "Metal is not available")
+    assert utils.tolerance(np.float16) == {"rtol": 1e-3, "atol": 1e-3}
@@ -1,15 +1,40 @@
+import ast
+import builtins
+import contextlib
+import copy
+import dataclasses
+import gc
+import html
+import itertools
+import json
+import math
+import operator
 import os
+import queue
+import random
 import re
+import sys
+import time
 
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
+from functools import lru_cache
 from typing import List, Tuple, Any
-from collections import Counter
+from collections import Counter, OrderedDict
 
 from chalk import *
 from colour import Color
 import chalk
 
-import mlx.core as mx
+try:
+    import mlx.core as mx
+except ImportError:  # Simulating, scoring and drawing only need shapes.
+    mx = None
+
+try:
+    import numpy as np
+except ImportError:  # Only needed for memory-mapped inputs.
+    np = None
 
 @dataclass
 class MetalKernel:
@@ -18,70 +43,883 @@ class MetalKernel:
     output_names: List[str]
     header: str = ""
     source: str = ""
+    atomic_outputs: bool = False
+    # Header constants that `instantiate` can give other values.
+    params: Tuple[str] = ()
 
     def __call__(self):
-        return mx.fast.metal_kernel(
-            name=self.name,
-            input_names=self.input_names,
-            output_names=self.output_names,
+        return build_metal_kernel(
+            self.name,
+            tuple(self.input_names),
+            tuple(self.output_names),
+            self.header,
+            self.source,
+            self.atomic_outputs,
+        )
+
+    def batched(self, input_shapes, output_shapes):
+        """Kernel that handles a stack of problems along a new leading axis.
+
+        Entry `z` of the batch is run by the threadgroups with
+        `threadgroup_position_in_grid.z == z`. They see `a`, `a_shape`, ...
+        and `out` exactly as the unbatched kernel would.
+        """
+        prelude = []
+        for name, shape in zip(self.input_names + self.output_names, input_shapes + output_shapes):
+            size = 1
+            for d in shape:
+                size *= d
+            prelude.append(f"auto {name} = {name}_batched + threadgroup_position_in_grid.z * {size};")
+            for suffix, value in [("_shape", shape), ("_strides", row_major_strides(shape))]:
+                if name + suffix in self.source:
+                    prelude.append(f"const int {name}{suffix}[] = {{{', '.join(map(str, value))}}};")
+            if name + "_ndim" in self.source:
+                prelude.append(f"const int {name}_ndim = {len(shape)};")
+
+        return MetalKernel(
+            name=self.name + "_batched",
+            input_names=[name + "_batched" for name in self.input_names],
+            output_names=[name + "_batched" for name in self.output_names],
             header=self.header,
-            source=self.source,
+            source="\n".join(prelude) + "\n" + self.source,
+            atomic_outputs=self.atomic_outputs,
+            params=self.params,
+        )
+
+    def instantiate(self, **values):
+        """This kernel with the template parameters in `values` set.
+
+        Each parameter is a `constant` declared in `header`, and keeps its
+        value there unless given here. Instances are cached per value set,
+        and so are the Metal kernels and simulator code built from them.
+        """
+        unknown = set(values) - set(self.params)
+        if unknown:
+            raise ValueError(f"{self.name} has no template parameters {sorted(unknown)}, only {list(self.params)}")
+        if not values:
+            return self
+        return instantiate_kernel(
+            self.name,
+            tuple(self.input_names),
+            tuple(self.output_names),
+            self.header,
+            self.source,
+            self.atomic_outputs,
+            tuple(self.params),
+            tuple(sorted(values.items())),
+        )
+
+def row_major_strides(shape):
+    """Element strides of a contiguous array of `shape`."""
+    strides = [1] * len(shape)
+    for d in range(len(shape) - 2, -1, -1):
+        strides[d] = strides[d + 1] * shape[d + 1]
+    return tuple(strides)
+
+@lru_cache(maxsize=256)
+def instantiate_kernel(name, input_names, output_names, header, source, atomic_outputs, params, values):
+    for param, value in values:
+        if isinstance(value, bool):
+            value = "true" if value else "false"
+        header, n = re.subn(rf"(constant\s+[\w:]+\s+{param}\s*=\s*)[^;]+;", rf"\g<1>{value};", header)
+        if n != 1:
+            raise ValueError(f"{name}: expected one `constant` declaration of {param} in the header, found {n}")
+    # Metal caches libraries by kernel name, so each instance needs its own.
+    suffix = "_".join(f"{param}{value}" for param, value in values)
+    return MetalKernel(
+        name=re.sub(r"\W", "_", f"{name}_{suffix}"),
+        input_names=list(input_names),
+        output_names=list(output_names),
+        header=header,
+        source=source,
+        atomic_outputs=atomic_outputs,
+        params=params,
+    )
+
+@lru_cache(maxsize=256)
+def build_metal_kernel(name, input_names, output_names, header, source, atomic_outputs=False):
+    # Building a kernel is expensive, so identical kernels are shared
+    # between problems and across daemon requests.
+    return mx.fast.metal_kernel(
+        name=name,
+        input_names=list(input_names),
+        output_names=list(output_names),
+        header=header,
+        source=source,
+        atomic_outputs=atomic_outputs,
+    )
+
+# Specialization. Header constants, shapes and the threadgroup size are the
+# same for every thread of a launch, so fold them into the transpiled kernel
+# before compiling it: constant expressions are evaluated, branches on them
+# dropped and short fixed-trip-count loops unrolled.
+
+MAX_UNROLL = 32
+FOLDABLE_CALLS = {"int": int, "float": float, "min": min, "max": max, "abs": abs}
+
+def stored_names(nodes):
+    names = set()
+    for node in nodes:
+        for n in ast.walk(node):
+            if isinstance(n, ast.Name) and isinstance(n.ctx, ast.Store):
+                names.add(n.id)
+    return names
+
+
+class Specializer(ast.NodeTransformer):
+    """Folds the names in `env` (and launch constants) into expressions."""
+    def __init__(self, env, threadsperblock):
+        self.env = env
+        self.threadsperblock = threadsperblock
+
+    def visit_Name(self, node):
+        if isinstance(node.ctx, ast.Load) and node.id in self.env:
+            return ast.copy_location(ast.Constant(self.env[node.id]), node)
+        return node
+
+    def visit_Attribute(self, node):
+        self.generic_visit(node)
+        # metal.threads_per_threadgroup.x / .y and metal.threads_per_simdgroup
+        inner = node.value
+        if (
+            node.attr in ("x", "y") and isinstance(inner, ast.Attribute)
+            and inner.attr == "threads_per_threadgroup"
+            and isinstance(inner.value, ast.Name) and inner.value.id == "metal"
+        ):
+            return ast.copy_location(ast.Constant(getattr(self.threadsperblock, node.attr)), node)
+        if node.attr == "threads_per_simdgroup" and isinstance(inner, ast.Name) and inner.id == "metal":
+            return ast.copy_location(ast.Constant(32), node)
+        return node
+
+    def fold(self, node, fn, *args):
+        try:
+            return ast.copy_location(ast.Constant(fn(*args)), node)
+        except Exception:
+            return node
+
+    def visit_BinOp(self, node):
+        self.generic_visit(node)
+        if isinstance(node.left, ast.Constant) and isinstance(node.right, ast.Constant):
+            return self.fold(node, BIN_OPS[type(node.op)], node.left.value, node.right.value)
+        return node
+
+    def visit_UnaryOp(self, node):
+        self.generic_visit(node)
+        if isinstance(node.operand, ast.Constant):
+            ops = {ast.USub: operator.neg, ast.UAdd: operator.pos, ast.Not: operator.not_, ast.Invert: operator.invert}
+            return self.fold(node, ops[type(node.op)], node.operand.value)
+        return node
+
+    def visit_Compare(self, node):
+        self.generic_visit(node)
+        if len(node.ops) == 1 and isinstance(node.left, ast.Constant) and isinstance(node.comparators[0], ast.Constant):
+            return self.fold(node, CMP_OPS[type(node.ops[0])], node.left.value, node.comparators[0].value)
+        return node
+
+    def visit_BoolOp(self, node):
+        self.generic_visit(node)
+        values = list(node.values)
+        # Leading constants either decide the result or can be skipped.
+        while values and isinstance(values[0], ast.Constant):
+            decides = (not values[0].value) if isinstance(node.op, ast.And) else bool(values[0].value)
+            if decides or len(values) == 1:
+                return values[0]
+            values.pop(0)
+        if len(values) == 1:
+            return values[0]
+        node.values = values
+        return node
+
+    def visit_IfExp(self, node):
+        self.generic_visit(node)
+        if isinstance(node.test, ast.Constant):
+            return node.body if node.test.value else node.orelse
+        return node
+
+    def visit_Subscript(self, node):
+        self.generic_visit(node)
+        if isinstance(node.ctx, ast.Load) and isinstance(node.value, ast.Constant) and isinstance(node.slice, ast.Constant):
+            return self.fold(node, operator.getitem, node.value.value, node.slice.value)
+        return node
+
+    def visit_Call(self, node):
+        self.generic_visit(node)
+        if (
+            isinstance(node.func, ast.Name) and node.func.id in FOLDABLE_CALLS and not node.keywords
+            and node.func.id not in self.env and all(isinstance(a, ast.Constant) for a in node.args)
+        ):
+            return self.fold(node, FOLDABLE_CALLS[node.func.id], *[a.value for a in node.args])
+        return node
+
+    def expr(self, node, env=None):
+        saved, self.env = self.env, self.env if env is None else env
+        try:
+            return self.visit(node)
+        finally:
+            self.env = saved
+
+    # Statements are specialized in order, tracking which names hold a
+    # known constant at each point.
+
+    def block(self, body):
+        out = []
+        for stmt in body:
+            out += self.statement(stmt)
+        return out
+
+    def statement(self, node):
+        if isinstance(node, ast.Assign):
+            node.value = self.expr(node.value)
+            for target in node.targets:
+                if not isinstance(target, ast.Name):
+                    self.expr(target)
+            for name in stored_names(node.targets):
+                self.env.pop(name, None)
+            if len(node.targets) == 1 and isinstance(node.targets[0], ast.Name) and isinstance(node.value, ast.Constant):
+                self.env[node.targets[0].id] = node.value.value
+            return [node]
+        if isinstance(node, ast.If):
+            node.test = self.expr(node.test)
+            if isinstance(node.test, ast.Constant):
+                return self.block(node.body if node.test.value else node.orelse)
+            env = self.env
+            self.env = dict(env)
+            node.body = self.block(node.body) or [ast.Pass()]
+            body_env, self.env = self.env, dict(env)
+            node.orelse = self.block(node.orelse)
+            # Only constants both branches agree on survive the join.
+            self.env = {k: v for k, v in self.env.items() if k in body_env and body_env[k] == v and type(body_env[k]) is type(v)}
+            return [node]
+        if isinstance(node, ast.While) and not node.orelse:
+            unrolled = self.unroll(node)
+            if unrolled is not None:
+                return unrolled
+        if isinstance(node, (ast.While, ast.For)):
+            for name in stored_names([node]):
+                self.env.pop(name, None)
+            env = self.env
+            self.env = dict(env)
+            if isinstance(node, ast.While):
+                node.test = self.expr(node.test)
+                if isinstance(node.test, ast.Constant) and not node.test.value:
+                    self.env = env
+                    return self.block(node.orelse)
+            else:
+                node.iter = self.expr(node.iter)
+            node.body = self.block(node.body) or [ast.Pass()]
+            node.orelse = self.block(node.orelse)
+            self.env = env
+            return [node]
+        stored = stored_names([node])
+        node = self.expr(node)
+        for name in stored:
+            self.env.pop(name, None)
+        return [node]
+
+    def unroll(self, node):
+        """Unroll `while k <test>: ...; k = <update>` when k's values are known."""
+        if any(isinstance(n, (ast.Break, ast.Continue)) for n in ast.walk(node)):
+            return None
+        last = node.body[-1]
+        if isinstance(last, ast.AugAssign):
+            update = ast.BinOp(ast.Name(last.target.id, ast.Load()), last.op, last.value) if isinstance(last.target, ast.Name) else None
+            target = last.target
+        elif isinstance(last, ast.Assign) and len(last.targets) == 1:
+            update, target = last.value, last.targets[0]
+        else:
+            return None
+        if update is None or not isinstance(target, ast.Name) or target.id not in self.env:
+            return None
+        var = target.id
+        if var in stored_names(node.body[:-1]):
+            return None
+
+        # The test and update may only use the loop variable and constants
+        # that the body doesn't change.
+        env = {k: v for k, v in self.env.items() if k not in stored_names(node.body)}
+        values, value = [], self.env[var]
+        while True:
+            test = self.expr(copy.deepcopy(node.test), {**env, var: value})
+            if not isinstance(test, ast.Constant):
+                return None
+            if not test.value:
+                break
+            values.append(value)
+            if len(values) > MAX_UNROLL:
+                return None
+            step = self.expr(copy.deepcopy(update), {**env, var: value})
+            if not isinstance(step, ast.Constant):
+                return None
+            value = step.value
+
+        out = []
+        for v in values:
+            self.env[var] = v
+            out += self.block(copy.deepcopy(node.body[:-1]))
+        final = ast.copy_location(ast.Assign([ast.Name(var, ast.Store())], ast.Constant(value)), last)
+        self.env[var] = value
+        return out + [final]
+
+
+class BranchMarker(ast.NodeTransformer):
+    """Routes every `if` and `while` test through `metal.branch`, which
+    records which lanes take it.
+
+    Branches are labelled with their line of `source`, which follows
+    `header`; `line_map` maps the transpiled lines back to it. Copies of a
+    branch made by unrolling are the same branch, visited again.
+    """
+    def __init__(self, header, source, line_map):
+        self.lines = (header + source).splitlines()
+        self.offset = header.count("\n")
+        self.line_map = line_map
+        self.branches = {}
+
+    def mark(self, node, orelse):
+        self.generic_visit(node)
+        line = self.line_map[node.lineno - 1]
+        text = self.lines[line - 1].strip().rstrip("{").strip()
+        k = self.branches.setdefault((node.test.lineno, node.test.col_offset), len(self.branches))
+        args = [ast.Constant(k), ast.Constant(f"line {line - self.offset}: {text}"), node.test, ast.Constant(orelse)]
+        node.test = ast.copy_location(
+            ast.Call(ast.Attribute(ast.Name("metal", ast.Load()), "branch", ast.Load()), args, []), node.test
         )
+        return node
+
+    def visit_If(self, node):
+        # An `elif` is a branch of its own, not an else path.
+        orelse = bool(node.orelse) and not (len(node.orelse) == 1 and isinstance(node.orelse[0], ast.If))
+        return self.mark(node, orelse)
+
+    def visit_While(self, node):
+        return self.mark(node, False)
+
+
+@contextlib.contextmanager
+def gc_paused():
+    """Pause the cyclic garbage collector.
+
+    Simulation allocates millions of trace objects that all stay alive,
+    and the collector would rescan them over and over for nothing.
+    """
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def kernel_function(body, scope, params):
+    """Compile the transpiled kernel statements `body` into a function of
+    `metal` and the tables `params`, with `scope` as its globals.
+
+    The kernel's variables are then fast locals, and each thread is a
+    single call rather than an `exec` in a fresh namespace.
+    """
+    args = ast.arguments([], [ast.arg(name) for name in ("metal",) + params], None, [], [], None, [])
+    fn = ast.FunctionDef("kernel", args, body or [ast.Pass()], [], None, None, lineno=1, col_offset=0)
+    code = compile(ast.fix_missing_locations(ast.Module([fn], [])), "<metal>", "exec")
+    scope = dict(scope)
+    exec(code, scope)
+    return scope["kernel"]
+
+
+@lru_cache(maxsize=256)
+def compile_specialized(header, source, names, threadsperblock, params):
+    """The kernel as a function of `metal` and the tables `params`, with the
+    constants `names` (`(name, value)` pairs) and the threadgroup size
+    folded in, and its branches marked. Call it once per thread."""
+    line_map = []
+    tree = ast.parse(convert_source_to_py(header + source, line_map), "<metal>")
+    tree.body = Specializer(dict(names), threadsperblock).block(tree.body)
+    tree = BranchMarker(header, source, line_map).visit(tree)
+    return kernel_function(tree.body, dict(names), params)
+
+@dataclass
+class Score:
+    """Simulated access counts of a kernel over every thread of its grid.
+
+    `max`, `mean` and `total` map the count names (`in_reads`,
+    `out_write_bytes`, `shared_read_txns`, `atomics`, ...) to the max per
+    thread, mean per thread and grid total. `rounds` has the same three for
+    each barrier round.
+
+    A score of sampled results has `sample` set: the number of threadgroups
+    in the grid and simulated, and `bounds`, the half-width of a 95%
+    interval around each extrapolated total. `max` is then over the
+    simulated threads only.
+
+    `lanes` is the SIMD lane usage of the kernel's branches, from
+    `lane_usage`, for simulated scores.
+    """
+    name: str
+    threads: int
+    max: Counter
+    mean: Counter
+    total: Counter
+    rounds: list
+    sample: dict = None
+    lanes: dict = None
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "threads": self.threads,
+            "max": dict(self.max),
+            "mean": dict(self.mean),
+            "total": dict(self.total),
+            "rounds": [{k: dict(v) for k, v in r.items()} for r in self.rounds],
+            "sample": self.sample and {**self.sample, "bounds": dict(self.sample["bounds"])},
+            "lanes": self.lanes,
+        }
+
+    def to_json(self, **kwargs):
+        return json.dumps(self.to_dict(), **kwargs)
+
+
+class SampledResults(dict):
+    """`run_python` results for a subset of the threadgroups of a grid.
+
+    `strata` maps each stratum (`corner`, `left`, `right`, `top`, `bottom`,
+    `interior`) to `(n, blocks)`: how many threadgroups of the grid fall in
+    it and which of them were simulated. `threads` is the size of the grid.
+    """
+
+    def __init__(self, results, strata, threads):
+        super().__init__(results)
+        self.strata = strata
+        self.threads = threads
+
+    def stratum(self, block):
+        for name, (_, blocks) in self.strata.items():
+            if block in blocks:
+                return name
+
+
+def extrapolate(strata, per_block):
+    """Stratified estimate of grid totals from per-threadgroup `per_block` counts.
+
+    Returns the estimated totals and the half-width of their 95% interval.
+    A stratum simulated in full contributes no uncertainty.
+    """
+    total, variance = Counter(), Counter()
+    for n, blocks in strata.values():
+        if not blocks:
+            continue
+        keys = set().union(*(per_block[b] for b in blocks))
+        for k in keys:
+            values = [per_block[b][k] for b in blocks]
+            mean = sum(values) / len(values)
+            total[k] += n * mean
+            if 1 < len(values) < n:
+                var = sum((v - mean) ** 2 for v in values) / (len(values) - 1)
+                variance[k] += n * n * (1 - len(values) / n) * var / len(values)
+    bounds = Counter({k: 1.96 * math.sqrt(variance[k]) for k in total})
+    return total, bounds
+
+def lane_usage(results):
+    """Active and launched SIMD lanes of the branches in `results`.
+
+    A path through a branch that any lane of a SIMD group takes runs for
+    the whole group: its launched lanes are the group's threads, its
+    active lanes the ones that took it. Returns the overall efficiency,
+    the efficiency of each barrier round, and each branch path with its
+    active, launched and idle lane counts, most idle first. None if the
+    kernel has no branches.
+    """
+    # (block, simdgroup, branch, round, visit) -> [reached, taken]
+    executions = {}
+    info = {}
+    for block, threads in results.items():
+        for tt, _, metal, _ in threads.values():
+            group = metal.simdgroup_index_in_threadgroup
+            for k, label, orelse, rnd, n, taken in metal.branches:
+                info[k] = (label, orelse)
+                counts = executions.setdefault((block, group, k, rnd, n), [0, 0])
+                counts[0] += 1
+                counts[1] += taken
+    if not executions:
+        return None
+
+    tpb = len(next(iter(results.values())))
+    paths, rounds = {}, {}
+    for (_, group, k, rnd, _), (reached, taken) in executions.items():
+        launched = min(32, tpb - 32 * group)
+        label, orelse = info[k]
+        for path, active in [(label, taken), ("else of " + label, reached - taken)]:
+            if active == 0 or (path != label and not orelse):
+                continue
+            for key, table in [(path, paths), (rnd, rounds)]:
+                usage = table.setdefault(key, [0, 0])
+                usage[0] += active
+                usage[1] += launched
+
+    active = sum(a for a, _ in paths.values())
+    launched = sum(l for _, l in paths.values())
+    branches = [
+        {"branch": path, "active": a, "launched": l, "idle": l - a, "efficiency": a / l}
+        for path, (a, l) in paths.items()
+    ]
+    return {
+        "efficiency": active / launched,
+        "rounds": [rounds[r][0] / rounds[r][1] if r in rounds else None for r in range(max(rounds) + 1)],
+        "branches": sorted(branches, key=lambda b: -b["idle"]),
+    }
+
+# Elements of each output compared at a time by `MetalProblem.compare`.
+CHUNK_ELEMENTS = 1 << 22
+
+def load_npy(path):
+    """Memory-map a `.npy` file for use as a `MetalProblem` input.
+
+    Dispatching the kernel copies the whole file into memory. With
+    `chunk_axes`, the spec and the comparison copy a slice at a time.
+    """
+    assert np is not None, "Memory-mapped inputs need numpy"
+    return np.load(path, mmap_mode="r")
+
+def as_mx(x):
+    assert mx is not None, "Running kernels and specs needs MLX"
+    return x if isinstance(x, mx.array) else mx.array(x)
+
+@dataclass
+class Mismatch:
+    """How one kernel output differs from the spec.
+
+    `first` holds up to `limit` mismatching elements as `(index, yours,
+    spec)`.
+    """
+    name: str
+    shape: tuple
+    dtype: Any
+    count: int = 0
+    max_abs: float = 0.0
+    max_rel: float = 0.0
+    first: list = None
+
+    def update(self, x, y, offset, limit):
+        """Fold in flat chunks `x` and `y`, starting at element `offset` of the output."""
+        assert mx is not None, "Comparing outputs needs MLX"
+        x, y = x.astype(mx.float32), y.astype(mx.float32)
+        bad = mx.logical_not(mx.isclose(x, y, **tolerance(self.dtype)))
+        err = mx.abs(x - y)
+        rel = mx.where(y == 0, 0, err / mx.abs(y))
+        count, max_abs, max_rel = mx.sum(bad), mx.max(err), mx.max(rel)
+        mx.eval(count, max_abs, max_rel)
+        self.max_abs = max(self.max_abs, max_abs.item())
+        self.max_rel = max(self.max_rel, max_rel.item())
+        if count.item() == 0:
+            return
+        self.count += count.item()
+        self.first = self.first or []
+        if len(self.first) < limit:
+            # The first few mismatches, without materializing every index.
+            positions = mx.where(bad, mx.arange(x.size), x.size)
+            for i in mx.sort(positions)[: limit - len(self.first)].tolist():
+                if i == x.size:
+                    break
+                self.first.append((unravel(offset + i, self.shape), x[i].item(), y[i].item()))
+
+    def __str__(self):
+        size = math.prod(self.shape)
+        lines = [
+            f"{self.name}: {self.count} of {size} elements differ,"
+            f" max abs error {self.max_abs:.6g}, max rel error {self.max_rel:.6g}"
+        ]
+        for index, yours, spec in self.first:
+            lines.append(f"   {self.name}{list(index)}: yours {yours}, spec {spec}")
+        if self.count > len(self.first):
+            lines.append(f"   ... and {self.count - len(self.first)} more")
+        return "\n".join(lines)
+
+def unravel(i, shape):
+    index = []
+    for n in reversed(shape):
+        i, r = divmod(i, n)
+        index.append(r)
+    return tuple(reversed(index))
+
+def compare_outputs(names, xs, chunks, limit=10):
+    """Compare outputs `xs` against the spec, a chunk at a time.
+
+    `chunks` yields `(offset, ys)`: the spec's outputs, flattened, from
+    element `offset` on. Returns a `Mismatch` for each output that differs,
+    with at most `limit` mismatching elements listed.
+    """
+    mismatches = [Mismatch(name, tuple(x.shape), x.dtype) for name, x in zip(names, xs)]
+    flat = [x.reshape(-1) for x in xs]
+    for offset, ys in chunks:
+        assert len(xs) == len(ys), f"Kernel has {len(xs)} outputs but spec returned {len(ys)}"
+        for m, x, y in zip(mismatches, flat, ys):
+            for s in range(0, y.size, CHUNK_ELEMENTS):
+                n = min(CHUNK_ELEMENTS, y.size - s)
+                m.update(x[offset + s : offset + s + n], y[s : s + n], offset + s, limit)
+    return [m for m in mismatches if m.count]
+
+@dataclass
+class Constraints:
+    """The inputs and launches a problem's kernel has to handle.
+
+    `sizes` maps each size name to an inclusive `(min, max)` range, and
+    `launch(**sizes)` returns a dict with the `inputs` shapes and any of
+    `output_shapes`, `grid` and `threadgroup` that depend on them. Inputs
+    get random values in `values` of one of `dtypes`. `metal_fuzz.py`
+    draws cases from these.
+    """
+    sizes: dict
+    launch: Any
+    dtypes: Tuple[Any] = ("float32",)
+    values: Tuple[float] = (-10, 10)
 
 @dataclass
 class MetalProblem:
     name: str
     fn: Any
-    inputs: List[mx.array]
-    output_shapes: Tuple[int]
+    inputs: List[Any]
+    output_shapes: Any
     grid: Tuple[int] = (1,1,1)
     threadgroup: Tuple[int] = (1,1,1)
     spec: Any = None
-
-    def run_metal(self):
-        assert mx.metal.is_available(), "Metal is not available"
+    input_dtypes: List[Any] = None
+    output_dtypes: List[Any] = None
+    constraints: Constraints = None
+    chunk_axes: Tuple[Any] = None
+
+    def __post_init__(self):
+        # `output_shapes` is a single shape, or one shape per output.
+        if all(isinstance(d, int) for d in self.output_shapes):
+            self.output_shapes = [self.output_shapes]
+        self.output_shapes = [tuple(shape) for shape in self.output_shapes]
+        if self.input_dtypes is not None:
+            # Memory-mapped inputs keep the dtype of their file.
+            self.inputs = [
+                x.astype(d) if mx is not None and isinstance(x, mx.array) else x
+                for x, d in zip(self.inputs, self.input_dtypes)
+            ]
+        if self.output_dtypes is None:
+            self.output_dtypes = [mx.float32 if mx is not None else "float"] * len(self.output_shapes)
+
+    def run_metal(self, stream=None):
+        assert mx is not None and mx.metal.is_available(), "Metal is not available"
 
         outputs = self.metalKernel()(
-            inputs=self.inputs,
+            inputs=[as_mx(x) for x in self.inputs],
             grid=self.grid,
             threadgroup=self.threadgroup,
-            output_shapes=[self.output_shapes],
-            output_dtypes=[mx.float32],
+            output_shapes=self.output_shapes,
+            output_dtypes=self.output_dtypes,
+            stream=mx.gpu if stream is None else stream,
+            verbose=os.getenv("VERBOSE")=='1',
+            init_value=0,
+        )
+
+        return outputs[0] if len(outputs) == 1 else tuple(outputs)
+
+    def time_metal(self, repeat=10):
+        """Mean seconds per run of the kernel, measured on the GPU."""
+        self.metalKernel = self.fn(*self.inputs)
+        mx.eval(self.run_metal())
+        start = time.perf_counter()
+        for _ in range(repeat):
+            mx.eval(self.run_metal())
+        return (time.perf_counter() - start) / repeat
+
+    def run_metal_batch(self, inputs):
+        """Run the kernel on inputs stacked along a new leading axis, in one dispatch."""
+        assert mx is not None and mx.metal.is_available(), "Metal is not available"
+        assert self.grid[2] == 1 and self.threadgroup[2] == 1, "Batching uses the z axis of the grid"
+
+        batch = inputs[0].shape[0]
+        kernel = self.metalKernel.batched(
+            [tuple(x.shape[1:]) for x in inputs], self.output_shapes
+        )
+        outputs = kernel()(
+            inputs=inputs,
+            grid=(self.grid[0], self.grid[1], batch),
+            threadgroup=self.threadgroup,
+            output_shapes=[(batch,) + shape for shape in self.output_shapes],
+            output_dtypes=self.output_dtypes,
             stream=mx.gpu,
             verbose=os.getenv("VERBOSE")=='1',
             init_value=0,
         )
 
-        return outputs[0]
-    
-    def score(self, results):
-        total = 0
-        full = Counter()
-        for pos, (tt, a, c, out) in results[Coord(0, 0)].items():
-            total += 1
-            count = Counter()
-            for out, tab in [(False, c2.refs[i]) for i in range(1, c.rounds()) for c2 in c.caches] + [(True, out)]:
-                for inc in tab.incoming:
-                    if out:
-                        count["out_writes"] += 1
-                    else:
-                        count["shared_writes"] += 1
-                    for ins in inc[1].inputs:
-                        if ins.location[0].startswith("S"):
-                            count["shared_reads"] += 1
-                        else:
-                            count["in_reads"] += 1
-            for k in count:
-                if count[k] > full[k]:
-                    full[k] = count[k]
-        print(f"""# {self.name}
- 
-   Score (Max Per Thread):
-   | {'Global Reads':>13} | {'Global Writes':>13} | {'Shared Reads' :>13} | {'Shared Writes' :>13} |
-   | {full['in_reads']:>13} | {full['out_writes']:>13} | {full['shared_reads']:>13} | {full['shared_writes']:>13} | 
-        """) 
+        return outputs[0] if len(outputs) == 1 else tuple(outputs)
 
-    def run_python(self):
+    def spec_batch(self, inputs):
+        try:
+            y = mx.vmap(self.spec)(*inputs)
+            mx.eval(y)
+            return y
+        except Exception:
+            # Fall back to one call per batch entry for specs vmap can't trace.
+            ys = [self.spec(*[x[k] for x in inputs]) for k in range(inputs[0].shape[0])]
+            if isinstance(ys[0], tuple):
+                return tuple(mx.stack(y) for y in zip(*ys))
+            return mx.stack(ys)
+    
+    def score(self, results=None):
+        """Print and return the score of `results`, or of a static analysis if not given."""
+        if results is None:
+            analysis = self.analyze()
+            score = analysis.score
+            for message in analysis.out_of_bounds:
+                print(f"Warning: {message}")
+        else:
+            score = self.measure(results)
+        columns = ["in_read", "out_write", "shared_read", "shared_write", "simd_read", "simd_write"]
+
+        def row(label, counts, suffix="s", fmt=""):
+            return f"   | {label:>13} | " + " | ".join(f"{counts[c + suffix]:>13{fmt}}" for c in columns) + " | "
+
+        full = score.max
+        # Extrapolated totals are estimates; don't show their fractions.
+        total_fmt = ".0f" if score.sample else ""
+        lines = [
+            f"# {self.name}",
+            " ",
+            "   Score (Max Per Thread):",
+            f"   | {'':>13} | {'Global Reads':>13} | {'Global Writes':>13} | {'Shared Reads' :>13} | {'Shared Writes' :>13} | {'SIMD Reads' :>13} | {'SIMD Writes' :>13} |",
+            row("Accesses", full),
+            row("Transactions", full, "_txns"),
+            row("Bytes", full, "_bytes"),
+            " ",
+            f"   Grid ({score.threads} threads):",
+            row("Mean", score.mean, fmt=".2f"),
+            row("Total", score.total, fmt=total_fmt),
+            row("Total Bytes", score.total, "_bytes", fmt=total_fmt),
+        ]
+        if score.sample:
+            lines.insert(-1, row("Total ± 95%", score.sample["bounds"], fmt=".0f"))
+            lines += [
+                f"   Sampled {score.sample['simulated']} of {score.sample['threadgroups']} threadgroups:"
+                " max over the sample, totals extrapolated."
+            ]
+        if len(score.rounds) > 1:
+            lines += [" ", "   Barrier Rounds (Max Per Thread):"]
+            lines += [row(f"Round {r}", counts["max"]) for r, counts in enumerate(score.rounds)]
+        if score.lanes:
+            lanes = score.lanes
+            lines += [" ", f"   SIMD Lanes: {lanes['efficiency']:.1%} of launched lanes active in branches"]
+            if len(lanes["rounds"]) > 1:
+                lines.append("   By round: " + " | ".join("-" if e is None else f"{e:.0%}" for e in lanes["rounds"]))
+            for b in [b for b in lanes["branches"] if b["idle"]][:3]:
+                lines.append(f"   | {b['efficiency']:>6.1%} active | {b['idle']:>8} idle lanes | {b['branch']}")
+        print("\n".join(lines) + "\n")
+        if full["atomics"]:
+            print(f"   Atomics: {full['atomics']} per thread, at most {full['atomic_contention']} on one address\n")
+        return score
+
+    def counts(self, results):
+        """Max per-thread counts over the grid."""
+        return self.measure(results).max
+
+    def thread_counts(self, results):
+        """Access counts keyed by (threadgroup, thread, barrier round)."""
+        counts = {}
+        for block, threads in results.items():
+            _, a, c, outs = next(iter(threads.values()))
+            shared = [c2.refs[i] for i in range(1, c.rounds()) for c2 in c.caches]
+            registers = c.threadgroupMemory.registers
+            # The counters each table's reads go to, and their size.
+            read_keys = {}
+            for kind, tables in [("in", a + outs), ("shared", [r for c2 in c.caches for r in c2.refs]), ("simd", registers)]:
+                for tab in tables:
+                    read_keys[tab.name] = (kind + "_reads", kind + "_read_bytes", kind + "_read_txns", tab.itemsize)
+            # Reads a thread already passed through a SIMD exchange are
+            # charged there, not again when the value is stored.
+            exchanged = {}
+            for tab in registers:
+                for _, val, tt, _ in tab.incoming:
+                    exchanged.setdefault(tt, set()).update(id(ins) for ins in val.inputs)
+            # Vector loads and stores move several elements in one transaction.
+            seen = {}
+            tabs = [("shared", t) for t in shared] + [("simd", t) for t in registers] + [("out", t) for t in outs]
+            for kind, tab in tabs:
+                for _, val, tt, rnd in tab.incoming:
+                    count = counts.setdefault((block, tt, rnd), Counter())
+                    txns = seen.setdefault(tt, set())
+                    count[kind + "_writes"] += 1
+                    count[kind + "_write_bytes"] += tab.itemsize
+                    if val.txn is None or (kind, val.txn) not in txns:
+                        count[kind + "_write_txns"] += 1
+                        txns.add((kind, val.txn))
+                    skip = exchanged.get(tt, ()) if kind != "simd" else ()
+                    for ins in val.inputs:
+                        if skip and id(ins) in skip:
+                            continue
+                        reads, read_bytes, read_txns, size = read_keys[ins.location[0]]
+                        count[reads] += 1
+                        count[read_bytes] += size
+                        if ins.txn is None or ins.txn not in txns:
+                            count[read_txns] += 1
+                            txns.add(ins.txn)
+            for tab in outs + [r for c2 in c.caches for r in c2.refs]:
+                for _, _, tt, rnd in tab.atomics:
+                    counts.setdefault((block, tt, rnd), Counter())["atomics"] += 1
+        return counts
+
+    @gc_paused()
+    def measure(self, results):
+        """Score every thread of the grid, overall and per barrier round.
+
+        Totals and means of `SampledResults` are extrapolated to the grid.
+        """
+        strata = getattr(results, "strata", None)
+        threads = results.threads if strata else sum(len(block) for block in results.values())
+        counts = self.thread_counts(results)
+
+        def summarize(items):
+            top, total, per_block = Counter(), Counter(), {b: Counter() for b in results}
+            for (block, _), count in items:
+                per_block[block].update(count)
+                for k in count:
+                    if count[k] > top[k]:
+                        top[k] = count[k]
+            bounds = None
+            if strata:
+                total, bounds = extrapolate(strata, per_block)
+            else:
+                for count in per_block.values():
+                    total.update(count)
+            return top, total, Counter({k: v / threads for k, v in total.items()}), bounds
+
+        per_thread, per_round = {}, {}
+        for (block, tt, rnd), count in counts.items():
+            per_thread.setdefault((block, tt), Counter()).update(count)
+            per_round.setdefault(rnd, []).append(((block, tt), count))
+        full, total, mean, bounds = summarize(per_thread.items())
+
+        rounds = []
+        for r in range(max(per_round, default=0) + 1):
+            top, round_total, round_mean, _ = summarize(per_round.get(r, []))
+            rounds.append({"max": top, "mean": round_mean, "total": round_total})
+
+        # Contention is the number of atomic ops that hit one address: device
+        # addresses across the whole grid, threadgroup ones per threadgroup.
+        contention = Counter()
+        for block, block_results in results.items():
+            _, _, metal, outs = next(iter(block_results.values()))
+            for tab in outs:
+                for index, _, _, _ in tab.atomics:
+                    contention[(tab.name,) + index] += 1
+            for tab in {id(r): r for c2 in metal.caches for r in c2.refs}.values():
+                for index, _, _, _ in tab.atomics:
+                    contention[(block, tab.name) + index] += 1
+        if contention:
+            full["atomic_contention"] = max(contention.values())
+        sample = None
+        if strata:
+            sample = {
+                "threadgroups": sum(n for n, _ in strata.values()),
+                "simulated": len(results),
+                "bounds": bounds,
+            }
+        return Score(self.name, threads, full, mean, total, rounds, sample, lane_usage(results))
+
+    def set_launch(self):
         if self.threadgroup[0] == 1 and self.threadgroup[1] == 1:
             self.threadsperblock = Coord(self.grid[0], self.grid[1])
             self.blockspergrid = Coord(1, 1)
@@ -89,79 +927,846 @@ class MetalProblem:
             self.threadsperblock = Coord(self.threadgroup[0], self.threadgroup[1])
             self.blockspergrid = Coord(self.grid[0] // self.threadgroup[0], self.grid[1] // self.threadgroup[1])
 
+    def analyze(self, fallback=True):
+        """Score the kernel statically, or by simulation if the analysis can't decide.
+
+        Loops are followed one iteration at a time, so the analysis gives up
+        after `MAX_STEPS` statements. The fallback simulates a sample of the
+        threadgroups, which on small grids is all of them.
+        """
+        self.set_launch()
+        self.metalKernel = self.fn(*self.inputs)
+        try:
+            return analyze_kernel(
+                self.metalKernel, self.inputs, self.output_shapes, self.output_dtypes,
+                self.threadsperblock, self.blockspergrid, self.name,
+            )
+        except Undecidable as e:
+            if not fallback:
+                raise
+            results = self.sample_python()
+            if len(results) == self.blockspergrid.x * self.blockspergrid.y:
+                results = dict(results)
+            return Analysis(self.measure(results), [], [], simulated=True, reason=str(e))
+
+    @gc_paused()
+    def run_python(self, blocks=None, profile=None):
+        """Simulate every thread of the threadgroups in `blocks`, by default the whole grid.
+
+        With a `LineProfile`, its instrumented kernel runs instead.
+        """
+        self.set_launch()
         self.metalKernel = self.fn(*self.inputs)
-        metal_py = convert_source_to_py(self.metalKernel.header + self.metalKernel.source)
 
+        # Only the shapes and dtypes of the inputs are needed, never their
+        # data.
         inputs = {}
         for i in range(len(self.inputs)):
             curr = self.inputs[i]
             name = self.metalKernel.input_names[i]
-            inputs[name + "_shape"] = curr.shape
-            inputs[name + "_ndim"] = curr.ndim
-            inputs[name + "_strides"] = mx.array([curr.shape[0], 1])
-
-        globals().update(inputs)
+            inputs[name + "_shape"] = tuple(curr.shape)
+            inputs[name + "_ndim"] = len(curr.shape)
+            inputs[name + "_strides"] = row_major_strides(curr.shape)
+
+        # Shapes and the threadgroup size are the same for every thread.
+        constants = tuple(inputs.items())
+        params = tuple(self.metalKernel.input_names + self.metalKernel.output_names)
+        if profile is None:
+            kernel = compile_specialized(
+                self.metalKernel.header, self.metalKernel.source, constants, self.threadsperblock, params
+            )
+        else:
+            kernel = profile.function(constants, params)
 
         results = {}
-        for i, block in self.blockspergrid.enumerate():
+        if blocks is None:
+            blocks = [block for _, block in self.blockspergrid.enumerate()]
+        for block in blocks:
+            # Tables are shared by the whole threadgroup; each access is
+            # tagged with the thread that made it.
+            memory = ThreadgroupMemory()
+            tables = [
+                Table(name, inp.shape, memory, inp.dtype)
+                for name, inp in zip(self.metalKernel.input_names, self.inputs)
+            ]
+            outs = [
+                Table(name, shape, memory, dtype)
+                for name, shape, dtype in zip(self.metalKernel.output_names, self.output_shapes, self.output_dtypes)
+            ]
+
             results[block] = {}
             for tt, pos in self.threadsperblock.enumerate():
-                tables = []
-                args = ["a", "b", "c", "d"]
-                for i, inp in enumerate(self.inputs):
-                    globals()[args[i]] = Table(args[i], inp)
-                    tables.append(globals()[args[i]])
-                out = mx.zeros(self.output_shapes)
-                out = Table("out", out)
-                metal = Metal(block, self.threadsperblock, pos, pos)
+                grid_pos = Coord(
+                    block.x * self.threadsperblock.x + pos.x,
+                    block.y * self.threadsperblock.y + pos.y,
+                )
+                metal = Metal(block, self.threadsperblock, pos, grid_pos, tt, memory)
+                memory.metal = metal
+                kernel(metal, *tables, *outs)
+                results[block][pos] = (tt, tables, metal, outs)
 
-                exec(metal_py)
+        return results
 
-                metal.finish()
-                results[block][pos] = (tt, tables, metal, out)
+    def profile(self, blocks=None):
+        """Simulate under a line profiler and print the annotated kernel source."""
+        self.metalKernel = self.fn(*self.inputs)
+        profile = LineProfile(self.metalKernel)
+        self.run_python(blocks, profile=profile)
+        print(f"# {self.name}\n \n" + profile.annotate() + "\n")
+        return profile
+
+    def cache_traffic(self, config=None, results=None):
+        """Print the modeled cache hit rates and DRAM traffic of the kernel."""
+        report = model_cache(self.run_python() if results is None else results, config)
+        print(f"# {self.name}\n \n{report}\n")
+        return report
+
+    def variants(self, launch=None, **choices):
+        """Copies of this problem for every combination of template values.
+
+        `choices` maps template parameters of the kernel to the values to
+        try. `launch(**values)` can give each combination its own `grid` and
+        `threadgroup`; by default the problem's launch is kept. Returns a
+        dict from names like `"THREADGROUP_MEM_SIZE=4"` to problems, ready
+        for `compare_kernels`.
+        """
+        variants = {}
+        for combination in itertools.product(*choices.values()):
+            values = dict(zip(choices, combination))
+            label = ", ".join(f"{k}={v}" for k, v in values.items())
+
+            def kernel_fn(*inputs, values=values):
+                return self.fn(*inputs).instantiate(**values)
+
+            changes = launch(**values) if launch is not None else {}
+            variants[label] = dataclasses.replace(self, fn=kernel_fn, name=f"{self.name} ({label})", **changes)
+        return variants
+
+    def sample_python(self, edge=2, interior=8, seed=0):
+        """Simulate a sample of the threadgroups, returning `SampledResults`.
+
+        Guards usually only differ at the borders of the grid, so every
+        corner threadgroup is simulated, plus `edge` threadgroups drawn at
+        random from each edge and `interior` from the rest. `measure` and
+        `score` extrapolate the totals of the sample to the whole grid.
+        """
+        self.set_launch()
+        grid = self.blockspergrid
+        # Each stratum is the product of some columns and rows of the grid,
+        # in the order its first threadgroup comes up row by row.
+        x_edges = (0, grid.x - 1) if grid.x > 1 else ()
+        y_edges = (0, grid.y - 1) if grid.y > 1 else ()
+        cols = range(1, grid.x - 1) if x_edges else range(grid.x)
+        rows = range(1, grid.y - 1) if y_edges else range(grid.y)
+        products = {
+            "corner": (x_edges, y_edges),
+            "top": (cols, y_edges[:1]),
+            "left": (x_edges[:1], rows),
+            "interior": (cols, rows),
+            "right": (x_edges[1:], rows),
+            "bottom": (cols, y_edges[1:]),
+        }
+        rng = random.Random(seed)
+        strata = {}
+        for name, (xs, ys) in products.items():
+            n = len(xs) * len(ys)
+            if n == 0:
+                continue
+            k = {"corner": n, "interior": interior}.get(name, edge)
+            strata[name] = (n, {Coord(xs[i % len(xs)], ys[i // len(xs)]) for i in rng.sample(range(n), min(k, n))})
 
-        return results
+        chosen = sorted(set().union(*(bs for _, bs in strata.values())), key=lambda b: (b.y, b.x))
+        threads = grid.x * grid.y * self.threadsperblock.x * self.threadsperblock.y
+        return SampledResults(self.run_python(chosen), strata, threads)
     
-    def show(self):
+    def show(self, svg=None):
+        """Score and draw the kernel, or stream the drawing to the file `svg`."""
         results = self.run_python()
         score = self.score(results)
+        for hazard in find_hazards(results):
+            print(f"Warning: {hazard.message}")
+        if svg is not None:
+            write_results(results, self.name, self.threadsperblock.x, self.threadsperblock.y, svg)
+            return svg
         return draw_results(results, self.name, self.threadsperblock.x, self.threadsperblock.y)
 
-    def check(self):
+    def spec_chunks(self):
+        """Yield `(offset, ys)`: the spec's outputs, flattened, from element `offset` on.
+
+        With `chunk_axes`, the spec is run on slices of the inputs that
+        line up with rows of the outputs: the input axis for each input,
+        or None for inputs it needs whole, which are copied into memory
+        whole. Otherwise it runs once, on whole copies of the inputs.
+        """
+        if self.chunk_axes is None:
+            ys = self.spec(*[as_mx(x) for x in self.inputs])
+            yield 0, [y.reshape(-1) for y in (ys if isinstance(ys, tuple) else (ys,))]
+            return
+
+        rows = self.output_shapes[0][0]
+        row_size = max(math.prod(shape[1:]) for shape in self.output_shapes)
+        step = max(1, CHUNK_ELEMENTS // row_size)
+        for start in range(0, rows, step):
+            stop = min(start + step, rows)
+            args = [
+                as_mx(x if axis is None else x[(slice(None),) * axis + (slice(start, stop),)])
+                for x, axis in zip(self.inputs, self.chunk_axes)
+            ]
+            ys = self.spec(*args)
+            yield start * row_size, [y.reshape(-1) for y in (ys if isinstance(ys, tuple) else (ys,))]
+
+    def compare(self, xs, limit=10):
+        """Compare the kernel outputs `xs` against the spec, a chunk at a time.
+
+        Returns a `Mismatch` for each output that differs, with at most
+        `limit` mismatching elements listed.
+        """
+        if not isinstance(xs, tuple):
+            xs = (xs,)
+        return compare_outputs(self.metalKernel.output_names, xs, self.spec_chunks(), limit)
+
+    def check(self, limit=10):
         try:
             self.metalKernel = self.fn(*self.inputs)
 
             if os.getenv("MTL_CAPTURE_ENABLED") == '1':
-                mx.eval(*self.inputs)
+                mx.eval(*[x for x in self.inputs if isinstance(x, mx.array)])
                 
                 traceName = f"custom_kernel_{self.metalKernel.name}.gputrace"
                 mx.metal.start_capture(traceName)
                 for _ in range(2): mx.eval(self.run_metal())
                 mx.metal.stop_capture()
 
-            x = self.run_metal()
-            y = self.spec(*self.inputs)
+            xs = self.run_metal()
+            failed = self.compare(xs, limit)
+            if not failed: 
+                print("Passed Tests!")
+                return True
+
+            print("Failed Tests.")
+            for m in failed:
+                print(m)
+            # Small outputs are easier to debug in full.
+            if all(math.prod(shape) <= 64 for shape in self.output_shapes):
+                ys = self.spec(*[as_mx(x) for x in self.inputs])
+                if not isinstance(xs, tuple):
+                    xs, ys = (xs,), (ys,)
+                for name, x, y in zip(self.metalKernel.output_names, xs, ys):
+                    print(f"Yours ({name}):", x)
+                    print(f"Spec  ({name}):", y)
+
+        except AssertionError as e:
+            print(f"Error: {e}")
+        return False
+
+    def check_batch(self, input_sets):
+        """Check the kernel against the spec on many input sets at once.
+
+        The input sets are stacked along a new leading axis and run as a
+        single dispatch, and the spec is evaluated with `mx.vmap`. Returns
+        whether each input set passed.
+
+        The simulator traces indices, not values, so a single `show()` on
+        any one input set already covers the access pattern of the batch.
+        """
+        batch = len(input_sets)
+        try:
+            inputs = [mx.stack(xs) for xs in zip(*input_sets)]
+            self.metalKernel = self.fn(*input_sets[0])
+
+            xs = self.run_metal_batch(inputs)
+            ys = self.spec_batch(inputs)
+            if not isinstance(xs, tuple):
+                xs, ys = (xs,), (ys,)
+
+            passed = [True] * batch
+            for x, y in zip(xs, ys):
+                close = mx.isclose(x, y.reshape(x.shape), **tolerance(x.dtype))
+                passed = [p and c for p, c in zip(passed, close.reshape(batch, -1).all(axis=1).tolist())]
+
+        except AssertionError as e:
+            print(f"Error: {e}")
+            return [False] * batch
+
+        failed = [k for k, ok in enumerate(passed) if not ok]
+        if not failed:
+            print(f"Passed Tests! ({batch} batches)")
+        else:
+            print(f"Failed Tests. {len(failed)} of {batch} batches failed:", failed[:10], "..." if len(failed) > 10 else "")
+        return passed
+
+@dataclass
+class MetalStage:
+    """One dispatch of a `MetalPipeline`.
+
+    `inputs` names the pipeline buffers passed to the kernel, in order.
+    The kernel's outputs become pipeline buffers under its `output_names`.
+    """
+    name: str
+    fn: Any
+    inputs: List[str]
+    output_shapes: Any
+    grid: Tuple[int] = (1,1,1)
+    threadgroup: Tuple[int] = (1,1,1)
+    output_dtypes: List[Any] = None
+
+    def problem(self, buffers):
+        return MetalProblem(
+            self.name,
+            self.fn,
+            [buffers[name] for name in self.inputs],
+            self.output_shapes,
+            grid=self.grid,
+            threadgroup=self.threadgroup,
+            output_dtypes=self.output_dtypes,
+        )
+
+@dataclass(frozen=True)
+class BufferShape:
+    """Stands in for an array whose data the simulator never looks at."""
+    shape: Tuple[int]
+    dtype: Any
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def size(self):
+        return math.prod(self.shape)
+
+@dataclass
+class MetalPipeline:
+    """Several kernels run back to back, e.g. the two passes of a reduction.
+
+    Intermediate outputs stay as lazy `mx.array`s on the device and are
+    fed straight to later stages. `spec` is called with the pipeline
+    inputs and is compared against the buffers named in `outputs`.
+    """
+    name: str
+    stages: List[MetalStage]
+    inputs: dict
+    outputs: List[str]
+    spec: Any = None
+
+    def run_metal(self):
+        buffers = dict(self.inputs)
+        for stage in self.stages:
+            problem = stage.problem(buffers)
+            problem.metalKernel = problem.fn(*problem.inputs)
+            outs = problem.run_metal()
+            if not isinstance(outs, tuple):
+                outs = (outs,)
+            buffers.update(zip(problem.metalKernel.output_names, outs))
+        return buffers
+
+    def time_metal(self, repeat=10):
+        """Mean seconds per run of each stage, measured on the GPU."""
+        buffers = dict(self.inputs)
+        mx.eval(*buffers.values())
+        times = []
+        for stage in self.stages:
+            problem = stage.problem(buffers)
+            problem.metalKernel = problem.fn(*problem.inputs)
+            mx.eval(problem.run_metal())
+            start = time.perf_counter()
+            for _ in range(repeat):
+                outs = problem.run_metal()
+                mx.eval(outs)
+            times.append((time.perf_counter() - start) / repeat)
+            if not isinstance(outs, tuple):
+                outs = (outs,)
+            buffers.update(zip(problem.metalKernel.output_names, outs))
+        return times
+
+    def run_python(self):
+        """Simulate every stage, returning `(problem, results)` per stage.
+
+        Intermediate buffers are stood in for by `BufferShape`s, since
+        the simulator only needs their shapes and dtypes.
+        """
+        buffers = dict(self.inputs)
+        stages = []
+        for stage in self.stages:
+            problem = stage.problem(buffers)
+            stages.append((problem, problem.run_python()))
+            for name, shape, dtype in zip(problem.metalKernel.output_names, problem.output_shapes, problem.output_dtypes):
+                buffers[name] = BufferShape(tuple(shape), dtype)
+        return stages
+
+    def score(self, stages, times=None):
+        columns = [
+            ("Global Reads", "in_reads"), ("Global Writes", "out_writes"),
+            ("Shared Reads", "shared_reads"), ("Shared Writes", "shared_writes"),
+            ("Global Bytes", "global_bytes"),
+        ]
+        # Stages are scored per thread; the last row adds up the accesses
+        # of every thread of every stage.
+        rows = []
+        total = Counter()
+        for problem, results in stages:
+            score = problem.measure(results)
+            counts = Counter(score.max)
+            counts["global_bytes"] = counts["in_read_bytes"] + counts["out_write_bytes"]
+            total.update({k: score.total[k] for _, k in columns})
+            total["global_bytes"] += score.total["in_read_bytes"] + score.total["out_write_bytes"]
+            rows.append((problem.name, counts))
+        rows.append(("Grid Total", total))
+
+        header = f"   | {'Stage':>20} | " + " | ".join(f"{c:>13}" for c, _ in columns)
+        if times is not None:
+            header += f" | {'Time (ms)':>13}"
+            times = list(times) + [sum(times)]
+        lines = [header + " |"]
+        for i, (name, counts) in enumerate(rows):
+            line = f"   | {name:>20} | " + " | ".join(f"{counts[k]:>13}" for _, k in columns)
+            if times is not None:
+                line += f" | {times[i] * 1000:>13.3f}"
+            lines.append(line + " |")
+        print(f"# {self.name}\n \n   Score (Max Per Thread per stage, Grid Total over all of them):\n" + "\n".join(lines) + "\n")
+        return rows
 
-            if mx.allclose(x, y): 
+    def show(self):
+        stages = self.run_python()
+        self.score(stages)
+        diagrams = []
+        for problem, results in stages:
+            for hazard in find_hazards(results):
+                print(f"Warning: {problem.name}: {hazard.message}")
+            diagrams.append(draw_results(
+                results, problem.name, problem.threadsperblock.x, problem.threadsperblock.y
+            ))
+        full = vcat(diagrams, 1.0)
+        set_svg_height(50 * full.get_envelope().height)
+        return full
+
+    def check(self, limit=10):
+        try:
+            buffers = self.run_metal()
+            xs = tuple(buffers[name] for name in self.outputs)
+            ys = self.spec(*self.inputs.values())
+            if not isinstance(ys, tuple):
+                ys = (ys,)
+            failed = compare_outputs(self.outputs, xs, [(0, [y.reshape(-1) for y in ys])], limit)
+            if not failed:
                 print("Passed Tests!")
-                return 
+                return True
 
             print("Failed Tests.")
-            print("Yours:", x)
-            print("Spec :", y)
+            for m in failed:
+                print(m)
+            # Small outputs are easier to debug in full.
+            if all(x.size <= 64 for x in xs):
+                for name, x, y in zip(self.outputs, xs, ys):
+                    print(f"Yours ({name}):", x)
+                    print(f"Spec  ({name}):", y)
 
         except AssertionError as e:
             print(f"Error: {e}")
+        return False
+
+def threadgroup_bytes(results):
+    """Threadgroup memory declared by each threadgroup of `results`."""
+    _, _, metal, _ = next(iter(next(iter(results.values())).values()))
+    return sum(math.prod(c.refs[0].size) * c.refs[0].itemsize for c in metal.threadgroupMemory.caches)
+
+def cell_counts(results):
+    """Reads and writes of each table cell, summed over the grid.
+
+    Keys are `(table, index, "reads" or "writes")`. Every barrier round of
+    a threadgroup array counts under the array's own name.
+    """
+    counts = Counter()
+    for threads in results.values():
+        _, _, c, outs = next(iter(threads.values()))
+        tabs = outs + c.threadgroupMemory.registers + [r for c2 in c.threadgroupMemory.caches for r in c2.refs]
+        for tab in tabs:
+            for index, val, _, _ in tab.incoming:
+                counts[(tab.name.rstrip("'"), index, "writes")] += 1
+                for ins in val.inputs:
+                    counts[(ins.location[0].rstrip("'"), ins.location[1:], "reads")] += 1
+    return counts
+
+def trace_diff(before, after):
+    """Cells whose counts differ between two `cell_counts`, biggest change first.
+
+    Returns `(table, index, kind, before, after)` tuples.
+    """
+    changed = [k + (before[k], after[k]) for k in set(before) | set(after) if before[k] != after[k]]
+    return sorted(changed, key=lambda d: (-abs(d[4] - d[3]), d[:3]))
+
+@dataclass
+class CacheConfig:
+    """A set-associative, LRU, write-back cache in front of device memory.
+
+    With `scope="core"` each of the `cores` has its own cache, like the L1,
+    and threadgroups are dealt to the cores in dispatch order. With
+    `scope="device"` one cache is shared, like the last-level cache, by the
+    `cores` threadgroups that run at the same time.
+    """
+    line: int = 128
+    capacity: int = 8 * 1024
+    ways: int = 8
+    cores: int = 1
+    scope: str = "core"
+
+    def __post_init__(self):
+        if self.scope not in ("core", "device"):
+            raise ValueError(f"scope must be 'core' or 'device', not {self.scope!r}")
+        if self.capacity % (self.line * self.ways):
+            raise ValueError("capacity must be a multiple of line * ways")
+
+    def __str__(self):
+        scope = "one per core" if self.scope == "core" else "shared"
+        return f"{self.line} B lines, {self.capacity // 1024} KiB {self.ways}-way, {scope}, {self.cores} cores"
+
+class Cache:
+    def __init__(self, config):
+        self.ways = config.ways
+        self.sets = [OrderedDict() for _ in range(config.capacity // (config.line * config.ways))]
+
+    def access(self, line, table, write):
+        """Look up `line`, returning whether it hit and the table of the
+        dirty line it evicted, if any. Write misses allocate without a fill."""
+        lines = self.sets[line % len(self.sets)]
+        if line in lines:
+            lines.move_to_end(line)
+            if write:
+                lines[line] = (table, True)
+            return True, None
+        evicted = None
+        if len(lines) == self.ways:
+            _, (evicted, dirty) = lines.popitem(last=False)
+            evicted = evicted if dirty else None
+        lines[line] = (table, write)
+        return False, evicted
+
+    def flush(self):
+        """Tables of the dirty lines still in the cache."""
+        return [table for lines in self.sets for table, dirty in lines.values() if dirty]
+
+def global_requests(results, line):
+    """Device memory requests of each threadgroup of `results`, in issue order.
+
+    Requests are issued by barrier round, then SIMD group, then program
+    order. The lanes of a SIMD group make their k-th access of a round
+    together, and accesses of those lanes to one cache line coalesce into
+    a single request. Returns a dict from block to lists of `(key, table,
+    line)`, sorted by `key = (round, simdgroup, k, table index, write)`,
+    and the bytes accessed.
+    """
+    _, tables, _, outs = next(iter(next(iter(results.values())).values()))
+    # Buffers are laid out one after another, page aligned.
+    bases, end = {}, 0
+    for tab in tables + outs:
+        bases[tab.name] = end
+        end += -(-math.prod(tab.size) * tab.itemsize // 4096) * 4096
+
+    requests, accessed = {}, 0
+    for block, threads in results.items():
+        _, tables, _, outs = next(iter(threads.values()))
+        buffers = tables + outs
+        strides = [row_major_strides(tab.size) for tab in buffers]
+        accesses = []
+        for t, tab in enumerate(buffers):
+            accesses += [(n, t, index, tt, rnd, False) for (index, tt, rnd), n in zip(tab.reads, tab.read_order)]
+            accesses += [
+                (n, t, index, tt, rnd, True) for (index, _, tt, rnd), n in zip(tab.incoming, tab.incoming_order)
+            ]
+        issued = {}
+        rank = Counter()
+        for _, t, index, tt, rnd, write in sorted(accesses, key=lambda a: a[0]):
+            k = rank[tt, rnd]
+            rank[tt, rnd] += 1
+            tab = buffers[t]
+            address = bases[tab.name] + sum(i * s for i, s in zip(index, strides[t])) * tab.itemsize
+            issued.setdefault((rnd, tt // 32, k, t, write), (tab.name, set()))[1].add(address // line)
+            accessed += tab.itemsize
+        requests[block] = [(key, name, l) for key, (name, lines) in sorted(issued.items()) for l in sorted(lines)]
+    return requests, accessed
 
-def convert_source_to_py(source):
+@dataclass
+class CacheReport:
+    """Modeled device memory traffic of a kernel.
+
+    `tables` maps each global table to a Counter of cache `requests`,
+    `hits`, and lines read from (`dram_reads`) and written back to
+    (`dram_writes`) DRAM. `accessed_bytes` is what the threads read and
+    wrote; `footprint_bytes` is the lines they touched, the traffic of an
+    infinite cache.
+    """
+    config: CacheConfig
+    tables: dict
+    accessed_bytes: int
+    footprint_bytes: int
+
+    @property
+    def hit_rate(self):
+        requests = sum(c["requests"] for c in self.tables.values())
+        return sum(c["hits"] for c in self.tables.values()) / requests if requests else 0.0
+
+    @property
+    def dram_bytes(self):
+        return sum(c["dram_reads"] + c["dram_writes"] for c in self.tables.values()) * self.config.line
+
+    def __str__(self):
+        line = self.config.line
+        rows = [
+            f"   Cache Model ({self.config}):",
+            f"   | {'Table':>13} | {'Requests':>13} | {'Hit Rate':>13} | {'DRAM Read':>13} | {'DRAM Write':>13} |",
+        ]
+        total = Counter()
+        for name, c in list(self.tables.items()) + [("Total", None)]:
+            if c is None:
+                c = total
+            else:
+                total.update(c)
+            rate = c["hits"] / c["requests"] if c["requests"] else 0.0
+            rows.append(
+                f"   | {name:>13} | {c['requests']:>13} | {rate:>13.1%} | "
+                f"{c['dram_reads'] * line:>13} | {c['dram_writes'] * line:>13} |"
+            )
+        rows.append(
+            f"   Accessed {self.accessed_bytes} bytes; modeled DRAM traffic {self.dram_bytes} bytes"
+            f" (at least {self.footprint_bytes})."
+        )
+        return "\n".join(rows)
+
+def model_cache(results, config=None):
+    """Replay the global accesses of `results` through a cache model.
+
+    Threadgroups are dispatched in grid order: row by row, by y and then
+    x. Each replays its requests as `global_requests` issues them, by
+    barrier round, SIMD group and program order. Under a shared cache,
+    the threadgroups that run at the same time interleave: their k-th
+    accesses in the same round and SIMD group go one after another.
+    Sampled results only replay the sampled threadgroups.
+    """
+    config = config or CacheConfig()
+    requests, accessed = global_requests(results, config.line)
+    blocks = sorted(requests, key=lambda block: (block.y, block.x))
+    _, ins, _, outs = next(iter(next(iter(results.values())).values()))
+    tables = {tab.name: Counter() for tab in ins + outs}
+    footprint = set()
+
+    def replay(cache, stream):
+        for write, name, line in stream:
+            hit, evicted = cache.access(line, name, write)
+            footprint.add(line)
+            tables[name]["requests"] += 1
+            tables[name]["hits"] += hit
+            tables[name]["dram_reads"] += not hit and not write
+            if evicted is not None:
+                tables[evicted]["dram_writes"] += 1
+
+    if config.scope == "core":
+        caches = [Cache(config) for _ in range(config.cores)]
+        for k, block in enumerate(blocks):
+            replay(caches[k % config.cores], [(key[4], name, line) for key, name, line in requests[block]])
+    else:
+        caches = [Cache(config)]
+        for k in range(0, len(blocks), config.cores):
+            # Keys are (round, simdgroup, access, table, write); order the
+            # threadgroups of a wave after the access.
+            wave = sorted(
+                (key[:3] + (j,) + key[3:], name, line)
+                for j, block in enumerate(blocks[k : k + config.cores])
+                for key, name, line in requests[block]
+            )
+            replay(caches[0], [(key[5], name, line) for key, name, line in wave])
+    for cache in caches:
+        for name in cache.flush():
+            tables[name]["dram_writes"] += 1
+    return CacheReport(config, tables, accessed, len(footprint) * config.line)
+
+@dataclass
+class Variant:
+    """One kernel of a `compare_kernels` run.
+
+    `passed` and `time` (seconds per run) are None without a Metal device.
+    """
+    name: str
+    score: Score
+    threadgroup_bytes: int
+    cells: Counter
+    results: Any
+    passed: Any = None
+    time: float = None
+    cache: Any = None
+
+def compare_kernels(problem, kernels, repeat=10, cache=None):
+    """Run each kernel factory in `kernels` on the inputs and launch of `problem`.
+
+    `kernels` maps names to factories like `problem.fn`, or to problems
+    from `problem.variants`, which bring their own launch. Every kernel is
+    simulated, and checked against the spec and timed when Metal is
+    available. Prints a side-by-side table with deltas against the first
+    kernel, and the cells whose access counts changed. DRAM traffic is
+    modeled with the `cache` config, by default `CacheConfig()`. Returns a
+    `Variant` per kernel.
+    """
+    variants = []
+    for name, fn in kernels.items():
+        if isinstance(fn, MetalProblem):
+            p = fn
+        else:
+            p = dataclasses.replace(problem, fn=fn, name=f"{problem.name} ({name})")
+        results = p.run_python()
+        variant = Variant(name, p.measure(results), threadgroup_bytes(results), cell_counts(results), results)
+        variant.cache = model_cache(results, cache)
+        if mx is not None and mx.metal.is_available():
+            p.metalKernel = p.fn(*p.inputs)
+            variant.passed = not p.compare(p.run_metal())
+            variant.time = p.time_metal(repeat)
+        variants.append(variant)
+
+    def metrics(v):
+        rows = [("Passed", "-" if v.passed is None else ("yes" if v.passed else "NO"))]
+        rows += [(label, v.score.max[key]) for label, key in [
+            ("Global Reads", "in_reads"), ("Global Writes", "out_writes"),
+            ("Shared Reads", "shared_reads"), ("Shared Writes", "shared_writes"),
+            ("SIMD Reads", "simd_reads"), ("SIMD Writes", "simd_writes"),
+            ("Global Read Txns", "in_read_txns"),
+        ]]
+        rows += [
+            ("Threadgroup Mem", v.threadgroup_bytes),
+            ("Barrier Rounds", len(v.score.rounds)),
+            ("Total Glob Bytes", v.score.total["in_read_bytes"] + v.score.total["out_write_bytes"]),
+            ("DRAM Bytes", v.cache.dram_bytes),
+            ("Cache Hit Rate", round(v.cache.hit_rate, 3)),
+            ("Time (ms)", "-" if v.time is None else round(v.time * 1000, 3)),
+        ]
+        return rows
+
+    table = [metrics(v) for v in variants]
+    width = max([20] + [len(v.name) for v in variants])
+    lines = [
+        f"# {problem.name}",
+        " ",
+        "   Comparison (Max Per Thread, deltas against the first):",
+        f"   | {'':>16} | " + " | ".join(f"{v.name:>{width}}" for v in variants) + " |",
+    ]
+    for i, (label, _) in enumerate(table[0]):
+        cells = []
+        for rows in table:
+            value, first = rows[i][1], table[0][i][1]
+            if rows is not table[0] and isinstance(value, (int, float)) and isinstance(first, (int, float)):
+                delta = round(value - first, 3)
+                value = f"{value} ({'+' if delta >= 0 else ''}{delta})"
+            cells.append(f"{str(value):>{width}}")
+        lines.append(f"   | {label:>16} | " + " | ".join(cells) + " |")
+    print("\n".join(lines) + "\n")
+
+    for v in variants[1:]:
+        diff = trace_diff(variants[0].cells, v.cells)
+        print(f"   Trace diff, {variants[0].name} -> {v.name}: {len(diff)} cells changed")
+        for tab, index, kind, before, after in diff[:10]:
+            print(f"   {tab}{list(index)} {kind}: {before} -> {after}")
+        if len(diff) > 10:
+            print(f"   ... and {len(diff) - 10} more")
+        print()
+    return variants
+
+def check_async(problems, streams=None):
+    """Check many problems against their specs with a single evaluation.
+
+    Each problem's kernel is built as it is queued. Kernel runs, specs and
+    comparisons are queued lazily, round-robin over `streams` (by default
+    a new stream on the default device), then evaluated together with one
+    `mx.async_eval`. Yields `(problem, passed, failed)` as each problem
+    finishes, where `failed` names the outputs that differ or holds the
+    error.
+
+    Kernels only run on the GPU; with a CPU stream the specs and
+    comparisons run there and the kernel on `mx.gpu`. Without Metal the
+    kernels are not dispatched, but the specs still run and are checked
+    against the output shapes: problems whose spec works are yielded with
+    `passed` None.
+    """
+    if mx is None:
+        for problem in problems:
+            yield problem, None, "Metal is not available"
+        return
+
+    metal = mx.metal.is_available()
+    streams = streams or [mx.new_stream(mx.default_device())]
+    pending = [[] for _ in streams]
+    for i, problem in enumerate(problems):
+        stream = streams[i % len(streams)]
+        try:
+            problem.metalKernel = problem.fn(*problem.inputs)
+            with mx.stream(stream):
+                ys = problem.spec(*[as_mx(x) for x in problem.inputs])
+                if not isinstance(ys, tuple):
+                    ys = (ys,)
+                assert len(ys) == len(problem.output_shapes), (
+                    f"Kernel has {len(problem.output_shapes)} outputs but spec returned {len(ys)}"
+                )
+                ys = [y.reshape(shape) for y, shape in zip(ys, problem.output_shapes)]
+                if metal:
+                    xs = problem.run_metal(stream if stream.device == mx.gpu else None)
+                    xs = xs if isinstance(xs, tuple) else (xs,)
+                    work = [mx.allclose(x, y, **tolerance(x.dtype)) for x, y in zip(xs, ys)]
+                else:
+                    work = ys
+        except Exception as e:
+            yield problem, False, f"{type(e).__name__}: {e}"
+            continue
+        pending[i % len(streams)].append((problem, work))
+
+    mx.async_eval(*[a for work in pending for _, arrays in work for a in arrays])
+
+    # Each stream finishes its work in order, so one waiter per stream
+    # hands back every problem as soon as it is done.
+    done = queue.Queue()
+
+    def wait(work):
+        for problem, arrays in work:
+            try:
+                mx.eval(arrays)
+                if not metal:
+                    done.put((problem, None, "Metal is not available"))
+                    continue
+                failed = [name for name, c in zip(problem.metalKernel.output_names, arrays) if not c.item()]
+                done.put((problem, not failed, failed))
+            except Exception as e:
+                done.put((problem, False, f"{type(e).__name__}: {e}"))
+
+    with ThreadPoolExecutor(len(streams)) as pool:
+        for work in pending:
+            pool.submit(wait, work)
+        for _ in range(sum(len(work) for work in pending)):
+            yield done.get()
+
+def tolerance(dtype):
+    """`rtol`/`atol` for comparing results of the given MLX or NumPy dtype."""
+    if mx is not None and isinstance(dtype, mx.Dtype):
+        name = str(dtype).split(".")[-1]
+    else:
+        name = np.dtype(dtype).name
+    if name == "bfloat16":
+        return {"rtol": 1e-2, "atol": 1e-2}
+    if name == "float16":
+        return {"rtol": 1e-3, "atol": 1e-3}
+    if name.startswith("float"):
+        return {"rtol": 1e-5, "atol": 1e-8}
+    return {"rtol": 0, "atol": 0}
+
+def convert_source_to_py(source, line_map=None):
+    """Transpile Metal `source` to Python.
+
+    If `line_map` is a list, the (1-based) source line of each output line
+    is appended to it. `preprocess_source` keeps lines where they are.
+    """
     metal_source = preprocess_source(source)
 
     output_lines = []
+    source_lines = []
     incr_stack = []
     indent_level = 0
     statement = False
     lines = metal_source.splitlines()
-    for line in lines:
+    for number, line in enumerate(lines, 1):
         line = line.strip()
 
         if line.count("}") > 0 and line.count("{") > 0:
@@ -175,7 +1780,8 @@ def convert_source_to_py(source):
                 if incr_stack:
                     incr_indent_level, incr_line = incr_stack[-1]
                     if incr_indent_level == indent_level + 1:
-                        output_lines.append(incr_line)
+                        output_lines.append(incr_line[1])
+                        source_lines.append(incr_line[0])
                         incr_stack.pop()
                 continue
 
@@ -202,6 +1808,7 @@ def convert_source_to_py(source):
 
             output_lines.append('    ' * (indent_level-1) + init)
             output_lines.append('    ' * (indent_level-1) + "while " + cond + ":")
+            source_lines += [number, number]
 
             if '++' in incr:
                 incr = re.sub(r'(\+\+)(\w+)', r'\2 += 1', incr)
@@ -213,7 +1820,7 @@ def convert_source_to_py(source):
                 incr = re.sub(r'\s*(.*?)\s*/=\s*(.*)', r'\1 = int(\1 / \2)', incr)
 
             incr_line = '    ' * indent_level + incr
-            incr_stack.append((indent_level, incr_line))
+            incr_stack.append((indent_level, (number, incr_line)))
             continue
 
         if not statement:
@@ -222,17 +1829,50 @@ def convert_source_to_py(source):
         else:
             line = '    ' * (indent_level-1) + line
         output_lines.append(line)
+        source_lines.append(number)
         statement = False
 
+    if line_map is not None:
+        line_map.extend(source_lines)
     return '\n'.join(output_lines)
 
+# Scalar Metal types and their size in bytes.
+METAL_TYPES = {
+    "bool": 1, "char": 1, "uchar": 1, "int8_t": 1, "uint8_t": 1,
+    "short": 2, "ushort": 2, "int16_t": 2, "uint16_t": 2, "half": 2, "bfloat": 2,
+    "int": 4, "uint": 4, "int32_t": 4, "uint32_t": 4, "float": 4,
+    "long": 8, "ulong": 8, "int64_t": 8, "uint64_t": 8, "size_t": 8, "double": 8,
+}
+TYPES = "|".join(METAL_TYPES)
+
 def preprocess_source(source):
     source = re.sub(r'//.*', '', source)
-    source = re.sub(r'threadgroup float (\w+)\[(\w+)\]\[(\w+)\];', r'\1 = metal.threadgroupMemory.array((\2, \3))', source)
-    source = re.sub(r'threadgroup float (\w+)\[(\w+)\];', r'\1 = metal.threadgroupMemory.array(\2)', source)
+    source = re.sub(rf'threadgroup (?:atomic_)?({TYPES}) (\w+)\[(\w+)\]\[(\w+)\];', r'\2 = metal.threadgroupMemory.array((\3, \4), "\1")', source)
+    source = re.sub(rf'threadgroup (?:atomic_)?({TYPES}) (\w+)\[(\w+)\];', r'\2 = metal.threadgroupMemory.array(\3, "\1")', source)
     source = re.sub(r'threadgroup_barrier\(mem_flags::mem_threadgroup\);', 'metal.syncthreads()', source)
+    source = re.sub(
+        r'simdgroup_(float|half|bfloat)8x8\s+(\w+)\s*(=\s*make_filled_simdgroup_matrix<[^>]*>\([^)]*\))?\s*;',
+        r'\2 = metal.simdgroup_matrix("\1")', source,
+    )
+    source = re.sub(r'\b(simd_\w+|simdgroup_(load|store|multiply_accumulate|multiply))\s*\(', r'metal.\1(', source)
+    source = re.sub(r'\batomic_(\w+)_explicit\s*\(', r'metal.atomic_\1(', source)
+    source = re.sub(r',\s*memory_order_\w+', '', source)
+    source = re.sub(r'(?<![\w.])((?:\d+\.\d*|\.\d+)(?:[eE][-+]?\d+)?|\d+[eE][-+]?\d+)[fFhH]\b', r'\1', source)
+    # Vector types: pointer casts become vector views of a table, and
+    # `floatN(...)` constructors build a Vector.
+    source = re.sub(r'\b(device|threadgroup|constant)\s+(const\s+)?\w+\s*\*\s*(\w+)\s*=', r'\3 =', source)
+    source = re.sub(rf'reinterpret_cast<\s*(device|threadgroup|constant)?\s*(const\s+)?({TYPES})([234])\s*\*\s*>\s*\(([^()]*)\)', r'(\5).vec(\4)', source)
+    source = re.sub(rf'\(\s*(device|threadgroup|constant)\s+(const\s+)?({TYPES})([234])\s*\*\s*\)\s*(\w+)', r'\5.vec(\4)', source)
+    source = re.sub(rf'\b({TYPES})([234])\s*\(', r'metal.vector(\2, ', source)
+    # `&x[i]` passed to an intrinsic becomes a pointer into table `x`.
+    source = re.sub(r'(?<=[(,])(\s*)&\s*(\w+)\[([^\]]*)\]', r'\1\2.ptr(\3)', source)
     source = re.sub(r'metal::', '', source)
-    source = re.sub(r'\b(uint|int|float|double|auto|constant)\b', '', source)
+    # Casts don't change what is read or written, so drop them.
+    source = re.sub(r'static_cast<\s*(\w+)\s*>', '', source)
+    source = re.sub(rf'\(\s*(const\s+)?({TYPES})\s*\)(?=\s*[\w(])', '', source)
+    # Type names go only where they declare something or cast a value, so
+    # variables named `half` or `long` are left alone.
+    source = re.sub(rf'(?<!")\b(atomic_)?({TYPES}|auto|const|constant)([234])?(?:\s+(?=[A-Za-z_])|\s*(?=\())', '', source)
     source = re.sub(r'\s*(\]\[)', ', ', source)
     source = source.replace('&&', 'and')
     source = source.replace('||', 'or')
@@ -241,7 +1881,11 @@ def preprocess_source(source):
         ('thread_position_in_grid', 'metal.thread_position_in_grid'),
         ('threadgroup_position_in_grid', 'metal.threadgroup_position_in_grid'),
         ('threads_per_threadgroup', 'metal.threads_per_threadgroup'),
-        ('thread_position_in_threadgroup', 'metal.thread_position_in_threadgroup')
+        ('thread_position_in_threadgroup', 'metal.thread_position_in_threadgroup'),
+        (r'\bthread_index_in_threadgroup\b', 'metal.thread_index_in_threadgroup'),
+        (r'\bthread_index_in_simdgroup\b', 'metal.thread_index_in_simdgroup'),
+        (r'\bsimdgroup_index_in_threadgroup\b', 'metal.simdgroup_index_in_threadgroup'),
+        (r'\bthreads_per_simdgroup\b', 'metal.threads_per_simdgroup'),
     ]
     for old, new in replacements:
         source = re.sub(old, new, source)
@@ -249,10 +1893,12 @@ def preprocess_source(source):
     return source 
 
 
+
 @dataclass
 class ScalarHistory:
     last_fn: str
     inputs: list
+    txn: Any = None
 
     def __radd__(self, b):
         return self + b
@@ -265,18 +1911,29 @@ class ScalarHistory:
         if isinstance(b, ScalarHistory):
             return ScalarHistory(self.last_fn, self.inputs + b.inputs)
         return NotImplemented
+
+    __mul__ = __add__
+    __rmul__ = __radd__
         
 class Scalar:
-    def __init__(self, location):
+    __slots__ = ("location", "txn")
+
+    def __init__(self, location, txn=None):
         self.location = location
+        self.txn = txn
 
     def __mul__(self, b):
         if isinstance(b, (float, int)):
             return ScalarHistory("id", [self])
         if isinstance(b, Scalar):
             return ScalarHistory("*", [self, b])
+        if isinstance(b, ScalarHistory):
+            return ScalarHistory("*", [self] + b.inputs)
         return NotImplemented
 
+    def __rmul__(self, b):
+        return self * b
+
     def __radd__(self, b):
         return self + b
         
@@ -289,35 +1946,171 @@ class Scalar:
             return ScalarHistory("+", [self] + b.inputs)
         return NotImplemented
     
+class Vector:
+    """A `floatN`/`halfN` value, one symbolic value per component."""
+    def __init__(self, values):
+        self.values = list(values)
+
+    def __getitem__(self, k):
+        return self.values[k]
+
+    def __len__(self):
+        return len(self.values)
+
+    def __getattr__(self, name):
+        # Swizzles: `v.x`, `v.xy`, `v.rgba`, ...
+        fields = "xyzw" if set(name) <= set("xyzw") else "rgba"
+        if not name or not set(name) <= set(fields):
+            raise AttributeError(name)
+        values = [self.values[fields.index(c)] for c in name]
+        return values[0] if len(values) == 1 else Vector(values)
+
+    def _map(self, b, op):
+        if isinstance(b, Vector):
+            return Vector(op(x, y) for x, y in zip(self.values, b.values))
+        return Vector(op(x, b) for x in self.values)
+
+    def __add__(self, b):
+        return self._map(b, lambda x, y: x + y)
+
+    def __radd__(self, b):
+        return self._map(b, lambda x, y: y + x)
+
+    def __mul__(self, b):
+        return self._map(b, lambda x, y: x * y)
+
+    def __rmul__(self, b):
+        return self._map(b, lambda x, y: y * x)
+
+# Each vector load or store is one memory transaction, however many
+# elements it moves.
+transactions = itertools.count()
+
+class VectorView:
+    """`reinterpret_cast<device floatN*>(x)`: `x` seen as an array of vectors."""
+    def __init__(self, target, n):
+        self.target = target
+        self.n = n
+
+    def __getitem__(self, index):
+        txn = next(transactions)
+        values = [self.target[index * self.n + k] for k in range(self.n)]
+        for v in values:
+            v.txn = txn
+        return Vector(values)
+
+    def __setitem__(self, index, val):
+        txn = next(transactions)
+        for k in range(self.n):
+            v = val[k] if isinstance(val, Vector) else val
+            if isinstance(v, Scalar):
+                v = ScalarHistory("id", [v])
+            if isinstance(v, ScalarHistory):
+                v = ScalarHistory(v.last_fn, v.inputs, txn)
+            self.target[index * self.n + k] = v
+
+def itemsize(dtype):
+    """Size in bytes of an MLX or NumPy dtype, or a Metal scalar type name."""
+    if isinstance(dtype, str) and dtype in METAL_TYPES:
+        return METAL_TYPES[dtype]
+    if mx is not None and isinstance(dtype, mx.Dtype):
+        return dtype.size
+    return np.dtype(dtype).itemsize
+
 class Table:
-    def __init__(self, name, array):
+    def __init__(self, name, size, memory=None, dtype="float"):
         self.name = name
         self.incoming = []
-        self.array = array
-
-        self.size = array.shape
+        self.reads = []
+        self.atomics = []
+        # Ids of the `reads` and `incoming` entries made by atomic ops.
+        self.atomic_entries = set()
+        # Position of each `reads` and `incoming` entry in the threadgroup's
+        # sequence of accesses, which follows each thread's program order.
+        self.read_order = []
+        self.incoming_order = []
+        self.memory = memory
+        self.dtype = dtype
+        self.itemsize = itemsize(dtype)
+
+        self.size = tuple(size)
     
     def __getitem__(self, index):
+        size = self.size
         if isinstance(index, int):
-            index = (index // self.size[1], index % self.size[1]) if len(self.size) == 2 else (index,)
-        assert len(index) == len(self.size), "Wrong number of indices"
-        if index[0] >= self.size[0]:
-            assert False, "bad size"
+            index = divmod(index, size[1]) if len(size) == 2 else (index,)
+        else:
+            assert len(index) == len(size), "Wrong number of indices"
+        assert index[0] < size[0], "bad size"
 
+        metal = self.memory.metal
+        self.reads.append((index, metal.thread_index_in_threadgroup, metal.round))
+        self.read_order.append(next(self.memory.order))
         return Scalar((self.name,) + index)
 
     def __setitem__(self, index, val):
+        size = self.size
         if isinstance(index, int):
-            index = (index // self.size[1], index % self.size[1]) if len(self.size) == 2 else (index,)
-        assert len(index) == len(self.size), "Wrong number of indices"
-        if index[0] >= self.size[0]:
-            assert False, "bad size"
+            index = divmod(index, size[1]) if len(size) == 2 else (index,)
+        else:
+            assert len(index) == len(size), "Wrong number of indices"
+        assert index[0] < size[0], "bad size"
         if isinstance(val, Scalar):
             val = ScalarHistory("id", [val])
         if isinstance(val, (float, int)):
             return
         assert isinstance(val, ScalarHistory), "Assigning an unrecognized value"
-        self.incoming.append((index, val))
+        metal = self.memory.metal
+        self.incoming.append((index, val, metal.thread_index_in_threadgroup, metal.round))
+        self.incoming_order.append(next(self.memory.order))
+
+    def __add__(self, offset):
+        return Pointer(self, offset)
+
+    def vec(self, n):
+        return VectorView(self, n)
+
+    def atomic(self, index, op, value=None, dest=None):
+        """Atomic read-modify-write of one cell, returning the old value.
+
+        `dest` is the table the new value is written to, if not this one.
+        """
+        target = self if dest is None else dest
+        reads, writes = len(self.reads), len(target.incoming)
+        old = None if op == "store" else self[index]
+        if op != "load":
+            target[index] = value if op in ("store", "exchange") else old + value
+        self.atomic_entries.update(map(id, self.reads[reads:]))
+        target.atomic_entries.update(map(id, target.incoming[writes:]))
+        if isinstance(index, int):
+            index = (index // self.size[1], index % self.size[1]) if len(self.size) == 2 else (index,)
+        metal = self.memory.metal
+        self.atomics.append((index, op, metal.thread_index_in_threadgroup, metal.round))
+        return old
+
+    def ptr(self, *index):
+        offset = 0
+        for i, d in zip(index, self.size):
+            offset = offset * d + i
+        return Pointer(self, offset)
+
+class Pointer:
+    """`table + offset`, as passed to the simdgroup matrix intrinsics."""
+    def __init__(self, target, offset):
+        self.target = target
+        self.offset = offset
+
+    def __add__(self, offset):
+        return Pointer(self.target, self.offset + offset)
+
+    def __getitem__(self, index):
+        return self.target[self.offset + index]
+
+    def __setitem__(self, index, val):
+        self.target[self.offset + index] = val
+
+    def vec(self, n):
+        return VectorView(self, n)
 
 @dataclass(frozen=True, eq=True)
 class Coord:
@@ -335,30 +2128,80 @@ class Coord:
         return (self.x, self.y)
 
 class RefList:
-    def __init__(self):
-        self.refs = []
+    """A threadgroup array, with one `Table` per barrier round.
+
+    Reads in round `r` come from `refs[r]`, and writes made in round `r`
+    land on `refs[r + 1]`, the table every thread sees after the barrier.
+    """
+    def __init__(self, name, size, memory, dtype):
+        self.memory = memory
+        self.refs = [Table(name, size, memory, dtype)]
+
+    def round(self, r):
+        refs = self.refs
+        if r < len(refs):
+            return refs[r]
+        while len(refs) <= r:
+            last = refs[-1]
+            refs.append(Table(last.name + "'", last.size, self.memory, last.dtype))
+        return refs[r]
         
     def __getitem__(self, index):
-        return self.refs[-1][index]
+        return self.round(self.memory.metal.round)[index]
 
     def __setitem__(self, index, val):
-        self.refs[-1][index] = val
+        self.round(self.memory.metal.round + 1)[index] = val
+
+    def __add__(self, offset):
+        return Pointer(self, offset)
+
+    def vec(self, n):
+        return VectorView(self, n)
+
+    def atomic(self, index, op, value=None):
+        r = self.memory.metal.round
+        return self.round(r).atomic(index, op, value, dest=self.round(r + 1))
+
+    def ptr(self, *index):
+        return Pointer(self, self.refs[0].ptr(*index).offset)
 
 
 class ThreadgroupMemory:
-    def __init__(self, metal):
-        self.metal = metal
+    """Trace store shared by every thread of a threadgroup.
+
+    Threads are simulated one after another; `metal` is the thread that
+    is currently running, and is used to tag each access with its thread
+    and barrier round.
+    """
+    def __init__(self):
+        self.metal = None
+        self.caches = []
+        self.registers = []
+        self.register_keys = {}
+        # Numbers the accesses to tables; see `Table.read_order`.
+        self.order = itertools.count()
 
-    def array(self, size):
+    def array(self, size, dtype="float"):
         if isinstance(size, int):
             size = (size,)
-        s = mx.zeros(size)
-        cache = Table("S" + str(len(self.metal.caches)), s)
-        # self.caches.append(cache)
-        self.metal.caches.append(RefList())
-        self.metal.caches[-1].refs = [cache]
-        self.metal.saved.append([])
-        return self.metal.caches[-1]
+        # The k-th declaration of every thread refers to the same array.
+        k = len(self.metal.caches)
+        if k == len(self.caches):
+            self.caches.append(RefList("S" + str(k), size, self, dtype))
+        self.metal.caches.append(self.caches[k])
+        return self.caches[k]
+
+    def register(self, name, key, size):
+        """Table standing in for the SIMD-group registers identified by `key`.
+
+        Every thread asking for the same `key` gets the same table, named
+        `name` and a number in the order the tables were first used.
+        """
+        if (name, key) not in self.register_keys:
+            k = sum(1 for n, _ in self.register_keys if n == name)
+            self.registers.append(Table(name + str(k), size, self))
+            self.register_keys[name, key] = self.registers[-1]
+        return self.register_keys[name, key]
 
 
 class Metal:
@@ -366,6 +2209,10 @@ class Metal:
     threads_per_threadgroup: Coord
     thread_position_in_threadgroup: Coord
     thread_position_in_grid: Coord
+    thread_index_in_threadgroup: int
+    thread_index_in_simdgroup: int
+    simdgroup_index_in_threadgroup: int
+    threads_per_simdgroup: int = 32
     caches: list
     threadgroupMemory: ThreadgroupMemory
 
@@ -374,39 +2221,1142 @@ class Metal:
         threadgroup_position_in_grid,
         threads_per_threadgroup,
         thread_position_in_threadgroup,
-        thread_position_in_grid
+        thread_position_in_grid,
+        thread_index_in_threadgroup,
+        threadgroupMemory,
     ):
         self.threadgroup_position_in_grid = threadgroup_position_in_grid
         self.threads_per_threadgroup = threads_per_threadgroup
         self.thread_position_in_threadgroup = thread_position_in_threadgroup
         self.thread_position_in_grid = thread_position_in_grid
+        self.thread_index_in_threadgroup = thread_index_in_threadgroup
+        self.thread_index_in_simdgroup = thread_index_in_threadgroup % self.threads_per_simdgroup
+        self.simdgroup_index_in_threadgroup = thread_index_in_threadgroup // self.threads_per_simdgroup
         self.caches = []
-        self.threadgroupMemory = ThreadgroupMemory(self)
-        self.saved = []
+        self.threadgroupMemory = threadgroupMemory
+        self.round = 0
+        self.barriers = []
+        self.exchanges = Counter()
+        self.lane_faults = []
+        # Inputs already charged to an exchange, by id.
+        self.exchanged = {}
+        self.matrices = 0
+        self.branches = []
+        self.visits = Counter()
+
+    def branch(self, k, label, taken, orelse=False):
+        """Record whether this thread takes branch `k`, and return it.
+
+        SIMD lanes run in lockstep, so the n-th time each lane reaches a
+        branch in a barrier round is the same execution of it.
+        """
+        taken = bool(taken)
+        n = self.visits[k, self.round]
+        self.visits[k, self.round] = n + 1
+        self.branches.append((k, label, orelse, self.round, n, taken))
+        return taken
 
     def syncthreads(self):
-        for i, c in enumerate(self.caches):
-            old_cache = c.refs[-1]
-            # self_links = cache.self_links()
-            # cache.clean()
-            temp = old_cache.incoming
-            old_cache.incoming = self.saved[i]
-            self.saved[i] = temp
-            cache = Table(old_cache.name + "'", old_cache.array)
-
-            c.refs.append(cache)
-
-    def finish(self):
-        for i, c in enumerate(self.caches):
-            old_cache = c.refs[-1]
-            old_cache.incoming = self.saved[i]
+        # Remember which barrier was reached, to spot divergent barriers.
+        self.barriers.append(sys._getframe(1).f_lineno)
+        self.round += 1
+
+    def vector(self, n, *args):
+        """`floatN(...)`: broadcast one value or concatenate the arguments."""
+        if len(args) == 1 and not isinstance(args[0], Vector):
+            return Vector(args * n)
+        values = [v for a in args for v in (a.values if isinstance(a, Vector) else [a])]
+        assert len(values) == n, f"Wrong number of components for a vector of {n}"
+        return Vector(values)
 
     def rounds(self):
         if len(self.caches) > 0:
-            return len(self.caches[0].refs)
+            # Arrays only grow a table for the rounds they are used in.
+            n = max(len(c.refs) for c in self.caches)
+            for c in self.caches:
+                c.round(n - 1)
+            return n
         else:
             return 0
 
+    # SIMD groups. Every cross-lane operation goes through a register
+    # table `R<k>`, indexed by thread, that each lane writes its value to
+    # and reads the other lanes' values from. Lanes run in lockstep, so the
+    # n-th time the lanes reach one call site in a barrier round they take
+    # part in the same exchange, whatever they did on other paths.
+
+    @staticmethod
+    def call_site():
+        """The kernel frame's current call: its code and bytecode offset."""
+        frame = sys._getframe(2)
+        while frame.f_code.co_filename != "<metal>":
+            frame = frame.f_back
+        return frame.f_code, frame.f_lasti
+
+    def simd_lanes(self):
+        """Thread indices of the lanes in this thread's SIMD group."""
+        first = self.simdgroup_index_in_threadgroup * self.threads_per_simdgroup
+        threads = self.threads_per_threadgroup.x * self.threads_per_threadgroup.y
+        return range(first, min(first + self.threads_per_simdgroup, threads))
+
+    def simd_exchange(self, value):
+        threads = self.threads_per_threadgroup.x * self.threads_per_threadgroup.y
+        site = self.call_site()
+        n = self.exchanges[site, self.round]
+        self.exchanges[site, self.round] = n + 1
+        # Each SIMD group uses its own lanes' slots of the table.
+        reg = self.threadgroupMemory.register("R", (site, self.round, n), (threads,))
+        # The lane's value stays in its register between exchanges, so only
+        # the inputs new since its last exchange are charged to this one.
+        if isinstance(value, Scalar):
+            value = ScalarHistory("id", [value])
+        if isinstance(value, ScalarHistory):
+            fresh = [ins for ins in value.inputs if id(ins) not in self.exchanged]
+            self.exchanged.update((id(ins), ins) for ins in fresh)
+            value = ScalarHistory("simd", fresh, value.txn)
+        reg[self.thread_index_in_threadgroup] = value
+        return reg
+
+    def simd_lane(self, value, lane, shift=False):
+        """`value` as held by lane `lane` of this thread's SIMD group.
+
+        A shift (`simd_shuffle_up`/`down`) past either end of the SIMD group
+        keeps the lane's own value, as Metal specifies. Any other read of a
+        lane outside the group, or of an inactive lane of a partial group,
+        is undefined on hardware: it reads the lane's own value here and is
+        recorded in `lane_faults` for `find_hazards`.
+        """
+        reg = self.simd_exchange(value)
+        lanes = self.simd_lanes()
+        if not 0 <= lane < len(lanes):
+            if not shift or 0 <= lane < self.threads_per_simdgroup:
+                self.lane_faults.append((lane, len(lanes)))
+            lane = self.thread_index_in_simdgroup
+        return reg[lanes[lane]]
+
+    def simd_reduce(self, value, lanes=None):
+        reg = self.simd_exchange(value)
+        lanes = self.simd_lanes() if lanes is None else lanes
+        if len(lanes) == 0:
+            return 0
+        return ScalarHistory("simd", [reg[t] for t in lanes])
+
+    def simd_sum(self, value):
+        return self.simd_reduce(value)
+
+    simd_product = simd_max = simd_min = simd_and = simd_or = simd_xor = simd_sum
+
+    def simd_prefix_inclusive_sum(self, value):
+        lanes = self.simd_lanes()
+        return self.simd_reduce(value, lanes[: self.thread_index_in_simdgroup + 1])
+
+    def simd_prefix_exclusive_sum(self, value):
+        lanes = self.simd_lanes()
+        return self.simd_reduce(value, lanes[: self.thread_index_in_simdgroup])
+
+    simd_prefix_inclusive_product = simd_prefix_inclusive_sum
+    simd_prefix_exclusive_product = simd_prefix_exclusive_sum
+
+    def simd_shuffle(self, value, lane):
+        return self.simd_lane(value, lane)
+
+    simd_broadcast = simd_shuffle
+
+    def simd_broadcast_first(self, value):
+        return self.simd_lane(value, 0)
+
+    def simd_shuffle_down(self, value, delta):
+        return self.simd_lane(value, self.thread_index_in_simdgroup + delta, shift=True)
+
+    def simd_shuffle_up(self, value, delta):
+        return self.simd_lane(value, self.thread_index_in_simdgroup - delta, shift=True)
+
+    def simd_shuffle_xor(self, value, mask):
+        return self.simd_lane(value, self.thread_index_in_simdgroup ^ mask)
+
+    # simdgroup 8x8 matrices. Matrix `M<j>` holds every SIMD group's copy
+    # of the j-th matrix declared; lane `l` owns elements `2l` and `2l + 1`.
+
+    def simdgroup_matrix(self, dtype="float"):
+        groups = -(-self.threads_per_threadgroup.x * self.threads_per_threadgroup.y // self.threads_per_simdgroup)
+        reg = self.threadgroupMemory.register("M", self.matrices, (groups, 8, 8))
+        self.matrices += 1
+        return reg
+
+    def matrix_elements(self):
+        lane = self.thread_index_in_simdgroup
+        return [divmod(e, 8) for e in (2 * lane, 2 * lane + 1)]
+
+    def simdgroup_load(self, matrix, src, stride=8, origin=(0, 0), transpose=False):
+        sg = self.simdgroup_index_in_threadgroup
+        for r, c in self.matrix_elements():
+            rr, cc = (c, r) if transpose else (r, c)
+            matrix[sg, r, c] = src[(origin[1] + rr) * stride + origin[0] + cc]
+
+    def simdgroup_store(self, matrix, dst, stride=8, origin=(0, 0), transpose=False):
+        sg = self.simdgroup_index_in_threadgroup
+        for r, c in self.matrix_elements():
+            rr, cc = (c, r) if transpose else (r, c)
+            dst[(origin[1] + rr) * stride + origin[0] + cc] = matrix[sg, r, c]
+
+    def simdgroup_multiply_accumulate(self, d, a, b, c=None):
+        sg = self.simdgroup_index_in_threadgroup
+        # Read everything before writing, since `d` may also be `c`.
+        values = []
+        for r, col in self.matrix_elements():
+            inputs = [a[sg, r, k] * b[sg, k, col] for k in range(8)]
+            if c is not None:
+                inputs.append(c[sg, r, col])
+            values.append(sum(inputs, ScalarHistory("simdgroup", [])))
+        for (r, col), value in zip(self.matrix_elements(), values):
+            d[sg, r, col] = value
+
+    def simdgroup_multiply(self, d, a, b):
+        self.simdgroup_multiply_accumulate(d, a, b)
+
+    # Atomics on device (`atomic_outputs=True`) or threadgroup memory.
+
+    def atomic(self, ptr, op, value=None):
+        if not isinstance(ptr, Pointer):
+            ptr = Pointer(ptr, 0)
+        return ptr.target.atomic(ptr.offset, op, value)
+
+    def atomic_fetch_add(self, ptr, value):
+        return self.atomic(ptr, "add", value)
+
+    def atomic_fetch_sub(self, ptr, value):
+        return self.atomic(ptr, "sub", value)
+
+    def atomic_fetch_min(self, ptr, value):
+        return self.atomic(ptr, "min", value)
+
+    def atomic_fetch_max(self, ptr, value):
+        return self.atomic(ptr, "max", value)
+
+    def atomic_fetch_and(self, ptr, value):
+        return self.atomic(ptr, "and", value)
+
+    def atomic_fetch_or(self, ptr, value):
+        return self.atomic(ptr, "or", value)
+
+    def atomic_fetch_xor(self, ptr, value):
+        return self.atomic(ptr, "xor", value)
+
+    def atomic_exchange(self, ptr, value):
+        return self.atomic(ptr, "exchange", value)
+
+    def atomic_load(self, ptr):
+        return self.atomic(ptr, "load")
+
+    def atomic_store(self, ptr, value):
+        self.atomic(ptr, "store", value)
+
+
+class LineProfile:
+    """Execution and access counts of each kernel source line, over every
+    simulated thread.
+
+    `lines` maps lines of `kernel.source` (1-based) to Counters of `execs`
+    and of `global_reads`, `global_writes`, `shared_reads` and
+    `shared_writes` made by that line. Pass it to `run_python`.
+
+    The profiled kernel is not specialized, so no statement is folded away
+    or unrolled, and a call before each statement and inside each test
+    counts the line and charges the accesses that follow to it. A loop
+    header counts every check of its condition.
+    """
+    KEYS = ["global_reads", "global_writes", "shared_reads", "shared_writes"]
+
+    def __init__(self, kernel):
+        self.kernel = kernel
+        # The header comes first; its lines are not part of the listing.
+        self.offset = kernel.header.count("\n")
+        self.line_map = []
+        tree = ast.parse(convert_source_to_py(kernel.header + kernel.source, self.line_map), "<metal>")
+        self.body = self.instrument(tree.body)
+        self.lines = {}
+
+    def source_line(self, node):
+        return self.line_map[node.lineno - 1] - self.offset
+
+    def call(self, line, count, node):
+        return ast.copy_location(
+            ast.Call(ast.Name("__line__", ast.Load()), [ast.Constant(line), ast.Constant(count)], []), node
+        )
+
+    def instrument(self, body, loop=None):
+        """Mark each statement of `body` with its line.
+
+        A transpiled `for` loop is its init, a `while` and an increment at
+        the end of the body, all on the `for` line; only the checks of the
+        `while` count as executions of that line.
+        """
+        loops = {self.source_line(stmt) for stmt in body if isinstance(stmt, ast.While)}
+        out = []
+        for stmt in body:
+            line = self.source_line(stmt)
+            if isinstance(stmt, (ast.If, ast.While)):
+                stmt.test = ast.BoolOp(ast.Or(), [self.call(line, True, stmt), stmt.test])
+            else:
+                out.append(ast.Expr(self.call(line, line not in loops and line != loop, stmt)))
+            if hasattr(stmt, "body"):
+                stmt.body = self.instrument(stmt.body, line if isinstance(stmt, ast.While) else loop)
+            if getattr(stmt, "orelse", None):
+                stmt.orelse = self.instrument(stmt.orelse, loop)
+            out.append(stmt)
+        return out
+
+    def function(self, constants, params):
+        """The instrumented kernel, called like `compile_specialized`'s."""
+        kernel = kernel_function(copy.deepcopy(self.body), {**dict(constants), "__line__": self.line}, params)
+
+        def run(metal, *tables):
+            self.memory, self.tables = metal.threadgroupMemory, tables
+            self.current, self.last = None, self.totals()
+            kernel(metal, *tables)
+            self.line(None, False)
+
+        return run
+
+    def totals(self):
+        shared = [t for c in self.memory.caches for t in c.refs]
+        return (
+            sum(len(t.reads) for t in self.tables),
+            sum(len(t.incoming) for t in self.tables),
+            sum(len(t.reads) for t in shared),
+            sum(len(t.incoming) for t in shared),
+        )
+
+    def line(self, line, count=True):
+        # Accesses since the last call were made by the previous line.
+        now = self.totals()
+        if self.current is not None:
+            counts = self.lines[self.current]
+            for key, a, b in zip(self.KEYS, now, self.last):
+                counts[key] += a - b
+        self.last, self.current = now, line
+        if line is not None:
+            self.lines.setdefault(line, Counter())["execs"] += count
+
+    def annotate(self):
+        """The kernel source with each line's counts, hottest lines marked."""
+        execs = sum(c["execs"] for c in self.lines.values()) or 1
+        rows = [f"   {'Execs':>8} {'%':>6} {'Glob R':>7} {'Glob W':>7} {'Shr R':>7} {'Shr W':>7}"]
+        hot = sorted(self.lines, key=lambda j: -self.lines[j]["execs"])[:3]
+        for j, text in enumerate(self.kernel.source.splitlines(), 1):
+            c = self.lines.get(j)
+            if c is None:
+                rows.append(f"   {'':>8} {'':>6} {'':>7} {'':>7} {'':>7} {'':>7}   : {j:>3}  {text}")
+                continue
+            counts = " ".join(f"{c[k]:>7}" for k in self.KEYS)
+            mark = "*" if j in hot else " "
+            rows.append(f"   {c['execs']:>8} {c['execs'] / execs:>6.1%} {counts} {mark} : {j:>3}  {text}")
+        return "\n".join(rows)
+
+@dataclass
+class Hazard:
+    """A problem `find_hazards` found; `threadgroup` is None for the whole grid."""
+    kind: str
+    threadgroup: Coord
+    message: str
+
+
+def ranges(values):
+    """Format sorted ints compactly, e.g. [0, 1, 2, 5] -> '0-2, 5'."""
+    spans = []
+    for v in values:
+        if spans and v == spans[-1][1] + 1:
+            spans[-1][1] = v
+        else:
+            spans.append([v, v])
+    return ", ".join(str(a) if a == b else f"{a}-{b}" for a, b in spans)
+
+
+def find_hazards(results, limit=10):
+    """Find data races on threadgroup memory, divergent barriers and
+    undefined SIMD lane reads.
+
+    Accesses are indexed by (array, cell, barrier round) in one pass over
+    the trace. A cell written by two threads in the same round, or read
+    by one thread while another writes it, is a race. Atomic accesses
+    don't race with each other, but a cell accessed both atomically and
+    plainly in one round is reported, as is a device cell accessed both
+    ways anywhere in the grid. A barrier that is
+    not reached by every thread of the threadgroup may hang on hardware.
+    At most `limit` races are reported per threadgroup.
+    """
+    hazards = []
+    # Device cells, over the whole grid: threadgroups can run in any order.
+    device = {}
+    for block, inner in results.items():
+        _, _, metal, _ = next(iter(inner.values()))
+
+        # Plain writers, plain readers and atomic users of each cell.
+        cells = {}
+        for k, c in enumerate(metal.caches):
+            for tab in c.refs:
+                for entry in tab.incoming:
+                    if id(entry) not in tab.atomic_entries:
+                        index, _, tt, rnd = entry
+                        cells.setdefault((k, index, rnd), (set(), set(), set()))[0].add(tt)
+                for entry in tab.reads:
+                    if id(entry) not in tab.atomic_entries:
+                        index, tt, rnd = entry
+                        cells.setdefault((k, index, rnd), (set(), set(), set()))[1].add(tt)
+                for index, _, tt, rnd in tab.atomics:
+                    cells.setdefault((k, index, rnd), (set(), set(), set()))[2].add(tt)
+
+        races = []
+        for (k, index, rnd), (writers, readers, atomic) in cells.items():
+            cell = f"{metal.caches[k].refs[0].name}{list(index)} in round {rnd}"
+            # Atomic accesses don't race with each other, only with plain ones.
+            if atomic and (writers or readers):
+                races.append(Hazard(
+                    "atomic-plain", block,
+                    f"atomic-plain race on {cell} of threadgroup {block.tuple()}: "
+                    f"threads {ranges(sorted(atomic))} access it atomically while threads "
+                    f"{ranges(sorted(writers | readers))} access it plainly",
+                ))
+            elif len(writers) > 1:
+                races.append(Hazard(
+                    "write-write", block,
+                    f"write-write race on {cell} of threadgroup {block.tuple()}: "
+                    f"threads {ranges(sorted(writers))} all write it",
+                ))
+            elif writers and readers - writers:
+                races.append(Hazard(
+                    "read-write", block,
+                    f"read-write race on {cell} of threadgroup {block.tuple()}: "
+                    f"thread {ranges(sorted(writers))} writes it while threads "
+                    f"{ranges(sorted(readers - writers))} read it",
+                ))
+        hazards += races[:limit]
+        if len(races) > limit:
+            hazards.append(Hazard(
+                "race", block,
+                f"... {len(races) - limit} more races in threadgroup {block.tuple()}",
+            ))
+
+        barriers = {}
+        for tt, _, m, _ in inner.values():
+            barriers.setdefault(tuple(m.barriers), []).append(tt)
+        if len(barriers) > 1:
+            groups = "; ".join(
+                f"threads {ranges(sorted(tts))} reach {len(b)}"
+                for b, tts in sorted(barriers.items(), key=lambda kv: min(kv[1]))
+            )
+            hazards.append(Hazard(
+                "barrier", block,
+                f"threadgroup_barrier is not reached by every thread of "
+                f"threadgroup {block.tuple()} ({groups}); this can hang on hardware",
+            ))
+
+        _, _, _, outs = next(iter(inner.values()))
+        for tab in outs:
+            for entry in tab.incoming:
+                if id(entry) not in tab.atomic_entries:
+                    device.setdefault((tab.name, entry[0]), (set(), set()))[0].add((block, entry[2]))
+            for entry in tab.reads:
+                if id(entry) not in tab.atomic_entries:
+                    device.setdefault((tab.name, entry[0]), (set(), set()))[0].add((block, entry[1]))
+            for index, _, tt, _ in tab.atomics:
+                device.setdefault((tab.name, index), (set(), set()))[1].add((block, tt))
+
+        faults = {}
+        for tt, _, m, _ in inner.values():
+            for fault in set(m.lane_faults):
+                faults.setdefault(fault, []).append(tt)
+        for (lane, active), tts in sorted(faults.items()):
+            hazards.append(Hazard(
+                "simd-lane", block,
+                f"threads {ranges(sorted(tts))} of threadgroup {block.tuple()} read lane {lane} "
+                f"of a SIMD group with {active} active lanes; the value is undefined",
+            ))
+
+    def threads(users):
+        blocks = {}
+        for block, tt in users:
+            blocks.setdefault(block.tuple(), []).append(tt)
+        return "; ".join(f"threads {ranges(sorted(tts))} of threadgroup {b}" for b, tts in sorted(blocks.items()))
+
+    mixed = [(cell, plain, atomic) for cell, (plain, atomic) in device.items() if plain and atomic]
+    for (name, index), plain, atomic in mixed[:limit]:
+        hazards.append(Hazard(
+            "atomic-plain", None,
+            f"atomic-plain race on {name}{list(index)}: {threads(atomic)} access it "
+            f"atomically while {threads(plain)} access it plainly",
+        ))
+    if len(mixed) > limit:
+        hazards.append(Hazard("race", None, f"... {len(mixed) - limit} more atomic-plain races on device memory"))
+    return hazards
+
+
+# Static analysis. Puzzle kernels index memory with affine functions of the
+# thread position, so rather than running every thread, `analyze_kernel`
+# interprets the transpiled kernel once per region of threads that take the
+# same path. A region is a product of an x and a y set of grid positions,
+# each kept as a bitset in a Python int.
+
+class Undecidable(Exception):
+    """The static analysis can't handle this kernel; simulate it instead."""
+
+
+class Lin:
+    """`sum(coef * var) + const` over the thread coordinates.
+
+    `lx`/`ly` are the position in the threadgroup and `bx`/`by` the
+    threadgroup position, so the x and y parts can be analyzed separately.
+    """
+    def __init__(self, coefs, const=0):
+        self.coefs = {v: c for v, c in coefs.items() if c != 0}
+        self.const = const
+
+    def dims(self):
+        return {v[1] for v in self.coefs}
+
+    def part(self, dim):
+        return Lin({v: c for v, c in self.coefs.items() if v[1] == dim})
+
+    def at(self, **values):
+        return sum(c * values[v] for v, c in self.coefs.items()) + self.const
+
+    def __add__(self, b):
+        if isinstance(b, Lin):
+            coefs = dict(self.coefs)
+            for v, c in b.coefs.items():
+                coefs[v] = coefs.get(v, 0) + c
+            return Lin(coefs, self.const + b.const)
+        if isinstance(b, (int, float)):
+            return Lin(self.coefs, self.const + b)
+        return NotImplemented
+
+    __radd__ = __add__
+
+    def __neg__(self):
+        return Lin({v: -c for v, c in self.coefs.items()}, -self.const)
+
+    def __sub__(self, b):
+        return self + (-b)
+
+    def __rsub__(self, b):
+        return (-self) + b
+
+    def __mul__(self, b):
+        if isinstance(b, (int, float)):
+            return Lin({v: c * b for v, c in self.coefs.items()}, self.const * b)
+        if isinstance(b, Lin):
+            raise Undecidable("product of two thread-dependent values")
+        return NotImplemented
+
+    __rmul__ = __mul__
+
+    def __mod__(self, m):
+        if isinstance(m, int):
+            return Mod(self, m)
+        raise Undecidable("modulo by a thread-dependent value")
+
+    def __eq__(self, b):
+        return isinstance(b, Lin) and (self.coefs, self.const) == (b.coefs, b.const)
+
+    def __hash__(self):
+        return hash((frozenset(self.coefs.items()), self.const))
+
+    def __repr__(self):
+        terms = [v if c == 1 else f"{c}*{v}" for v, c in sorted(self.coefs.items())]
+        if self.const or not terms:
+            terms.append(str(self.const))
+        return " + ".join(terms)
+
+
+@dataclass(frozen=True)
+class Mod:
+    """`lin % m`, which can only be compared."""
+    lin: Lin
+    m: int
+
+    def dims(self):
+        return self.lin.dims()
+
+    def at(self, **values):
+        return self.lin.at(**values) % self.m
+
+    def __repr__(self):
+        return f"({self.lin}) % {self.m}"
+
+
+@dataclass(frozen=True)
+class Data:
+    """A value computed from memory: how many elements of each table it was read from."""
+    reads: tuple  # sorted (table name, count) pairs
+
+    @staticmethod
+    def of(counts):
+        return Data(tuple(sorted(counts.items())))
+
+    def __add__(self, b):
+        if isinstance(b, Data):
+            counts = Counter(dict(self.reads))
+            counts.update(dict(b.reads))
+            return Data.of(counts)
+        if isinstance(b, (int, float, Lin)):
+            return self
+        return NotImplemented
+
+    __radd__ = __add__
+    __mul__ = __add__
+    __rmul__ = __add__
+
+
+@dataclass(frozen=True)
+class TableInfo:
+    name: str
+    size: tuple
+    kind: str  # "in", "out" or "shared"
+    itemsize: int
+
+
+@dataclass
+class Access:
+    """Every access of one table with one index expression in one barrier round."""
+    table: str
+    kind: str  # "read" or "write"
+    round: int
+    index: str
+    lo: Any
+    hi: Any
+    threads: int
+
+
+@dataclass
+class Analysis:
+    score: Score
+    accesses: list
+    out_of_bounds: list
+    simulated: bool = False
+    reason: str = ""
+
+
+class Region:
+    """Threads `xs` x `ys` (bitsets over grid positions) that took the same path.
+
+    `history` numbers the counts of the finished rounds, so that regions
+    can be compared without going through every round.
+    """
+    def __init__(self, xs, ys, env=None, round=0, counts=None, history=0):
+        self.xs = xs
+        self.ys = ys
+        self.env = env if env is not None else {}
+        self.round = round
+        self.counts = counts if counts is not None else {}
+        self.history = history
+
+    def copy(self, xs, ys):
+        # Finished rounds are never written again, so only the current one is copied.
+        counts = dict(self.counts)
+        if self.round in counts:
+            counts[self.round] = Counter(counts[self.round])
+        return Region(xs, ys, dict(self.env), self.round, counts, self.history)
+
+    def threads(self):
+        return self.xs.bit_count() * self.ys.bit_count()
+
+    def key(self):
+        return (
+            self.round,
+            self.history,
+            frozenset(self.env.items()),
+            frozenset(self.counts.get(self.round, Counter()).items()),
+        )
+
+
+METAL = object()
+COORDS = {
+    "thread_position_in_grid", "threadgroup_position_in_grid",
+    "thread_position_in_threadgroup", "threads_per_threadgroup",
+}
+BIN_OPS = {
+    ast.Add: operator.add, ast.Sub: operator.sub, ast.Mult: operator.mul,
+    ast.Div: operator.truediv, ast.FloorDiv: operator.floordiv, ast.Mod: operator.mod,
+    ast.LShift: operator.lshift, ast.RShift: operator.rshift,
+    ast.BitAnd: operator.and_, ast.BitOr: operator.or_, ast.BitXor: operator.xor,
+}
+CMP_OPS = {
+    ast.Lt: operator.lt, ast.LtE: operator.le, ast.Gt: operator.gt,
+    ast.GtE: operator.ge, ast.Eq: operator.eq, ast.NotEq: operator.ne,
+}
+MAX_STEPS = 100_000
+
+
+@lru_cache(maxsize=None)
+def parse_source(source):
+    return ast.parse(convert_source_to_py(source), "<metal>")
+
+
+class KernelAnalyzer:
+    def __init__(self, tables, shapes, threadsperblock, blockspergrid):
+        self.tables = tables
+        self.shapes = shapes
+        self.T = threadsperblock
+        self.B = blockspergrid
+        self.G = Coord(self.T.x * self.B.x, self.T.y * self.B.y)
+        self.full = {"x": (1 << self.G.x) - 1, "y": (1 << self.G.y) - 1}
+        self.declared = {}
+        self.masks = {}
+        self.accesses = {}
+        self.histories = {}
+        self.steps = 0
+
+    # Thread sets
+
+    def size(self, dim):
+        return (self.T.x, self.B.x) if dim == "x" else (self.T.y, self.B.y)
+
+    def mask(self, dim, test):
+        """Bitset of the positions along `dim` for which `test(l, b)` holds."""
+        t, b = self.size(dim)
+        left, op, right = test
+        lin = left - right if not isinstance(left, Mod) and not isinstance(right, Mod) else None
+        if lin is not None and isinstance(lin, Lin):
+            cl, cb = lin.coefs.get("l" + dim, 0), lin.coefs.get("b" + dim, 0)
+            if cb == cl * t or b == 1 or t == 1:
+                # Linear in the grid position, so the test holds on an interval
+                # (or all but one point): find its ends by bisection.
+                slope = cl if b == 1 else cb if t == 1 else cl
+                return self.interval_mask(slope, lin.const, op, t * b)
+        deps = {v[0] for side in (left, right) if not isinstance(side, (int, float)) for v in
+                (side.lin if isinstance(side, Mod) else side).coefs}
+        value = lambda side, l, k: side if isinstance(side, (int, float)) else side.at(**{"l" + dim: l, "b" + dim: k})
+        holds = lambda l, k: op(value(left, l, k), value(right, l, k))
+        if deps <= {"l"}:
+            block = "".join("1" if holds(l, 0) else "0" for l in reversed(range(t)))
+            return int(block * b, 2)
+        if deps <= {"b"}:
+            return int("".join(("1" if holds(0, k) else "0") * t for k in reversed(range(b))), 2)
+        return int("".join("1" if holds(g % t, g // t) else "0" for g in reversed(range(t * b))), 2)
+
+    @staticmethod
+    def interval_mask(slope, const, op, n):
+        """Bitset of the g in [0, n) with `op(slope * g + const, 0)`."""
+        full = (1 << n) - 1
+        if slope == 0:
+            return full if op(const, 0) else 0
+        if op in (operator.eq, operator.ne):
+            g = -const / slope
+            point = 1 << int(g) if g == int(g) and 0 <= g < n else 0
+            return point if op is operator.eq else full ^ point
+        f = lambda g: op(slope * g + const, 0)
+        first, last = f(0), f(n - 1)
+        if first == last:
+            return full if first else 0
+        # The test is monotone in g: find where it flips.
+        lo, hi = 0, n - 1
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if f(mid) == last:
+                hi = mid
+            else:
+                lo = mid + 1
+        below = (1 << lo) - 1
+        return below if first else full ^ below
+
+    def value_range(self, lin, dim, xs):
+        """Exact (min, max) of the `dim` part of `lin` over the positions in `xs`."""
+        part = lin.part(dim)
+        if not part.coefs:
+            return 0, 0
+        t, b = self.size(dim)
+        cl, cb = part.coefs.get("l" + dim, 0), part.coefs.get("b" + dim, 0)
+        lowest, highest = (xs & -xs).bit_length() - 1, xs.bit_length() - 1
+        if cb == cl * t or b == 1 or t == 1:
+            slope = cl if b == 1 else cb if t == 1 else cl
+            ends = [slope * lowest, slope * highest]
+        elif cl == 0:
+            ends = [cb * (lowest // t), cb * (highest // t)]
+        elif cb == 0:
+            # Fold every threadgroup onto the first to see which l are present.
+            folded, shift = xs, t
+            while shift < t * b:
+                folded |= folded >> shift
+                shift *= 2
+            folded &= (1 << t) - 1
+            ends = [cl * ((folded & -folded).bit_length() - 1), cl * (folded.bit_length() - 1)]
+        else:
+            if t * b > 1 << 16:
+                raise Undecidable("index range over a large grid")
+            ends = [cl * (g % t) + cb * (g // t) for g in range(t * b) if xs >> g & 1]
+        return min(ends), max(ends)
+
+    def index_range(self, index, region):
+        if isinstance(index, (int, float)):
+            return index, index
+        if isinstance(index, Mod):
+            return 0, index.m - 1
+        x = self.value_range(index, "x", region.xs)
+        y = self.value_range(index, "y", region.ys)
+        return x[0] + y[0] + index.const, x[1] + y[1] + index.const
+
+    # Predicates
+
+    def predicate(self, node, region):
+        if isinstance(node, ast.BoolOp):
+            kind = "and" if isinstance(node.op, ast.And) else "or"
+            return (kind, [self.predicate(v, region) for v in node.values])
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
+            return ("not", self.predicate(node.operand, region))
+        if isinstance(node, ast.Compare):
+            if len(node.ops) != 1:
+                raise Undecidable("chained comparison")
+            left = self.eval(node.left, region)
+            right = self.eval(node.comparators[0], region)
+            op = CMP_OPS[type(node.ops[0])]
+            if isinstance(left, Data) or isinstance(right, Data):
+                raise Undecidable("branch on a value read from memory")
+            dims = set()
+            for side in (left, right):
+                if isinstance(side, (Lin, Mod)):
+                    dims |= side.dims()
+            if not dims:
+                num = lambda s: s.const if isinstance(s, Lin) else s
+                return ("const", bool(op(num(left), num(right))))
+            if len(dims) > 1:
+                raise Undecidable("condition mixes the x and y thread positions")
+            return ("atom", dims.pop(), (left, op, right))
+        value = self.eval(node, region)
+        if isinstance(value, (int, float, bool)):
+            return ("const", bool(value))
+        if isinstance(value, Lin):
+            return self.predicate(ast.Compare(node, [ast.NotEq()], [ast.Constant(0)]), region)
+        raise Undecidable("branch on a value read from memory")
+
+    def split(self, pred, xs, ys):
+        """Split the threads `xs` x `ys` into rectangles where `pred` holds and doesn't."""
+        kind = pred[0]
+        if kind == "const":
+            return ([(xs, ys)], []) if pred[1] else ([], [(xs, ys)])
+        if kind == "not":
+            t, f = self.split(pred[1], xs, ys)
+            return f, t
+        if kind == "atom":
+            _, dim, test = pred
+            key = (dim, repr(test[0]), test[1], repr(test[2]))
+            if key not in self.masks:
+                self.masks[key] = self.mask(dim, test)
+            m = self.masks[key]
+            if dim == "x":
+                t, f = [(xs & m, ys)], [(xs & ~m, ys)]
+            else:
+                t, f = [(xs, ys & m)], [(xs, ys & ~m)]
+            keep = lambda rects: [r for r in rects if r[0] and r[1]]
+            return keep(t), keep(f)
+        first, rest = pred[1][0], pred[1][1:]
+        rest = rest[0] if len(rest) == 1 else (kind, rest)
+        t, f = self.split(first, xs, ys)
+        decided, undecided = (f, t) if kind == "and" else (t, f)
+        more_t, more_f = [], []
+        for r in undecided:
+            t2, f2 = self.split(rest, *r)
+            more_t += t2
+            more_f += f2
+        if kind == "and":
+            return more_t, decided + more_f
+        return decided + more_t, more_f
+
+    def branch(self, node, regions):
+        yes, no = [], []
+        for region in regions:
+            t, f = self.split(self.predicate(node, region), region.xs, region.ys)
+            yes += [region.copy(*r) for r in t]
+            no += [region.copy(*r) for r in f]
+        return yes, no
+
+    @staticmethod
+    def merge(regions):
+        """Join regions that ended up in the same state and form a rectangle."""
+        groups = {}
+        for region in regions:
+            groups.setdefault(region.key(), []).append(region)
+        merged = []
+        for group in groups.values():
+            changed = True
+            while changed:
+                changed = False
+                for i in range(len(group)):
+                    for j in range(i + 1, len(group)):
+                        a, b = group[i], group[j]
+                        if a.xs == b.xs or a.ys == b.ys:
+                            a.xs, a.ys = (a.xs, a.ys | b.ys) if a.xs == b.xs else (a.xs | b.xs, a.ys)
+                            del group[j]
+                            changed = True
+                            break
+                    if changed:
+                        break
+            merged += group
+        return merged
+
+    # Statements
+
+    def run(self, body, regions):
+        for stmt in body:
+            if not regions:
+                break
+            regions = self.stmt(stmt, regions)
+        return regions
+
+    def stmt(self, node, regions):
+        self.steps += 1
+        if self.steps > MAX_STEPS:
+            raise Undecidable("too many steps")
+        if isinstance(node, ast.Assign):
+            for region in regions:
+                value = self.eval(node.value, region)
+                for target in node.targets:
+                    self.assign(target, value, region)
+            return regions
+        if isinstance(node, ast.AugAssign):
+            load = ast.Subscript(node.target.value, node.target.slice, ast.Load()) \
+                if isinstance(node.target, ast.Subscript) else ast.Name(node.target.id, ast.Load())
+            return self.stmt(ast.Assign([node.target], ast.BinOp(load, node.op, node.value)), regions)
+        if isinstance(node, ast.If):
+            yes, no = self.branch(node.test, regions)
+            return self.merge(self.run(node.body, yes) + self.run(node.orelse, no))
+        if isinstance(node, ast.While):
+            if node.orelse:
+                raise Undecidable("while/else")
+            done = []
+            while regions:
+                regions, exited = self.branch(node.test, regions)
+                done += exited
+                regions = self.merge(self.run(node.body, regions))
+            return self.merge(done)
+        if isinstance(node, ast.Expr):
+            for region in regions:
+                self.eval(node.value, region)
+            return regions
+        if isinstance(node, ast.Pass):
+            return regions
+        raise Undecidable(f"{type(node).__name__} statement")
+
+    def assign(self, target, value, region):
+        if isinstance(target, ast.Name):
+            region.env[target.id] = value
+            return
+        if not isinstance(target, ast.Subscript):
+            raise Undecidable(f"assignment to {type(target).__name__}")
+        table = self.eval(target.value, region)
+        if not isinstance(table, TableInfo):
+            raise Undecidable("write to something that isn't a buffer")
+        self.access(table, "write", self.eval(target.slice, region), region)
+        if not isinstance(value, Data):
+            # Constants aren't recorded, as in the simulator.
+            return
+        count = region.counts.setdefault(region.round, Counter())
+        if table.kind != "in":
+            count[table.kind + "_writes"] += 1
+            count[table.kind + "_write_bytes"] += table.itemsize
+            count[table.kind + "_write_txns"] += 1
+            for name, n in value.reads:
+                source = self.tables[name]
+                kind = "shared" if source.kind == "shared" else "in"
+                count[kind + "_reads"] += n
+                count[kind + "_read_bytes"] += n * source.itemsize
+                count[kind + "_read_txns"] += n
+
+    def access(self, table, kind, index, region):
+        if isinstance(index, tuple):
+            ranges = [self.index_range(i, region) for i in index]
+            lo, hi = tuple(r[0] for r in ranges), tuple(r[1] for r in ranges)
+        else:
+            lo, hi = self.index_range(index, region)
+        key = (table.name, kind, region.round, repr(index))
+        if key in self.accesses:
+            a = self.accesses[key]
+            a.lo, a.hi = min(a.lo, lo), max(a.hi, hi)
+            a.threads += region.threads()
+        else:
+            self.accesses[key] = Access(table.name, kind, region.round, repr(index), lo, hi, region.threads())
+
+    # Expressions
+
+    def eval(self, node, region):
+        if isinstance(node, ast.Constant):
+            return node.value
+        if isinstance(node, ast.Name):
+            if node.id in region.env:
+                return region.env[node.id]
+            if node.id in self.tables:
+                return self.tables[node.id]
+            if node.id in self.shapes:
+                return self.shapes[node.id]
+            if node.id == "metal":
+                return METAL
+            if node.id in ("int", "float", "min", "max", "abs"):
+                return getattr(builtins, node.id)
+            raise Undecidable(f"unknown name {node.id}")
+        if isinstance(node, ast.Attribute):
+            return self.attribute(node, region)
+        if isinstance(node, ast.Subscript):
+            value = self.eval(node.value, region)
+            index = self.eval(node.slice, region)
+            if isinstance(value, tuple) and isinstance(index, int):
+                return value[index]
+            if isinstance(value, TableInfo):
+                self.access(value, "read", index, region)
+                return Data(((value.name, 1),))
+            raise Undecidable("unsupported subscript")
+        if isinstance(node, ast.Tuple):
+            return tuple(self.eval(e, region) for e in node.elts)
+        if isinstance(node, ast.BinOp):
+            left, right = self.eval(node.left, region), self.eval(node.right, region)
+            op = BIN_OPS.get(type(node.op))
+            if op is None:
+                raise Undecidable(f"operator {type(node.op).__name__}")
+            if isinstance(left, (Lin, Mod, Data)) or isinstance(right, (Lin, Mod, Data)):
+                if op not in (operator.add, operator.sub, operator.mul, operator.mod):
+                    raise Undecidable(f"{type(node.op).__name__} of a thread-dependent value")
+                if isinstance(left, Data) or isinstance(right, Data):
+                    if op not in (operator.add, operator.mul):
+                        raise Undecidable("arithmetic the simulator doesn't support on memory values")
+                if isinstance(left, Mod) or isinstance(right, Mod):
+                    raise Undecidable("arithmetic on a modulo")
+            result = op(left, right)
+            if result is NotImplemented:
+                raise Undecidable("unsupported arithmetic")
+            return result
+        if isinstance(node, ast.UnaryOp):
+            value = self.eval(node.operand, region)
+            if isinstance(node.op, ast.USub) and isinstance(value, (int, float, Lin)):
+                return -value
+            if isinstance(node.op, ast.UAdd) and isinstance(value, (int, float, Lin)):
+                return value
+            if isinstance(node.op, ast.Not) and isinstance(value, (int, float, bool)):
+                return not value
+            raise Undecidable("unsupported unary operator")
+        if isinstance(node, (ast.Compare, ast.BoolOp)):
+            pred = self.predicate(node, region)
+            if pred[0] != "const":
+                raise Undecidable("thread-dependent boolean value")
+            return pred[1]
+        if isinstance(node, ast.IfExp):
+            pred = self.predicate(node.test, region)
+            if pred[0] != "const":
+                raise Undecidable("thread-dependent conditional expression")
+            return self.eval(node.body if pred[1] else node.orelse, region)
+        if isinstance(node, ast.Call):
+            return self.call(node, region)
+        raise Undecidable(f"{type(node).__name__} expression")
+
+    def attribute(self, node, region):
+        value = self.eval(node.value, region)
+        if value is METAL:
+            if node.attr in COORDS or node.attr == "threadgroupMemory":
+                return (METAL, node.attr)
+            if node.attr == "thread_index_in_threadgroup":
+                return Lin({"lx": 1, "ly": self.T.x})
+            raise Undecidable(f"metal.{node.attr}")
+        if isinstance(value, tuple) and len(value) == 2 and value[0] is METAL and node.attr in ("x", "y"):
+            dim = node.attr
+            t = getattr(self.T, dim)
+            if value[1] == "threads_per_threadgroup":
+                return t
+            if value[1] == "thread_position_in_threadgroup":
+                return Lin({"l" + dim: 1})
+            if value[1] == "threadgroup_position_in_grid":
+                return Lin({"b" + dim: 1})
+            if value[1] == "thread_position_in_grid":
+                return Lin({"l" + dim: 1, "b" + dim: t})
+        raise Undecidable(f"attribute {node.attr}")
+
+    def call(self, node, region):
+        if node.keywords:
+            raise Undecidable("keyword arguments")
+        fn = self.eval(node.func, region) if not isinstance(node.func, ast.Attribute) else None
+        if isinstance(node.func, ast.Attribute):
+            owner = self.eval(node.func.value, region)
+            if owner is METAL and node.func.attr == "syncthreads":
+                finished = (region.history, frozenset(region.counts.get(region.round, Counter()).items()))
+                region.history = self.histories.setdefault(finished, len(self.histories) + 1)
+                region.round += 1
+                return None
+            if owner == (METAL, "threadgroupMemory") and node.func.attr == "array":
+                # Each declaration is one threadgroup array, shared by all threads.
+                if id(node) not in self.declared:
+                    args = [self.eval(a, region) for a in node.args]
+                    size = (args[0],) if isinstance(args[0], int) else args[0]
+                    dtype = args[1] if len(args) > 1 else "float"
+                    name = "S" + str(len(self.declared))
+                    self.declared[id(node)] = name
+                    self.tables[name] = TableInfo(name, size, "shared", itemsize(dtype))
+                return self.tables[self.declared[id(node)]]
+            raise Undecidable(f"call to {ast.unparse(node.func)}")
+        args = [self.eval(a, region) for a in node.args]
+        if fn is int and len(args) == 1 and isinstance(args[0], Lin):
+            if all(isinstance(c, int) for c in args[0].coefs.values()) and isinstance(args[0].const, int):
+                return args[0]
+            raise Undecidable("int() of a fractional thread-dependent value")
+        if all(isinstance(a, (int, float)) for a in args):
+            return fn(*args)
+        raise Undecidable(f"{fn.__name__}() of a thread-dependent value")
+
+
+def analyze_kernel(kernel, inputs, output_shapes, output_dtypes, threadsperblock, blockspergrid, name=""):
+    """Score `kernel` without running its threads. Raises `Undecidable` if it can't."""
+    source = kernel.header + kernel.source
+    if re.search(r"\b(simd_\w+|simdgroup_\w+|atomic_\w+)\s*\(|\bthread_index_in_simdgroup\b|\bsimdgroup_index_in_threadgroup\b", source):
+        raise Undecidable("SIMD-group and atomic operations")
+    if re.search(r"reinterpret_cast|\b(half|float|int|uint)[234]\b", source):
+        raise Undecidable("vector types")
+    tree = parse_source(source)
+
+    tables, shapes = {}, {}
+    for n, x in zip(kernel.input_names, inputs):
+        tables[n] = TableInfo(n, tuple(x.shape), "in", itemsize(x.dtype))
+        shapes[n + "_shape"] = tuple(x.shape)
+        shapes[n + "_ndim"] = len(x.shape)
+        shapes[n + "_strides"] = row_major_strides(x.shape)
+    for n, shape, dtype in zip(kernel.output_names, output_shapes, output_dtypes):
+        tables[n] = TableInfo(n, tuple(shape), "out", itemsize(dtype))
+
+    analyzer = KernelAnalyzer(tables, shapes, threadsperblock, blockspergrid)
+    start = Region(analyzer.full["x"], analyzer.full["y"])
+    regions = analyzer.run(tree.body, [start])
+
+    # Per-thread counts are the same for every thread of a region.
+    threads = analyzer.G.x * analyzer.G.y
+    full, total = Counter(), Counter()
+    rounds = {}
+    for region in regions:
+        n = region.threads()
+        per_thread = Counter()
+        for r, count in region.counts.items():
+            per_thread.update(count)
+            top, round_total = rounds.setdefault(r, (Counter(), Counter()))
+            for k, v in count.items():
+                top[k] = max(top[k], v)
+                round_total[k] += v * n
+        for k, v in per_thread.items():
+            full[k] = max(full[k], v)
+            total[k] += v * n
+    mean = Counter({k: v / threads for k, v in total.items()})
+    rounds = [
+        {"max": rounds[r][0], "mean": Counter({k: v / threads for k, v in rounds[r][1].items()}), "total": rounds[r][1]}
+        if r in rounds else {"max": Counter(), "mean": Counter(), "total": Counter()}
+        for r in range(max(rounds, default=0) + 1)
+    ]
+    score = Score(name, threads, full, mean, total, rounds)
+
+    accesses = list(analyzer.accesses.values())
+    out_of_bounds = []
+    for a in accesses:
+        size = analyzer.tables[a.table].size
+        lo, hi = (a.lo, a.hi) if isinstance(a.lo, tuple) else ((a.lo,), (a.hi,))
+        dims = size if len(lo) == len(size) else (math.prod(size),)
+        if any(l < 0 or h >= n for l, h, n in zip(lo, hi, dims)):
+            out_of_bounds.append(
+                f"{a.table}[{a.index}] {a.kind}s indices {a.lo}..{a.hi} "
+                f"in round {a.round}, but {a.table} has shape {size}"
+            )
+    return Analysis(score, accesses, out_of_bounds)
+
 
 # Some drawing constants
 black = Color("black")
@@ -456,17 +3406,28 @@ def draw_table(tab):
     t = text(tab.name, 0.5).fill_color(black).line_width(0.0)
     if len(tab.size) == 1:
         tab = table(tab.name, 0, *tab.size)
+    elif len(tab.size) == 3:
+        # simdgroup matrices: one 8x8 block per SIMD group, side by side.
+        g, r, c = tab.size
+        tab = concat(
+            [
+                rectangle(1, 1).translate(k * (r + 1) + i, j).named((tab.name, k, i, j))
+                for k in range(g)
+                for i in range(r)
+                for j in range(c)
+            ]
+        ).center_xy()
     else:
         tab = table(tab.name, *tab.size)
     tab = tab.line_width(0.05)
     return tab.beside((t + vstrut(0.5)), -unit_y)
 
 
-def draw_connect(tab, dia, loc2, color, con):
+def draw_connect(tab, dia, threads):
     return concat(
         [
-            myconnect(dia, loc2, color, con, (tab.name,) + loc, inp.location)
-            for (loc, val) in tab.incoming
+            myconnect(dia, *threads[tt], (tab.name,) + loc, inp.location)
+            for (loc, val, tt, _) in tab.incoming
             for inp in val.inputs
         ]
     )
@@ -474,18 +3435,19 @@ def draw_connect(tab, dia, loc2, color, con):
 def grid(mat, sep):
     return vcat([ hcat([y for y in x] , sep) for x in mat], sep )
 
-def draw_base(_, a, c, out):
+def draw_base(_, a, c, outs):
     inputs = vcat([draw_table(d) for d in a], 2.0).center_xy()
     shared_tables = [[draw_table(c2.refs[i]) for i in range(1, c.rounds())] for c2 in c.caches]
     shareds = grid(shared_tables, 1.0).center_xy()
-    outputs = draw_table(out).center_xy()
-    return hcat([inputs, shareds, outputs], 2.0)
+    registers = hcat([draw_table(r) for r in c.threadgroupMemory.registers], 1.0).center_xy()
+    outputs = vcat([draw_table(d) for d in outs], 2.0).center_xy()
+    return hcat([inputs, shareds, registers, outputs], 2.0)
 
 
 def draw_coins(tpbx, tpby):
     return concat(
         [
-            (circle(0.5).fill_color(colors[tt]).fill_opacity(0.7) + im).translate(
+            (circle(0.5).fill_color(colors[tt % len(colors)]).fill_opacity(0.7) + im).translate(
                 pos.x * 1.1, pos.y * 1.1
             )
             for tt, pos in Coord(tpbx, tpby).enumerate()
@@ -499,20 +3461,39 @@ def label(dia, content):
     return (dia + dia.juxtapose(t, -unit_y)).center_xy()
 
 
+def grid_columns(results):
+    """Map the threadgroup x and y coordinates in `results` to drawing columns and rows.
+
+    Sampled results skip most of the grid; the gaps are closed up.
+    """
+    xs = sorted({b.x for b in results})
+    ys = sorted({b.y for b in results})
+    return {x: i for i, x in enumerate(xs)}, {y: i for i, y in enumerate(ys)}
+
+
+def threadgroup_title(results, threadgroup):
+    title = f"Threadgroup {threadgroup.x} {threadgroup.y}"
+    if getattr(results, "strata", None):
+        title += f" (sampled, {results.stratum(threadgroup)})"
+    return title
+
+
 def draw_results(results, name, tpbx, tpby, sparse=False):
     full = empty()
     threadgroups = []
     locations = []
-    base = draw_base(*results[Coord(0, 0)][Coord(0, 0)])
+    base = draw_base(*next(iter(next(iter(results.values())).values())))
+    xs, ys = grid_columns(results)
     for threadgroup, inner in results.items():
-        dia = base
-        for pos, (tt, a, c, out) in inner.items():
+        # Location, colour and whether to draw lines for each thread.
+        threads = {}
+        for pos, (tt, a, c, outs) in inner.items():
             loc = (
                 pos.x / tpbx + (1 / (2 * tpbx)),
                 (pos.y / tpby)
                 + (1 / (2 * tpby)),
             )
-            color = colors[tt]
+            color = colors[tt % len(colors)]
             
             lines = True
             if sparse:
@@ -520,19 +3501,19 @@ def draw_results(results, name, tpbx, tpby, sparse=False):
                     pos.x == (tpbx - 1)
                     and pos.y == (tpby - 1)
                 )
-            all_tabs = (
-                a + [c2.refs[i] for i in range(1, c.rounds()) for c2 in c.caches] + [out]
-            )
-            dia = dia + concat(
-                draw_connect(t, dia, loc, color, lines) for t in all_tabs
-            )
+            threads[tt] = (loc, color, lines)
+        all_tabs = (
+            a + [c2.refs[i] for i in range(1, c.rounds()) for c2 in c.caches]
+            + c.threadgroupMemory.registers + outs
+        )
+        dia = base + concat(draw_connect(t, base, threads) for t in all_tabs)
         height = dia.get_envelope().height
 
         # Label threadgroup and surround
         if name in ["Map", "Zip", "Guard", "Map 2D", "Broadcast"]:
             dia = hstrut(1) | (label(dia, "Grid")) | hstrut(1)
         else:
-            dia = hstrut(1) | (label(dia, f"Threadgroup {threadgroup.x} {threadgroup.y}")) | hstrut(1)
+            dia = hstrut(1) | (label(dia, threadgroup_title(results, threadgroup))) | hstrut(1)
         dia = dia.center_xy().pad(1.2)
         env = dia.get_envelope()
         dia = dia + rectangle(env.width, env.height, 0.5).line_color(
@@ -541,7 +3522,7 @@ def draw_results(results, name, tpbx, tpby, sparse=False):
 
         
         threadgroups.append(dia.pad(1.1))
-        locations.append(P2(threadgroup.x, threadgroup.y))
+        locations.append(P2(xs[threadgroup.x], ys[threadgroup.y]))
 
     # Grid threadgroups
     env = threadgroups[0].get_envelope()
@@ -565,3 +3546,335 @@ def draw_results(results, name, tpbx, tpby, sparse=False):
 
     chalk.core.set_svg_output_height(500)
     return rectangle(env.width, env.height).fill_color(white) + full
+
+
+# Streaming SVG output. `draw_results` builds the whole chalk diagram in
+# memory before anything is written, which doesn't scale to big grids.
+# `write_results` lays out the same tables, arcs, markers and labels from the
+# table shapes alone and writes each element to the file as the trace is
+# walked.
+
+SVG_SCALE = 50  # pixels per table cell
+
+class Box:
+    """A laid-out group of tables: size plus each table's top-left corner."""
+    def __init__(self, width=0.0, height=0.0, tables=()):
+        self.width = width
+        self.height = height
+        self.tables = list(tables)
+
+    @staticmethod
+    def table(tab):
+        # A 1.0 high label area sits above the cells.
+        w, h = table_extent(tab)
+        return Box(w, h + 1.0, [(tab, 0.0, 1.0)])
+
+    @staticmethod
+    def cat(boxes, sep, horizontal):
+        boxes = [b for b in boxes if b.tables]
+        out = Box()
+        if not boxes:
+            return out
+        if horizontal:
+            out.height = max(b.height for b in boxes)
+        else:
+            out.width = max(b.width for b in boxes)
+        pos = 0.0
+        for b in boxes:
+            if horizontal:
+                dx, dy = pos, (out.height - b.height) / 2
+                pos += b.width + sep
+            else:
+                dx, dy = (out.width - b.width) / 2, pos
+                pos += b.height + sep
+            out.tables += [(t, x + dx, y + dy) for t, x, y in b.tables]
+        if horizontal:
+            out.width = pos - sep
+        else:
+            out.height = pos - sep
+        return out
+
+
+def table_extent(tab):
+    if len(tab.size) == 1:
+        return 1, tab.size[0]
+    if len(tab.size) == 3:
+        g, r, c = tab.size
+        return g * (r + 1) - 1, c
+    return tab.size[0], tab.size[1]
+
+
+def cell_offset(tab, index):
+    """Top-left corner of a cell, relative to its table, as `draw_table` lays it out."""
+    if len(tab.size) == 1:
+        return 0, index[0]
+    if len(tab.size) == 3:
+        k, i, j = index
+        return k * (tab.size[1] + 1) + i, j
+    return index[0], index[1]
+
+
+def layout_base(_, a, c, outs):
+    """Same arrangement as `draw_base`: inputs | shared | registers | outputs."""
+    inputs = Box.cat([Box.table(t) for t in a], 2.0, False)
+    shared = Box.cat(
+        [Box.cat([Box.table(c2.refs[i]) for i in range(1, c.rounds())], 1.0, True) for c2 in c.caches],
+        1.0, False,
+    )
+    registers = Box.cat([Box.table(r) for r in c.threadgroupMemory.registers], 1.0, True)
+    outputs = Box.cat([Box.table(t) for t in outs], 2.0, False)
+    return Box.cat([inputs, shared, registers, outputs], 2.0, True)
+
+
+class SVGWriter:
+    """Writes SVG elements straight to a text stream, in table-cell units.
+
+    Shared attributes live in the stylesheet so each element only carries
+    its coordinates and colour.
+    """
+    STYLE = (
+        "rect{fill:none;stroke:black;stroke-width:.05}"
+        "line{stroke-width:.04}"
+        "circle{stroke:black;stroke-width:.02}"
+        "text{text-anchor:middle;dominant-baseline:middle}"
+        ".m{stroke-width:.08}"
+    )
+
+    def __init__(self, out):
+        self.out = out
+        self.elements = 0
+
+    def header(self, width, height):
+        self.out.write(
+            f'<svg xmlns="http://www.w3.org/2000/svg" width="{width * SVG_SCALE:.0f}" '
+            f'height="{height * SVG_SCALE:.0f}" viewBox="0 0 {width:.2f} {height:.2f}">\n'
+            f'<style>{self.STYLE}</style>\n'
+            f'<rect width="{width:.2f}" height="{height:.2f}" style="fill:white;stroke:none"/>\n'
+        )
+
+    def write(self, element):
+        self.out.write(element)
+        self.elements += 1
+
+    def rect(self, x, y, w, h, stroke="black", rx=0):
+        self.write(f'<rect x="{x:.2f}" y="{y:.2f}" width="{w:.2f}" height="{h:.2f}" rx="{rx}" stroke="{stroke}"/>\n')
+
+    def marker(self, x, y, color):
+        """Outline of a written cell."""
+        self.write(f'<rect class="m" x="{x - 0.475:.2f}" y="{y - 0.475:.2f}" width=".95" height=".95" stroke="{color}"/>\n')
+
+    def line(self, x1, y1, x2, y2, stroke):
+        self.write(f'<line x1="{x1:.2f}" y1="{y1:.2f}" x2="{x2:.2f}" y2="{y2:.2f}" stroke="{stroke}"/>\n')
+
+    def fill(self, x, y, w, h, color, opacity=1.0):
+        self.write(
+            f'<rect x="{x:.2f}" y="{y:.2f}" width="{w:.2f}" height="{h:.2f}" '
+            f'style="fill:{color};fill-opacity:{opacity};stroke:none"/>\n'
+        )
+
+    def circle(self, x, y, r, fill, opacity=1.0):
+        self.write(f'<circle cx="{x:.2f}" cy="{y:.2f}" r="{r}" fill="{fill}" fill-opacity="{opacity}"/>\n')
+
+    def text(self, x, y, content, size):
+        self.write(f'<text x="{x:.2f}" y="{y:.2f}" font-size="{size}">{html.escape(content)}</text>\n')
+
+    def symbol(self, id):
+        """Start a reusable group; elements up to `end_symbol` belong to it."""
+        self.out.write(f'<symbol id="{id}" overflow="visible">\n')
+
+    def end_symbol(self):
+        self.out.write("</symbol>\n")
+
+    def use(self, id, x=0.0, y=0.0):
+        self.write(f'<use href="#{id}" x="{x:.2f}" y="{y:.2f}"/>\n')
+
+    def close(self):
+        self.out.write("</svg>\n")
+
+
+def write_table(svg, tab, x, y):
+    w, _ = table_extent(tab)
+    svg.text(x + w / 2, y - 0.5, tab.name, 0.5)
+    for index in tab_cells(tab):
+        cx, cy = cell_offset(tab, index)
+        svg.rect(x + cx, y + cy, 1, 1)
+
+
+def tab_cells(tab):
+    return itertools.product(*(range(n) for n in tab.size))
+
+
+def connections(inner, corners, tpbx, tpby, sparse):
+    """The arcs, cell markers and thread dots of one threadgroup's trace.
+
+    Elements are `(kind, x, y, ...)` tuples in threadgroup coordinates.
+    """
+    def center(location):
+        assert location[0] in corners, f"{location}: You may be reading/writing from an un'synced array"
+        tab, x, y = corners[location[0]]
+        cx, cy = cell_offset(tab, location[1:])
+        return x + cx + 0.5, y + cy + 0.5
+
+    threads = {}
+    for pos, (tt, a, c, outs) in inner.items():
+        loc = (pos.x / tpbx + 1 / (2 * tpbx), pos.y / tpby + 1 / (2 * tpby))
+        lines = not sparse or (pos.x == 0 and pos.y == 0) or (pos.x == tpbx - 1 and pos.y == tpby - 1)
+        threads[tt] = (loc, colors[tt % len(colors)].hex_l, lines)
+    all_tabs = (
+        a + [c2.refs[i] for i in range(1, c.rounds()) for c2 in c.caches]
+        + c.threadgroupMemory.registers + outs
+    )
+    elements = []
+    for tab in all_tabs:
+        for index, val, tt, _ in tab.incoming:
+            (lx, ly), color, lines = threads[tt]
+            x1, y1 = center((tab.name,) + index)
+            for inp in val.inputs:
+                x2, y2 = center(inp.location)
+                x2 += (lx - 0.5) * 0.85
+                y2 += (ly - 0.5) * 0.85
+                if lines:
+                    elements.append(("line", x1 - 0.5, y1, x2, y2, color))
+                elements.append(("marker", x1, y1, color))
+                elements.append(("circle", x2, y2, color))
+    return elements
+
+
+def write_connections(svg, elements, dx=0.0, dy=0.0):
+    for e in elements:
+        if e[0] == "line":
+            svg.line(e[1] - dx, e[2] - dy, e[3] - dx, e[4] - dy, e[5])
+        elif e[0] == "marker":
+            svg.marker(e[1] - dx, e[2] - dy, e[3])
+        else:
+            svg.circle(e[1] - dx, e[2] - dy, 0.1, e[3])
+
+
+def pattern_key(elements):
+    """`elements` moved so their top-left corner is at the origin, and that corner.
+
+    Two threadgroups whose keys match draw the same picture up to a
+    translation.
+    """
+    xs = [v for e in elements for v in (e[1::2][:2] if e[0] == "line" else e[1:2])]
+    ys = [v for e in elements for v in (e[2::2][:2] if e[0] == "line" else e[2:3])]
+    dx, dy = min(xs), min(ys)
+    key = []
+    for e in elements:
+        if e[0] == "line":
+            key.append((e[0], round(e[1] - dx, 3), round(e[2] - dy, 3), round(e[3] - dx, 3), round(e[4] - dy, 3), e[5]))
+        else:
+            key.append((e[0], round(e[1] - dx, 3), round(e[2] - dy, 3), e[3]))
+    return tuple(key), dx, dy
+
+
+def write_results(results, name, tpbx, tpby, out, sparse=False, instanced=True):
+    """Stream the drawing of `results` as SVG to `out`, a path or text file.
+
+    Produces the same picture as `draw_results` without building it in
+    memory first. With `instanced`, threadgroups whose connections are a
+    translated copy of an earlier threadgroup's reuse them via `<use>`.
+    Returns the number of elements written.
+    """
+    if isinstance(out, str):
+        with open(out, "w", buffering=1 << 20) as f:
+            return write_results(results, name, tpbx, tpby, f, sparse, instanced)
+
+    base = layout_base(*next(iter(next(iter(results.values())).values())))
+    margin, footer, gap = 1.5, 1.5, 1.0
+    panel_w = base.width + 2 * margin
+    panel_h = base.height + 2 * margin + footer
+    xs, ys = grid_columns(results)
+    blocks = len(xs), len(ys)
+    coins_w, coins_h = (tpbx - 1) * 1.1 + 1, (tpby - 1) * 1.1 + 1
+    top = 1.5 + 1 + 1 + coins_h + 1
+    width = max(blocks[0] * (panel_w + gap), coins_w) + 2 * gap
+    height = top + blocks[1] * (panel_h + gap) + gap
+
+    svg = SVGWriter(out)
+    svg.header(width, height)
+    svg.text(width / 2, 2.0, name, 1)
+    for tt, pos in Coord(tpbx, tpby).enumerate():
+        svg.circle(
+            (width - coins_w) / 2 + 0.5 + pos.x * 1.1, 3.5 + 0.5 + pos.y * 1.1, 0.5,
+            colors[tt % len(colors)].hex_l, opacity=0.7,
+        )
+
+    # Every threadgroup has the same frame and tables: one symbol, used
+    # once per threadgroup.
+    svg.symbol("frame")
+    svg.rect(0, 0, panel_w, panel_h, stroke="grey", rx=0.5)
+    for tab, x, y in base.tables:
+        write_table(svg, tab, margin + x, margin + y)
+    svg.end_symbol()
+
+    # Cell positions are shared by every threadgroup; look them up by
+    # table name in each threadgroup's own trace.
+    corners = {tab.name: (tab, margin + x, margin + y) for tab, x, y in base.tables}
+    patterns = {}
+
+    for threadgroup, inner in results.items():
+        ox = gap + (width - 2 * gap - blocks[0] * (panel_w + gap)) / 2 + xs[threadgroup.x] * (panel_w + gap)
+        oy = top + ys[threadgroup.y] * (panel_h + gap)
+        elements = connections(inner, corners, tpbx, tpby, sparse)
+        if instanced and elements:
+            key, dx, dy = pattern_key(elements)
+            if key not in patterns:
+                patterns[key] = f"tg{len(patterns)}"
+                svg.symbol(patterns[key])
+                write_connections(svg, elements, dx, dy)
+                svg.end_symbol()
+
+        svg.out.write(f'<g transform="translate({ox:.2f},{oy:.2f})">\n')
+        svg.use("frame")
+        if name in ["Map", "Zip", "Guard", "Map 2D", "Broadcast"]:
+            title = "Grid"
+        else:
+            title = threadgroup_title(results, threadgroup)
+        svg.text(panel_w / 2, panel_h - margin - 0.25, title, 0.5)
+        if instanced and elements:
+            svg.use(patterns[key], dx, dy)
+        else:
+            write_connections(svg, elements)
+        svg.out.write("</g>\n")
+    svg.close()
+    return svg.elements
+
+
+def write_trace_diff(results, diff, name, out):
+    """Draw the tables of `results`, filling the cells changed in `diff`.
+
+    `diff` comes from `trace_diff`: cells with more accesses are red,
+    cells with fewer green, labelled with the change. `out` is a path or
+    text file.
+    """
+    if isinstance(out, str):
+        with open(out, "w") as f:
+            return write_trace_diff(results, diff, name, f)
+
+    base = layout_base(*next(iter(next(iter(results.values())).values())))
+    margin, top = 1.5, 3.0
+    width, height = base.width + 2 * margin, base.height + top + margin
+    changes = {}
+    for tab, index, kind, before, after in diff:
+        changes.setdefault((tab, index), []).append(f"{kind[0]}{after - before:+d}")
+        changes[(tab, index)].sort()
+
+    svg = SVGWriter(out)
+    svg.header(width, height)
+    svg.text(width / 2, 1.5, name, 1)
+    shown = set()
+    for tab, x, y in base.tables:
+        x, y = margin + x, top + y
+        # Threadgroup arrays are drawn once per barrier round; mark the first.
+        key = tab.name.rstrip("'")
+        for index in tab_cells(tab):
+            if (key, index) in changes and (key, index) not in shown:
+                shown.add((key, index))
+                cx, cy = cell_offset(tab, index)
+                total = sum(int(c[1:]) for c in changes[(key, index)])
+                svg.fill(x + cx, y + cy, 1, 1, "red" if total > 0 else "green", 0.4)
+                svg.text(x + cx + 0.5, y + cy + 0.5, " ".join(changes[(key, index)]), 0.25)
+        write_table(svg, tab, x, y)
+    svg.close()
+    return svg.elements